@@ -25,26 +25,59 @@
 #  Author: Chase LP
 ###
 
-import re, time, threading
+import re, time, queue, threading
+from collections import deque
 from random import randint
 from sys import exc_info
 from traceback import format_exception
+from combatqueue import CombatScheduler
+from roster import PartyRoster
+from enemydb import EnemyDB
+from worldmap import WorldMap
+from worldstore import WorldStore
+from inventory import Inventory, invpage
+from dontsell import DontSellIndex
+from ledger import ItemLedger
+from latency import CommandLatency
+from charstate import CharState
+from querycache import QueryCache
+from lambcommands import CommandTracker, CommandError, commonerrors
+from statemachine import State, Machine, Scheduler, sendcmd, awaiting
+from fight import Fight
+from disposal import Disposal
+from loopscript import LoopScript, ScriptError, compileline, test
+from timers import TimerHeap, findeta, seconds
+from botconfig import BotConfig
+from metrics import timed
+from tracing import Tracer, traced
 
-# entermsg is a dict keyed on locations with entrance messages as values
-entermsg = {'Redmond':'You arrive at Redmond',
-            'Redmond_Hotel':'You enter the Redmond Hotel',
-            ################ The OrkHQ, for getting bacon
-            'Redmond_OrkHQ':'You enter the ork headquarters',
-            'OrkHQ_StorageRoom':'You continue inside OrkHQ_StorageRoom',
-            # Confirmed exit messages the same for:
-            # Redmond_OrkHQ, Redmond_Hideout, Seattle_Renraku,
-            # Seattle_Forest, Seattle_Harbor, Delaware_Nysoft,
-            # Delaware_Prison
-            'Exit':'You can return to this location',
-            # '#travel 1' moves to the right, 2 to left, (unless in redmond)
-            # Chicago <-> Delaware <-> Seattle <-> Redmond
-            'Subway':'You enter the Subway',
-           }
+# Handled in every state of our machines, a fight is an activity of the state
+machineinterrupts = {'combat':lambda bot, event: Fight(bot, event.line),
+                     'meet':lambda bot, event: bot.meet(event.line, wait=False)}
+
+# Lines telling us where we are, the location is the first group,
+#  with whether the line puts us inside the location or outside of it
+positionlines = [(re.compile(r'You are inside (\S+)$'), True),
+                 (re.compile(r'You are outside of (\S+)$'), False),
+                 (re.compile(r'now outside of (\S+)'), False),
+                 (re.compile(r'You continue inside (\S+)'), True),
+                 (re.compile(r'You arrive at (\S+)'), False),
+                ]
+# The response from #kp and #kw
+knownplaces = re.compile(r'Known Places in ([^:\s]+)[^:]*: (.*)$')
+knownwords = re.compile(r'Known Words[^:]*: (.*)$')
+
+''' listentries
+    Returns the entries of a #kp or #kw response without their numbers
+    "Known Places in Redmond: 1-Hotel, 2-OrkHQ" -> ['Hotel', 'OrkHQ']
+'''
+def listentries(text):
+  entries = text.split(':')[-1].split(', ')
+  return [re.sub(r'^\d+-', '', entry.strip()) for entry in entries
+                                              if entry.strip() != '']
+
+# A friendly name with its server, e.g., 1-chaseleif{57}[L59]
+friendlyname = re.compile(r'(\d+-)?([^\s{\[,]+){(\d+)}(\[\S+\])?')
 
 ''' class ShadowThread
     Attributes
@@ -52,75 +85,145 @@ entermsg = {'Redmond':'You arrive at Redmond',
     doloop        - None or a string, indicating which method to do inside printloop
     doquit        - boolean, indicates whether the thread should exit
     irc           - reference to an IRCHandler class, wraps the irc connection
+    config        - BotConfig, our settings, every setting below in it is
+                     read through a property and replaced with setconfig()
     lambbot       - string, the nick of the Shadow Lamb bot we will talk to
     meetsay       - None or a string, what we will say upon "You meet ..." messages
     invstop       - The stop position for considering items to sell / push to bank
+    shedload      - The fraction of our carrying capacity at which we shedinv
     lambmsg       - An re object to test for and get messages from the Lamb bot
     bumsleft      - A counter of bums needed to kill for the 'Bummer' quest
     precmds       - A list of commands to run before entering a loop function
+    loopscript    - None, or the filename of the loop script for the script loop
     escortnick    - The nick of the person we're escorting
     badcmds       - A list of commands we will not do during escort
     cancast       - Boolean indicating whether we can cast tele/calm/heal
     attacklow     - Boolean indicating whether to attack high or low levels
+    combatq       - CombatScheduler, holds combat commands until we are not busy
+    roster        - PartyRoster, our party members with their levels and HP/MP
+    enemydb       - EnemyDB, what we have learned about each enemy type
+    targetdb      - Boolean indicating whether to choose targets using the enemydb
+    worldmap      - WorldMap, cities, subway links and locations for route planning
+    worldstore    - WorldStore, known places/words, positions and entrance messages,
+                     shared with the other bots on this host
+    inventory     - Inventory, an index of our items kept from passive messages
+    dontsell      - DontSellIndex, items the store refused and items we keep
+    ledger        - ItemLedger, what items sell for and weigh, decides sell / bank / keep
+    mintrip       - The least nuyen we expect from a sell trip before making it
+    charstate     - CharState, our HP, MP, level, XP, karma and nuyen
+    restbelow     - The fraction of HP and MP below which we go to #sleep
+    statusage     - Seconds after which HP / MP are too old to decide on resting
+    querycache    - QueryCache, responses to #kp, #kw, #level and #party
+    commands      - CommandTracker, commands sent with send() awaiting their responses
+    timers        - TimerHeap, arrival and shed deadlines and periodic jobs
+    remaining     - The time our current action (travel, going, ...) is due to finish
+    shedevery     - Seconds between sheds when we can't tell how much we carry
+    controls      - queue.Queue of (attribute, value, event) from control(),
+                     applied by our thread
+    stats         - None, or a fleetstats StatsSlot for our loot, iterations
+                     and errors, set with control('stats', ...)
+    iteration     - The iteration counter of the current doloop
+    metrics       - BotMetrics, shared with our irc, served by metrics.serve()
+    tracer        - Tracer, spans of the phases of each iteration, written to
+                     the tracefile setting when it is set
+    latency       - CommandLatency, how long the Lamb bot takes to answer each command
+    position      - The location we were last seen in this run, None if unknown
 
     Internal Methods
     getlambmsg    - Returns a string, the stripped message from the Lamb bot (or empty if not a Lamb msg)
+    observe       - Called with every received line, updates the roster, inventory and world knowledge
     sleepreceive  - 'Sleeps' for ~ a duration, responding to IRC messages
     awaitresponse - Awaits a specific response from the Lamb bot, returns the string response
     handlecombat  - Called when in combat, returns when combat is over
-    cityrank      - Returns an ordinal value for cities, used for subway travel
     walkpath      - Issues "goto" commands for all locations within a list to walk a path
-    gotoloc       - Travels to a destination location
+    whereami      - Returns the location we are in, stopping any exploring or going
+    gotoloc       - Travels to a destination location along the cheapest planned route
     printloop     - The thread function, calls method specified by doloop, loop is quit for exceptions
+    syncinventory - Refetches the "#inventory" pages when the inventory index has drifted
     invflush      - This method flushes inventory up to a point
+    disposeitems  - Sends pipelined disposal commands for invflush
+    meet          - Fights the bums we still need to kill, otherwise says meetsay and #bye
+    query         - Returns the response to an info command, cached when fresh
+    cachereport   - Prints the query cache hit / miss counters
+    prefetch      - Sends every uncached query at once
+    send          - Sends a command, returns a LambCommand with a future
+    wait          - Waits for commands from send(), returns their results
+    expirecommands - Fails commands past their deadline, sets a timer for the next
+    rest          - Sends #sleep and waits until we are rested
+    exploremachine - Returns the state machine for one iteration of explore
+    getbaconmachine - Returns the state machine for one iteration of getbacon
+    forestmachine - Returns the state machine for one iteration of forest
+    statusstates  - States asking for #status when needrest or needshed would
+    travelstates  - States going to a place and entering it
+    reststates    - States going to the hotel to #sleep when we need to rest
+    shedstates    - States selling and banking what the ledger plans to shed
+    needstatus    - Returns True if needrest or needshed would ask for #status
+    precmdsteps   - Returns the precmds, compiled when they change
+    runsteps      - Runs compiled loop script steps
+    status        - Asks for #status, returns the response
+    receive       - Returns a response from irc, firing due timers
+    applycontrols - Applies the changes made with control()
+    setconfig     - Replaces our settings with another BotConfig
+    control       - Sets an attribute from another thread, waking ours
+    needrest      - Returns True if HP or MP is low enough to #sleep
+    load          - Returns the fraction of our carrying capacity we carry
+    needshed      - Returns True if we carry enough to shedinv
+    shedroom      - Returns what we carry and what we should after shedinv
+    enemyreport   - Prints the most profitable enemies per minute of combat
+    itemreport    - Prints what items sell for, per unit and per kg
+    latencyreport - Prints how long the Lamb bot takes to answer each command
 
     Doloop Methods
     getbacon      - Goes to the OrkHQ, then repeatedly kills FatOrk to get bacon
     explore       - Explores the current city on a loop
+    script        - Runs the loop script file set in loopscript
 '''
 class ShadowThread():
   doloop      = None    # None, or a string with the name of the loop function to do
   softquit    = False   # A flag to tell the thread to quit 'soon'
   doquit      = False   # A flag to tell the thread to quit
-  meetsay     = None    # None, or a string we will say when we 'meet' civilians
-  invstop     = 0       # Inventory stop position for selling and getting rid of inventory
   lambmsg     = None    # a compiled re to test for / retrieve lamb messages
   bumsleft    = 0       # Number of bums left to kill
-  precmds     = []      # List of commands to run when beginning doloop()
   server      = 'None'  # This bot's server, e.g., {14}, for duplicate names
-  escortnick  = ''      # The nick of the person we're escorting
-  badcmds     = []      # List of commands not to do during escort loop
-  cancast     = True    # Whether we can cast teleport/calm/heal
-  escortcasts = False   # Whether our escort can cast spells
-  attacklow   = True    # Default is to prioritize quicker kills during fight
   colors      = True    # Print color messages, init will toggle to false
   incombat    = False   # Whether we're in the handlecombat method
-  remaining   = 0       # A future time remaining from a print message
   untilaction = ''      # The action that remaining is pointing towards
-  store       = 'store' # The location to #goto or #teleport to sell things
+  stats       = None    # None, or a fleetstats StatsSlot we publish to
+  iteration   = 0       # The iteration of doloop we are on
+  position    = None    # The location we were last seen in, None if unknown
 
   ''' init
       Assign the lambbot, the irc socket class, and start the thread
+
+      Parameters
+      irc         - IRCHandler, our connection
+      lambbot     - None, or the Lamb bot's nick, over the one in config
+      config      - None, or a BotConfig with our settings
   '''
-  def __init__(self, irc, lambbot='Lamb3_1'):
-    # Escort restricted commands
-    self.badcmds = [
-            '#unequip','#uq', # Unequip item
-            '#swap','#sw',    # Swapping items could interfere with shedinv()
-            '#l','#lvlup',    # Use karma to lvlup traits
-            '#reset',         # Delete the player
-            '#aslset',        # Change asl
-            '#rm',           '#running_mode',
-            '#gi','#gy',      # (give item/money)
-            '#give','#giveny',
-            '#dr',           '#drop',
-            '#mo',           '#mount',
-            '#sh',           '#shout',
-            '#w',            '#whisper',
-            '#cm',           '#clan_message',
-            '#pm',           '#party_message',
-            '#ban',          '#unban',
-                   ]
+  def __init__(self, irc, lambbot=None, config=None):
+    # Our settings, replaced whole by setconfig()
+    self.config = BotConfig() if config is None else config
+    if lambbot is not None:
+      self.config = self.config.replace(lambbot=lambbot)
+    # Combat commands wait here until we are no longer busy
+    self.combatq = CombatScheduler()
+    # Party members, fed from every line we receive
+    self.roster = PartyRoster()
+    # Per-enemy statistics, kept across runs
+    self.enemydb = EnemyDB()
+    # Cities and locations with learned travel times, kept across runs
+    self.worldmap = WorldMap()
+    # Known places, words and entrance messages, shared between bots
+    self.worldstore = WorldStore()
+    # Our items, updated as we find, loot, sell and bank them
+    self.inventory = Inventory()
+    # Whether the server takes a quantity with each disposal command
+    self.domulti = {}
+    # Items not to sell, refusals are shared with the other bots
+    self.dontsell = DontSellIndex(self.worldstore)
+    self.dontsell.importlegacy()
+    # What each item sells for and weighs
+    self.ledger = ItemLedger()
     # Set money and XP earned to zero
     self.lootmoney = 0
     self.lootxp = 0
@@ -128,17 +231,110 @@ class ShadowThread():
     self.togglecolors()
     # The IRCHandler
     self.irc = irc
+    # Our HP, MP, level, XP, karma and nuyen, from the messages we receive
+    self.charstate = CharState(self.irc.username, self.inventory)
+    # Only our own used items leave the inventory
+    self.inventory.nick = self.irc.username
+    # Responses to info commands, dropped when a message changes them
+    self.querycache = QueryCache()
+    # Commands from send(), resolved by the responses we receive
+    self.commands = CommandTracker()
+    # Changes from the menu thread, applied by ours between reads
+    self.controls = queue.Queue()
+    # Deadlines and periodic jobs, reads from irc wait at most until the next
+    self.timers = TimerHeap()
+    self.timers.every('saveworldmap', 600, self.worldmap.save)
+    # Counters and histograms, the gauges are only read when scraped
+    self.metrics = self.irc.metrics
+    self.metrics.queue('commands').setfunction(lambda: len(self.commands.pending))
+    self.metrics.queue('combat').setfunction(lambda: len(self.combatq.pending))
+    self.metrics.queue('controls').setfunction(self.controls.qsize)
+    self.timers.every('ping', 60, self.irc.ping)
+    # Where each iteration's time goes
+    self.tracer = Tracer(self.irc.username, self.config.tracefile)
+    # How long each command takes to be answered, kept across runs
+    self.latency = CommandLatency(metrics=self.metrics)
+    # The compiled loop script and precmds, compiled again only when changed
+    self.scriptfile = None
+    self.precmdplan = []
+    self.precmdsource = ()
     # We will handle incoming messages and whether to print them
     # ( by default prints are enabled in IRCHandler )
     # NOTE:
     #  this will eat _all_ incoming messages that _we_ do not print
     self.irc.toggle_prints()
-    # Set the lamb bot nick
-    self.setlambbot(lambbot)
+    # Set the lamb bot nick and the keep words from our config
+    self.setlambbot(self.config.lambbot)
+    self.dontsell.setkeep(self.config.keep)
+    # Keep our trackers up to date with every line we receive
+    self.irc.addlistener(self.observe)
+    self.irc.addsender(self.sent)
     # Fork a background thread to handle IRC
     self.th = threading.Thread(target=self.printloop, daemon=True)
     self.th.start()
 
+  ''' remaining
+      The time the action from the last "remaining" / "ETA" message finishes,
+       0 once it has passed
+  '''
+  @property
+  def remaining(self):
+    return self.timers.deadline('arrival') or 0
+
+  ''' receive
+      Returns a response from irc, waiting no longer than the next timer,
+       then fires every due timer
+
+      Parameters
+      timeout     - the most seconds to wait
+  '''
+  def receive(self, timeout=30):
+    response = self.irc.get_response(timeout=self.timers.timeout(timeout))
+    self.applycontrols()
+    self.timers.run()
+    return response
+
+  ''' control
+      Sets an attribute from another thread (the menu), e.g., 'doquit', 'doloop',
+       'invstop', taking effect as soon as our thread is waiting for input
+      A setting in BotConfig, or 'config' for a whole BotConfig, goes to setconfig
+      Returns True if it was applied within wait seconds
+
+      Parameters
+      name        - string, the attribute
+      value       - its new value
+      wait        - seconds to wait for our thread to apply it
+  '''
+  def control(self, name, value, wait=0.5):
+    applied = threading.Event()
+    self.controls.put((name, value, applied))
+    self.irc.wake()
+    # Our thread may be busy, a few ms is plenty when it's waiting for input
+    if not self.th.is_alive():
+      self.applycontrols()
+    return applied.wait(wait)
+
+  ''' applycontrols
+      Applies every change from control(), in the order they were made
+      A bad value is printed and dropped, it never raises in our thread
+  '''
+  def applycontrols(self):
+    while True:
+      try:
+        name, value, applied = self.controls.get_nowait()
+      except queue.Empty:
+        return
+      try:
+        if name == 'config':
+          self.setconfig(value)
+        elif name in BotConfig._fields:
+          self.setconfig(self.config.replace(**{name:value}))
+        else:
+          setattr(self, name, value)
+      except (ValueError, TypeError) as e:
+        self.print(f' ~ Not applying {name}: {e}')
+      applied.set()
+
   ''' del
       Set quit flags and join the thread
   '''
@@ -173,12 +369,15 @@ class ShadowThread():
     # Replace the player's nick with a bright green
     s = re.sub(r'(\d+-)?'+self.irc.username+r'(\{'+self.server+r'\})?(\[\S+\])?',
                 '\033[32;1m'+self.irc.username+bgcolor, s)
-    # Replace escort player's nick with a duller green
-    # TODO: we could have a larger party, track all party members' names
-    # ... highlight other non-NPC names
-    if self.escortnick != '' and self.escortnick in s:
-      s = re.sub(r'(\d+-)?'+self.escortnick+r'{\d+}(\[\S+\])?',
-                '\033[38;5;35m'+self.escortnick+bgcolor,s)
+    # Replace party members' and the escort's nicks with a duller green
+    # Each friendly name found is looked up in the roster
+    def friendly(match):
+      if match.group(2)+'{'+match.group(3)+'}' in self.roster \
+          or match.group(2) == self.escortnick:
+        return '\033[38;5;35m'+match.group(2)+bgcolor
+      return match.group(0)
+    if '{' in s:
+      s = friendlyname.sub(friendly, s)
     # If we're in combat mark other players red, otherwise a dimmer blue
     pcolor = '\033[38;5;1;1m' if self.incombat else '\033[38;5;98m'
     # Players may or may not have a leading position number
@@ -230,9 +429,116 @@ class ShadowThread():
     else:
       self.print = self.colorprint
 
+  ''' observe
+      Listener for every line received from IRC
+      Messages from the Lamb bot update the party roster, the inventory index,
+       our known places / words and our position in the worldstore
+
+      Parameters
+      msg         - string, the full message line
+  '''
+  def observe(self, msg):
+    line = self.getlambmsg(msg)
+    if line == '':
+      return
+    self.roster.observe(line)
+    carried, gained = self.inventory.carried, self.inventory.sinceweigh
+    stale = self.inventory.stale
+    self.inventory.observe(line)
+    # A #status after gaining items weighs the one we didn't know the weight of,
+    #  unless items may have left the inventory since the last weighing
+    if ' Weight :' in line and carried is not None and not stale \
+        and len(gained) > 0 and self.inventory.carried is not None:
+      self.ledger.learn(gained, self.inventory.carried - carried)
+    self.ledger.observe(line)
+    self.charstate.observe(line)
+    self.querycache.observe(line)
+    self.latency.observe(line)
+    resolved = self.commands.observe(line)
+    if resolved is not None:
+      self.latency.complete(resolved.text)
+    # "... 1m 12s remaining" and "... ETA: 3m 12s" set when we will arrive
+    eta = findeta(line)
+    if eta is not None:
+      self.timers.after('arrival', eta[0])
+      self.untilaction = 'Pause: ' + eta[1] + ', now ~'
+    # Our known places and words are shared with the other bots
+    match = knownplaces.match(line)
+    if match is not None:
+      city = match.group(1)
+      places = listentries(match.group(2))
+      self.worldstore.setknownplaces(self.irc.username, city, places)
+      for place in places:
+        self.worldmap.addplace(city + '_' + place)
+      return
+    match = knownwords.match(line)
+    if match is not None:
+      self.worldstore.setknownwords(self.irc.username,
+                                    listentries(match.group(1)))
+      return
+    # Keep our last known position, it survives restarts of the bot
+    location, inside = None, False
+    for position, inside in positionlines:
+      match = position.search(line)
+      if match is not None:
+        location = match.group(1).rstrip('.,')
+        break
+    if location is None and line.startswith('You enter'):
+      location, inside = self.worldstore.locationfor(line), True
+    if location is not None:
+      self.position = location
+      self.worldstore.setposition(self.irc.username, location, inside)
+
+  ''' sent
+      Called with every PRIVMSG sent, times the commands to the Lamb bot
+  '''
+  def sent(self, recipient, msg):
+    if recipient == self.lambbot:
+      self.latency.sent(msg)
+
+  ''' enemyreport
+      Prints the most profitable enemies per minute of combat
+  '''
+  def enemyreport(self, limit=10):
+    self.enemydb.printreport(limit=limit, printfn=self.print)
+
+  ''' itemreport
+      Prints what items sell for, per unit and per kg
+  '''
+  def itemreport(self, limit=20):
+    self.ledger.printreport(limit=limit, printfn=self.print)
+
+  ''' latencyreport
+      Prints how long the Lamb bot takes to answer each command verb
+  '''
+  def latencyreport(self, limit=20):
+    self.latency.printreport(limit=limit, printfn=self.print)
+
+  ''' setconfig
+      Replaces our settings with another BotConfig in one assignment,
+       only call it from our thread, other threads use control('config', ...)
+      What the new settings need is set up before the assignment,
+       raises a ValueError and keeps the old settings if that fails
+  '''
+  def setconfig(self, config):
+    old = self.config
+    # The tracefile is the only one that can fail, so it goes first
+    if config.tracefile != old.tracefile:
+      try:
+        self.tracer.setfile(config.tracefile)
+      except OSError as e:
+        raise ValueError(f'can\'t write spans to {config.tracefile}: {e}')
+    if config.lambbot != old.lambbot:
+      self.setlambbot(config.lambbot)
+    if config.keep != old.keep:
+      self.dontsell.setkeep(config.keep)
+    self.config = config
+
+  ''' setlambbot
+      Sets the re object matching messages from the Lamb bot's nick
+  '''
   def setlambbot(self, lambbot):
-    self.lambbot = lambbot
-    self.lambmsg = re.compile(':?'+self.lambbot+r'\S* \S+ '+self.irc.username+' :')
+    self.lambmsg = re.compile(':?'+re.escape(lambbot)+r'\S* \S+ '+self.irc.username+' :')
 
   ''' getlambmsg
       Returns the text content of the message from the Lamb bot
@@ -256,6 +562,7 @@ class ShadowThread():
       duration    - integer, time to 'sleep' for
       earlyexit   - return if we receive something early
   '''
+  @traced('sleepreceive')
   def sleepreceive(self, earlyexit=False, duration=30):
     lastprint = time.time() - 20
     while duration > 1:
@@ -266,50 +573,105 @@ class ShadowThread():
         self.print(' ~ sleepreceive, about %.1f seconds remaining' % duration)
         lastprint = time.time()
       starttime = time.time()
-      response = self.irc.get_response(timeout=duration)
+      response = self.receive(timeout=duration)
       line = self.getlambmsg(response)
       if line != '': self.print(line)
       if earlyexit: break
       duration -= time.time() - starttime
 
+  ''' meet
+      Fights the bums we still need to kill, otherwise says meetsay and #bye
+      This will occur when we are walking within cities
+
+      Parameters
+      line        - string, the 'You meet' message
+      wait        - whether to wait for their reply to meetsay,
+                     a state machine doesn't, the #bye follows at once
+  '''
+  def meet(self, line, wait=True):
+    # We need to kill more bums
+    # You meet 1-Bum[7852502](-7.5m)(L5(6))[H]
+    # You meet 1-Bum[7852511](-7.5m)(L5(6))[H], 2-Bum[7852512] ...
+    # NOTE: I have seen bums walking with other NPCs (Police Officers?)
+    delay = 2 if wait else 0
+    if self.bumsleft > 0 and 'Bum' in line:
+      # Ensure there are only bums and get a count of them
+      bumcount = 0
+      for part in line.split(', '):
+        if 'Bum' in part:
+          bumcount += 1
+        else: # if this isn't a bum, set counter to be too high to skip
+          bumcount = self.bumsleft + 1
+          break
+      # Don't kill more bums than needed (or other NPC types)
+      if bumcount <= self.bumsleft:
+        self.irc.privmsg(self.lambbot, '#fight', delay=delay)
+        self.bumsleft -= bumcount
+        return
+    # If we have a message set to say
+    elif self.meetsay is not None and self.meetsay != '':
+      # Say the message and get their reply
+      self.irc.privmsg(self.lambbot, '#say ' + self.meetsay, delay=delay)
+      if wait:
+        self.sleepreceive(duration=5)
+    # Say bye to them, this will close an interation with a citizen
+    self.irc.privmsg(self.lambbot, '#bye', delay=delay)
+
   ''' awaitresponse
       Returns the string with the line containing the quitmsg parameter
 
       Parameters
       quitmsg     - string, this is the string we are waiting to receive
+                    or a callable taking each stripped line (or '' on a timeout),
+                     returning True when we are done waiting
       eta         - integer, this is an optional parameter used to print
                      periodic approximate time remaining messages
   '''
+  @timed('awaiting')
+  @traced('awaitresponse')
   def awaitresponse(self, quitmsg, eta=-1):
     escortmsg = None
     if self.doloop == 'escort':
       escortmsg = re.compile(self.escortnick+r'{\d+} pm: ')
     self.print(' ~ Awaiting response: '+str(quitmsg))
+    # The commands sent before now are done when we see the quitmsg
+    started = time.time()
+    lastprint = 0
     # Repeat until we see the quitmsg parameter
     while True:
       # If there is an ETA, print an approximate time remaining
       if eta > 0:
-        self.print(' ~ ' + time.asctime())
         # ETA currently used only for subway travel
         # If the ETA becomes too negative then there may be some issue
         if time.time() > self.remaining and eta-time.time() < -60:
           self.print(' ~ We are a minute past the ETA ... ' + \
                   'returning from awaitresponse ... !!!')
           return ''
-        # print the ETA
-        if time.time() < self.remaining:
-          self.print(' ~ About',
-                      f'{round(self.remaining-time.time())}s remaining')
-        else:
-          self.print(' ~ About '+str(int(eta-time.time()))+'s remaining')
-      # Get text from irc, set the timeout to 2 minutes
-      response = self.irc.get_response()
+        # print the ETA, every 30 seconds whatever wakes us
+        if time.time() - lastprint >= 30:
+          lastprint = time.time()
+          self.print(' ~ ' + time.asctime())
+          if time.time() < self.remaining:
+            self.print(' ~ About',
+                        f'{round(self.remaining-time.time())}s remaining')
+          else:
+            self.print(' ~ About '+str(int(eta-time.time()))+'s remaining')
+      # Get text from irc, a waiter may have a deadline sooner than that
+      timeout = 30
+      if hasattr(quitmsg, 'remaining'):
+        timeout = quitmsg.remaining()
+      response = self.receive(timeout=timeout)
       # The user wants to quit, get back to the loop function
       if self.doquit:
         raise Exception('Player quit')
       # TODO: Should handle messages other than stop here (?)
       # We will print the line at the bottom of this long conditional
       line = self.getlambmsg(response)
+      # A callable is also checked on timeouts, for its deadlines
+      if callable(quitmsg) and quitmsg(line):
+        if line != '': self.print(line)
+        self.latency.complete(before=started)
+        return response
       # Not a lamb message, continue to skip printing a blank line
       if line == '':
         continue
@@ -321,27 +683,10 @@ class ShadowThread():
       #  continue
       # Our quit msg, return the line
       # We can handle exceptions in quit here
-      if quitmsg in line: # and 'somethingbad' in line:
-        self.print(line)
-        return response
-      # Using the message 'ready to go' for next after #sleep . . .
-      if quitmsg == 'ready to go' and line == 'You don\'t need to rest':
+      if not callable(quitmsg) and quitmsg in line:
         self.print(line)
+        self.latency.complete(before=started)
         return response
-      if re.search(r'(\d+m )?(\d+s )?remaining$', line) or \
-          re.search(r'ETA: (\d+m )?(\d+s)?$', line):
-        self.remaining = re.search(r'(\d+m )?(\d+s )?remaining$', line)
-        if self.remaining:
-          mins, secs = self.remaining.groups()
-          self.untilaction = re.sub(r' (\d+m )?(\d+s )?remaining$','',line)
-        else:
-          self.remaining = re.search(r'ETA: (\d+m )?(\d+s)?$', line)
-          mins, secs = self.remaining.groups()
-          self.untilaction = re.sub(r' ETA: (\d+m )?(\d+s)?$','',line)
-        self.untilaction = 'Pause: ' + self.untilaction +', now ~'
-        self.remaining = time.time()
-        if mins: self.remaining += int(mins.rstrip('m '))*60
-        if secs: self.remaining += int(secs.rstrip('s '))
       if line.startswith('Use #talk'): continue
       if line.startswith('I don\'t want'): continue
       # someone said something
@@ -351,37 +696,15 @@ class ShadowThread():
       # We meet a citizen or another player
       # This will occur when we are walking within cities
       elif 'You meet ' in line:
-        # We need to kill more bums
-        # You meet 1-Bum[7852502](-7.5m)(L5(6))[H]
-        # You meet 1-Bum[7852511](-7.5m)(L5(6))[H], 2-Bum[7852512] ...
-        # NOTE: I have seen bums walking with other NPCs (Police Officers?)
         self.print(line)
-        if self.bumsleft > 0 and 'Bum' in line:
-          # Ensure there are only bums and get a count of them
-          bumcount = 0
-          for part in line.split(', '):
-            if 'Bum' in part:
-              bumcount += 1
-            else: # if this isn't a bum, set counter to be too high to skip
-              bumcount = self.bumsleft + 1
-              break
-          # Don't kill more bums than needed (or other NPC types)
-          if bumcount <= self.bumsleft:
-            self.irc.privmsg(self.lambbot, '#fight')
-            self.bumsleft -= bumcount
-            continue
-        # If we have a message set to say
-        elif self.meetsay is not None and self.meetsay != '':
-          # Say the message and get their reply
-          self.irc.privmsg(self.lambbot, '#say ' + self.meetsay)
-          self.sleepreceive(duration=5)
-        # Say bye to them, this will close an interation with a citizen
-        self.irc.privmsg(self.lambbot, '#bye')
+        self.meet(line)
         continue
       # Starting combat
       elif 'You ENCOUNTER ' in line:
         line = self.handlecombat(line)
-        if quitmsg in line: return line
+        if quitmsg in line:
+          self.latency.complete(before=started)
+          return line
         continue
       # You gained some MP
       elif line.startswith('You gained +'): pass
@@ -420,8 +743,7 @@ class ShadowThread():
 
   ''' handlecombat
       Combat handler, returns when combat is complete
-      * This currently requires the calm spell for healing *
-      Any special combat actions go here
+      The Fight decides what to do with each line, we wait for it here
 
       Parameters
       line        - string, the current message buffer
@@ -431,89 +753,22 @@ class ShadowThread():
       msg         - string, the current message buffer
                     Will be the line 'You continue'
   '''
+  @traced('handlecombat')
   def handlecombat(self, line=''):
-    # If we had a message that we had time remaining
-    if time.time() < self.remaining:
-      self.print(self.untilaction,
-                  f'{int((self.remaining-time.time())/60)}m',
-                  f'{int((self.remaining-time.time())%60)}s remaining')
-      self.freezetime = time.time()
-    else:
-      self.freezetime = None
-    self.incombat = True
-    if line.startswith('You ENCOUNTER'):
-      while line.endswith(','):
-        nextline = self.getlambmsg(self.irc.get_response())
-        if nextline == '': continue
-        line += ' ' + nextline
     self.print(line)
+    fight = Fight(self, line)
     # If we are escorting a player make an re object to respond to 'quit'
     escortmsg = None
-    # dotarget returns True if we should prefer the level of x over y
-    # (we always prefer attacking drones over other NPCs)
-    dotarget = lambda x,y: True if self.attacklow and x < y \
-                          else False if self.attacklow \
-                          else True if x > y else False
     if self.doloop == 'escort':
       escortmsg = re.compile(self.escortnick+r'{\d+} pm: ')
-    class ShadowEnemy():
-      def __init__(self,num,name,pos,lvl):
-        self.num = num
-        self.name = name
-        self.pos = pos
-        self.lvl = lvl
-      def __str__(self):
-        return f' ~ Enemy {self.num}) {self.name} L{self.lvl} at {self.pos}m'
-
-    #                     1-Killer[8023221](-8.0m)(L17(34))[H]
-    parts=re.findall(r'(\d+)-([^\[ ]+[ ]?[^\[ ]*)\[\d+\]\(([-]?[\d\.]+)m\)\(L(\d+)', line)
-    enemies = {}
-    havetarget = None
-    for part in parts:
-      num = int(part[0])
-      name = part[1]
-      pos = float(part[2])
-      lvl = int(part[3])
-      enemies[num] = ShadowEnemy(num,name,pos,lvl)
-      if 'Drone' in name:
-        if havetarget is None or abs(pos-1) < abs(enemies[havetarget].pos-1):
-          # Save the current target as the index of enemies[]
-          havetarget = num
-
-    if havetarget is None and len(enemies) > 1:
-      targetlvl = 0
-      for enemy in enemies:
-        if havetarget is None:
-          targetlvl = enemies[enemy].lvl
-          havetarget = enemy
-        elif dotarget(enemies[enemy].lvl, targetlvl):
-          targetlvl = enemies[enemy].lvl
-          havetarget = enemy
-        elif enemies[enemy].lvl == targetlvl \
-              and abs(enemies[enemy].pos-1) < abs(enemies[havetarget].pos-1):
-          havetarget = enemy
-
-    for enemy in enemies:
-      self.print(enemies[enemy])
-
-    # havetarget should be set
-    if havetarget is not None and len(enemies) > 1:
-      self.irc.privmsg(self.lambbot, '#attack ' + str(havetarget))
-
-    calmcasttime = 0
-    calmcastgap = 90
-
-    # Only need to match one of these (beginning of line match)
-    #                             7-DarkElve[8023234]
-    #enemyattack = re.compile(r'\d+-[\S]+\[[\d]+\]')
-    #                              1-chaseleif{57}
-    friendlyattack = re.compile(r'\d+-[\S]+{')
-
-    mypos = 1
-    myaction = re.compile(r'\d+-'+self.irc.username+r'\{'+self.server+r'\}')
-    hostileaction = re.compile(r'\d+-[\S]+\[\d+\]')
-    while True:
-      msg = self.irc.get_response(timeout=45)
+    msg = line
+    while not fight.done:
+      # Send a queued command once we are no longer busy
+      fight.poll()
+      # Wake up when we become free if there is something queued
+      deadline = fight.deadline()
+      wait = 45 if deadline is None else min(45, max(0, deadline - time.time()))
+      msg = self.receive(timeout=wait)
       line = self.getlambmsg(msg)
       if line == '': continue
       if escortmsg is not None and escortmsg.match(msg) is not None:
@@ -522,194 +777,67 @@ class ShadowThread():
           self.irc.privmsg(self.lambbot, '#pm Can\'t stop while in combat')
         continue
       self.print(line)
-      if 'You continue' in line:
-        if re.search(r'(\d+m )?(\d+s )?remaining$', line):
-          mins = re.search(r'(\d+m )?(\d+s )?remaining$', line)
-          if mins:
-            mins, secs = mins.groups()
-            self.untilaction = re.sub(r' (\d+m )?(\d+s )?remaining$','',line)
-          self.untilaction = 'Pause: ' + self.untilaction +', now ~'
-          self.remaining = time.time()
-          if mins: self.remaining += int(mins.rstrip('m '))*60
-          if secs: self.remaining += int(secs.rstrip('s '))
-        break
-      # The line starts with our player
-      if myaction.match(line):
-        action = line[myaction.match(line).span()[1]+1:]
-        # We are moving
-        if action.startswith('moves'):
-          # Our current position
-          mypos = float(action.split('position')[1].split()[0])
-          continue
-        # A calm was cast which did nothing, do a heal
-        if line.startswith('casts') and '+0HP for' in line:
-          target = line.split('.')[1].split(' ')[-1]
-          self.irc.privmsg(self.lambbot, '#cast heal ' + target)
-          continue
-      # The line starts with an enemy
-      elif hostileaction.match(line):
-        action = line[hostileaction.match(line).span()[1]+1:]
-        if action.startswith('moves'):
-          try:
-            enemy = int(hostileaction.search(line)[0].split('-')[0])
-            enemies[enemy].pos = float(action.split('position')[1].split()[0])
-          except:
-            pass
-          continue
-      # An attack was made but it missed
-      if 'misses' in line: pass
-      # Combat
-      elif 'attacks' in line:
-        # Friendly attack
-        if friendlyattack.match(line):
-          # We killed an enemy
-          if 'killed them' in line:
-            if 'You loot' in line:
-              num = line.split('loot')[1].lstrip()
-              self.lootmoney += float(num.split('$')[0])
-              self.lootxp += float(num.split()[-1][:-2])
-            num = int(line.split('attacks ')[1].split('-')[0].strip())
-            # If we didn't fill out the enemies dict
-            if num not in enemies:
-              continue
-            del(enemies[num])
-            for enemy in enemies:
-              self.print(enemies[enemy])
-            # it wasn't us that killed the enemy . . .
-            if self.irc.username+'{'+self.server+'}' not in line:
-              if havetarget is None or havetarget != num:
-                continue
-            # No need to explicitly set an enemy if there aren't multiple
-            if len(enemies) < 2:
-              continue
-            havetarget = None
-            for enemy in enemies:
-              if 'Drone' not in enemies[enemy].name: continue
-              if havetarget is None:
-                havetarget = enemy
-                targetdist = abs(mypos-enemies[enemy].pos)
-              elif abs(mypos-enemies[enemy].pos) < targetdist:
-                havetarget = enemy
-                targetdist = abs(mypos-enemies[enemy].pos)
-            if havetarget is None:
-              for enemy in enemies:
-                if havetarget is None:
-                  targetlvl = enemies[enemy].lvl
-                  havetarget = enemy
-                  targetdist = abs(mypos-enemies[enemy].pos)
-                elif dotarget(enemies[enemy].lvl, targetlvl):
-                  targetlvl = enemies[enemy].lvl
-                  havetarget = enemy
-                  targetdist = abs(mypos-enemies[enemy].pos)
-                elif enemies[enemy].lvl == targetlvl \
-                        and abs(mypos-enemies[enemy].pos) < targetdist:
-                  havetarget = enemy
-                  targetdist = abs(mypos-enemies[enemy].pos)
-            if havetarget is not None:
-              self.irc.privmsg(self.lambbot, '#attack ' + str(havetarget))
-        # An enemy attacked
-        else: #if enemyattack.match(line) is not None:
-          # uh oh
-          if 'killed' in line:
-            raise Exception('Player died')
-          # Add some logic for using potions / first aid (?)
-          if not self.cancast:
-            continue
-          player = line.split('-')[1].split(' ')[-1]
-          # "68.7/72.6"
-          health = line.split(', ')[1].split('HP')[0]
-          numerator = health.split('/')[0]
-          denominator = health.split('/')[1]
-          doheal = False
-          docalm = False
-          health = float(numerator)/float(denominator)
-          # Less than 30% health
-          if health < 0.3:
-            doheal = True
-          # Less than 50% health
-          elif health < 0.5:
-            docalm = True
-          # Less than 80% health
-          elif health < 0.8 and (time.time() - calmcasttime) > calmcastgap:
-            docalm = True
-          if doheal:
-            self.irc.privmsg(self.lambbot, '#cast heal ' + player)
-          elif docalm:
-            self.irc.privmsg(self.lambbot, '#cast calm ' + player)
-            calmcasttime = time.time()
-    self.incombat = False
+      fight.feed(line)
     return msg
 
-  ''' cityrank
-      Returns an ordering, this is used to determine direction of subway travel
-
-      Parameters
-      city        - A string with a city name: Chicago, Delaware, Seattle, Redmond
-  '''
-  def cityrank(self,city):
-    if city=='Chicago': return 4
-    if city=='Delaware': return 3
-    if city=='Seattle': return 2
-    return 1
-
   ''' walkpath
       Returns upon arrival of last entry in the list
+      The time taken to walk to each point is learned by the worldmap
 
       Parameters
       path        - list, a list of strings, each a destination to "goto"
   '''
+  @traced('walkpath')
   def walkpath(self,path):
     self.print(' ~ Entering walkpath, path = '+str(path))
     # For each waypoint in the list of waypoints
     for point in path:
       self.print(' ~ Point = ' + point)
+      starttime = time.time()
       # goto the waypoint
       self.irc.privmsg(self.lambbot, '#goto ' + point)
       # await the entrance message for this waypoint
-      self.awaitresponse(entermsg[point])
+      quitmsg = self.worldstore.entermsg(point, None)
+      if quitmsg is None:
+        # Learn the entrance message of a new location for next time
+        line = self.getlambmsg(self.awaitresponse('You enter'))
+        if line != '':
+          self.worldstore.learnentermsg(point, line.split('. ')[0])
+      else:
+        self.awaitresponse(quitmsg)
+      self.worldmap.learn('goto', None, self.worldmap.addplace(point),
+                          time.time()-starttime)
       # The user wants to quit, get back to the loop function
       if self.doquit:
         raise Exception('Player quit')
 
-  ''' gotoloc
-      Handles getting to some starting point for a message loop.
-
-      Parameters
-      location    - string, the destination location, form of 'Redmond_Hotel'
-                    * the destination location should not be within a dungeon
-                    * the origin must be in the world (not in a dungeon)
-
-      Returns
-                    When travel is complete, player is at the destination
+  ''' whereami
+      Returns the location we are inside, from the "#party" response
+      If we are outside of a location we enter it
+      Exploring or going somewhere is stopped, a subway ride is waited out
   '''
-  def gotoloc(self,location):
-    # No current location
-    currloc = ''
+  def whereami(self):
     # Limit repeated "#party" messages
     onsubway = False
-    while currloc == '':
+    while True:
       # Find out where we are at
       self.irc.privmsg(self.lambbot, '#party')
       # You are {inside,outside,fighting,exploring,going}
-      # leave whatever location we are in, or enter if it is right
       while True:
-        resp = self.irc.get_response()
+        resp = self.receive()
         line = self.getlambmsg(resp)
         # We are inside or outside of a location
         if line.startswith('You are inside') or line.startswith('You are outside'):
           if 'outside' in line:
             self.irc.privmsg(self.lambbot, '#enter')
             self.sleepreceive(duration=5)
-          # If this location is the destination then return
-          if location in line:
-            return
           # The location is the last word in the line
-          currloc = line.split(' ')[-1]
-          break
-        # We are in combat
+          return line.split(' ')[-1]
+        # We are in combat, ask again when it is over
         elif line.startswith('You are fighting'):
           onsubway = False
-          resp = handlecombat(line)
+          self.handlecombat(line)
+          break
         # We are exploring, or going to a location, try to stop
         elif line.startswith('You are'):
           # TODO: onsubway is erroneously set, leader of party of 2 in hotel
@@ -717,17 +845,7 @@ class ShadowThread():
           if onsubway:
             # This should be a subway journey, which we cannot stop
             # Find out the remaining time for this travel
-            line = line.split('.')[1][1:]
-            mins = 0
-            secs = 0
-            if line.split('m')[0].isdigit():
-              mins = int(line.split('m')[0])
-            if 's' in line:
-              line = line.split('s')[0]
-              if ' ' in line:
-                line = line.split(' ')[1]
-              secs = int(line)
-            timeremaining = mins*60 + secs + 10
+            timeremaining = seconds(line.split('.')[1]) + 10
             self.print(' ~ It was detected that we are likely in a subway')
             self.print(' ~ (sleeping for ~ ' + str(timeremaining) + 's)')
             self.sleepreceive(duration=timeremaining)
@@ -738,44 +856,62 @@ class ShadowThread():
             # set the onsubway flag in case we don't stop
             onsubway = True
           break
-    # The city precedes the '_' in the locations
-    dstcity = location.split('_')[0]
-    srccity = currloc.split('_')[0]
-    # We are in the same city as the destination, we can walk directly there now
-    if dstcity == srccity:
-      # Walkpath will finish when we have arrived at the destination
-      return self.walkpath([location])
-    # We are in a different city, let's get to and take the subway
-    if 'Subway' not in currloc:
-      # We aren't at the subway, walk to the subway
-      self.walkpath(['Subway'])
-    # We are now at the subway in a different city
-    # For subway direction: Chicago <-> Delaware <-> Seattle <-> Redmond
-    if srccity == 'Redmond' or self.cityrank(srccity) > self.cityrank(dstcity):
-      self.irc.privmsg(self.lambbot, '#travel 1')
-    else:
-      self.irc.privmsg(self.lambbot, '#travel 2')
-    # The optional 'eta' parameter to the await response function
-    #  will occasionally print an approximate time remaining
-    etamsg = self.getlambmsg(self.awaitresponse('ETA: '))
-    eta = 0
-    # We can calculate our travel time
-    etamsg = etamsg[etamsg.find('ETA: ')+5:]
-    # We will always have minutes
-    parts = etamsg.split('m')
-    mins = int(parts[0])
-    secs = 0
-    # We also have seconds
-    if len(parts) > 1 and 's' in parts[1]:
-      parts = parts[1].split('s')
-      if parts[0][0] == ' ':
-        secs = int(parts[0][1:])
-    # Set the ETA as future from the current time
-    eta = int(time.time() + mins * 60 + secs)
-    # Await the response that we have arrived in the next city
-    self.awaitresponse('You arrive',eta=eta)
-    # Recursive call to continue travelling to the destination
-    self.gotoloc(location)
+
+  ''' gotoloc
+      Handles getting to some starting point for a message loop.
+      The cheapest route is planned over the worldmap, walking, riding the
+       subway, or casting teleport / teleportii when we can cast
+      After each subway ride we check where we are and plan again
+
+      Parameters
+      location    - string, the destination location, form of 'Redmond_Hotel'
+                    * the destination location should not be within a dungeon
+                    * the origin must be in the world (not in a dungeon)
+
+      Returns
+                    When travel is complete, player is at the destination
+  '''
+  @traced('gotoloc')
+  def gotoloc(self,location):
+    location = self.worldmap.addplace(location)
+    while True:
+      currloc = self.whereami()
+      # If this location is the destination then return
+      if currloc.lower() == location.lower():
+        return
+      route = self.worldmap.plan(currloc, location, cancast=self.cancast)
+      if route is None:
+        raise Exception(f'No known route from {currloc} to {location}')
+      self.print(' ~ Route:', ', '.join(f'{step[0]} {step[1]}' for step in route))
+      for kind, arg, src, dst in route:
+        starttime = time.time()
+        # Walkpath will finish when we have arrived, it learns the walk time
+        if kind == 'goto':
+          self.walkpath([arg])
+          continue
+        if kind == 'travel':
+          self.irc.privmsg(self.lambbot, arg)
+          # The optional 'eta' parameter to the await response function
+          #  will occasionally print an approximate time remaining
+          self.awaitresponse('ETA: ')
+          # observe has set the arrival timer from the ETA
+          eta = int(self.remaining or time.time())
+          # Await the response that we have arrived in the next city
+          self.awaitresponse('You arrive',eta=eta)
+          self.worldmap.learn(kind, src, dst, time.time()-starttime)
+          # Plan again from wherever the subway left us
+          break
+        # teleport takes the place in this city, teleportii the full name
+        place = arg if kind == 'teleportii' else arg.split('_',1)[-1]
+        self.irc.privmsg(self.lambbot, f'#cast {kind} {place}')
+        self.awaitresponse('now outside of')
+        self.irc.privmsg(self.lambbot, '#enter')
+        self.awaitresponse('You enter')
+        self.worldmap.learn(kind, src, dst, time.time()-starttime)
+      else:
+        self.worldmap.save()
+        return
+      self.worldmap.save()
 
   ''' printloop
 
@@ -792,7 +928,7 @@ class ShadowThread():
     # Not setup to do a function yet
     while func == 'None':
       if self.doquit or self.softquit: return
-      line = self.irc.get_response(timeout=10)
+      line = self.receive(timeout=10)
       if self.getlambmsg(line):
         line = self.getlambmsg(line)
         self.print(line)
@@ -817,7 +953,7 @@ class ShadowThread():
       if func == 'None':
         # There was no function
         # Either handle combat here or ping msgs in the irc handler
-        line = self.getlambmsg(self.irc.get_response())
+        line = self.getlambmsg(self.receive())
         if 'You ENCOUNTER' in line:
           self.handlecombat(self.getlambmsg(line))
         elif 'attacks' in line:
@@ -832,32 +968,18 @@ class ShadowThread():
       while not self.doquit and func == str(self.doloop):
         # Call the selected function and pass the iteration counter
         starttime = time.time()
+        self.iteration = fncounter
+        self.tracer.newiteration()
         self.print(' ~  ~~~~~~~~~~')
         self.print(' ~ { ' + time.asctime())
         self.print(' ~ { Beginning iteration', fncounter+1, 'of', func)
         self.print(' ~  ~~~~~~~~~~')
         try:
-          for cmd in self.precmds:
+          for cmd, step in self.precmdsteps():
             try:
-              # Lambbot commands start with an '#'
-              if cmd.startswith('#'):
-                self.irc.privmsg(self.lambbot, cmd)
-                self.sleepreceive(duration=5)
-              # We can issue a sleep as "sleep(30)", etc.
-              elif cmd.startswith('sleep('):
-                duration = cmd.split('(')[1].split(')')[0]
-                self.sleepreceive(duration=int(duration))
-              # This is intended to be used when we are being escorted
-              #  though could serve any purpose
-              # "msg nick some message"
-              elif cmd.startswith('msg'):
-                recipient = cmd.split(' ')[1].split(' ')[0]
-                message = ' '.join(cmd.split(' ')[2:])
-                self.irc.privmsg(recipient, message)
-                self.sleepreceive(duration=5)
-              else:
-                self.print('Unknown pre-command: \"' + cmd + '\"')
+              self.runsteps([step], fncounter)
             except Exception as e:
+              self.metrics.exceptions.inc()
               self.print('Error with pre-command: \"' + cmd + '\"')
               etype, value, tb = exc_info()
               info, error = format_exception(etype, value, tb)[-2:]
@@ -881,13 +1003,25 @@ class ShadowThread():
           self.print(msg, end='')
           with open('exceptions','a') as outfile:
             outfile.write(msg)
+          self.metrics.exceptions.inc()
+          if self.stats is not None:
+            self.stats.error()
         # Increase the iteration counter
         fncounter+=1
+        self.metrics.iteration(func, time.time()-starttime)
+        if self.stats is not None:
+          self.stats.iteration(time.time()-starttime, func)
         elapsed = int(time.time()-starttime)
         self.print(' ~  ~~~~~~~~~~')
         self.print(' ~ { ' + time.asctime())
         self.print(' ~ { Finished iteration ' + str(fncounter) + ' of ' + func)
         self.print(' ~ {   in %d:%02d' %  (elapsed//60,elapsed%60))
+        # Where the time went, each phase without the phases inside it
+        total = max(time.time()-starttime, 1)
+        for name, secs in self.tracer.enditeration(func, fncounter):
+          if secs >= 1:
+            self.print(' ~ {     %-13s %d:%02d %3d%%' % \
+                        (name, secs//60, secs%60, 100*secs/total))
         elapsed = int(time.time()-firststart)
         secs = elapsed%60
         elapsed //= 60
@@ -906,29 +1040,51 @@ class ShadowThread():
         self.sleepreceive(duration=5)
     self.irc.privmsg(self.lambbot, '#disable bot')
 
+  ''' syncinventory
+      Refetches every page of "#inventory" to correct the inventory index
+      Only needed when the index has drifted or hasn't been fetched in a while
+  '''
+  def syncinventory(self):
+    self.inventory.beginsync()
+    self.irc.privmsg(self.lambbot, '#inventory')
+    while True:
+      line = self.receive()
+      line = self.getlambmsg(line)
+      if 'Your Inventory' in line: break
+      if 'There are no items here' in line:
+        self.inventory.setempty()
+        return
+      if line != '':
+        self.print(line)
+    # The first page has been indexed, get the rest
+    numpages = int(line.split(':')[0].split('/')[1])
+    for page in range(2, numpages+1):
+      self.irc.privmsg(self.lambbot, '#inventory ' + str(page))
+      while True:
+        line = self.receive()
+        line = self.getlambmsg(line)
+        if 'Your Inventory' in line: break
+        if line != '':
+          self.print(line)
+
   ''' invflush
       If self.invstop is positive, this function {sells,pushes,drops} all items including that number
       This function should be called outside of travel, etc.
       An ideal place for this function would be before a loop function exits
+      Items come from the inventory index, pages are only refetched if it has drifted
 
       Parameters
       inescort    - boolean, whether we are a 'passenger' and our escort teleported us here
       cmd         - string, the command to use, e.g., "#drop", "#sell", "#push", "#give nick"
+      items       - None, or a list of (name, qty) to use instead of everything past invstop
   '''
-  def invflush(self, inescort=True, cmd='#drop'):
+  @traced('invflush')
+  def invflush(self, inescort=True, cmd='#drop', items=None):
     for _ in range(randint(1,2)):
-      line = self.irc.get_response(timeout=7)
+      line = self.receive(timeout=7)
       line = self.getlambmsg(line)
       if line != '':
         self.print(line)
-    dontsellitems = [ 'Loki', 'Quartz', 'Orchid', 'Beer', 'Wine', 'Booze',
-                      'IDCard', 'Stimpatch', 'Milk', 'Ammo', 'Circuits',
-                      'Coke', 'Potion', 'Pizza', 'Apple', 'Smith', 'Elixir',
-                      'Bone', 'Ether', 'Moon', 'AimWater', 'Rune', 'Diamond',
-                      'FirstAid', 'Hematite', 'Alcopop', 'Mandrake',
-                      'ScrollOfWisdom', 'CopCap', 'EmptyBottle']
-    dontsellitems += ['Tenugui']
-    #dontsellitems += [ 'Demon', 'Sirene' ]
     if self.escortnick != '':
       escortmatch = re.compile(self.escortnick+r'{\d+} pm: ')
       flushstart = time.time()
@@ -941,112 +1097,36 @@ class ShadowThread():
         self.irc.privmsg(self.lambbot, f'#pm ready')
       elif escortmatch:
         while time.time() - flushstart < 60:
-          line = self.irc.get_response()
+          line = self.receive()
           line = self.getlambmsg(line)
           if line == '': continue
           self.print(line)
           if escortmatch.match(line) and 'ready' in line.split('pm: ')[1]:
             break
       return
-    self.irc.privmsg(self.lambbot, '#inventory')
-    numpages = ''
-    readyquit = self.escortnick == ''
-    while True:
-      line = self.irc.get_response()
-      line = self.getlambmsg(line)
-      if 'Your Inventory' in line: break
-      if 'There are no items here' in line:
-        if inescort:
-          self.irc.privmsg(self.lambbot, f'#pm ready')
-        elif escortmatch:
-          while time.time() - flushstart < 60:
-            line = getline(self.irc.get_response())
-            line = self.getlambmsg(line)
-            if line == '': continue
-            self.print(line)
-            if escortmatch.match(line) and 'ready' in line.split('pm: ')[1]:
-              break
-        return
-      self.print(line)
-      if escortmatch:
-        if escortmatch.match(line) and 'ready' in line.split('pm: ')[1]:
-          readyquit = True
-    numpages = int(line.split(':')[0].split('/')[1])
-    haveqty = re.compile(r'\([\d]+\)')
-    domulti = True
-    while numpages > 0:
-      self.irc.privmsg(self.lambbot, '#inventory ' + str(numpages))
-      numpages -= 1
-      numitems = 0
-      while True:
-        line = self.irc.get_response()
-        line = self.getlambmsg(line)
-        if line == '': continue
-        if 'Your Inventory' in line: break
-        self.print(line)
-        if escortmatch and escortmatch.match(line):
-          if 'ready' in line.split('pm: ')[1]: readyquit = True
-      items = line.split(', ')
-      numitems = items[-1].split('-')[0].strip()
-      # If there is only one item on this inventory page it will be different
-      if numitems.startswith('page'):
-        numitems = numitems.split(': ')[1]
-      numitems = int(numitems)
-      pos = len(items)-1
-      while numitems >= self.invstop and pos > 0:
-        if cmd == '#sell':
-          if any([item in items[pos] for item in dontsellitems]):
-            numitems -= 1
-            pos -= 1
-            continue
-        if haveqty.search(items[pos]):
-          qty = items[pos][haveqty.search(items[pos]).span()[0]:]
-          qty = int(re.sub('[()]','',qty))
-          if cmd!='#push' and (not domulti or qty%5 != 0):
-            if qty%10 != 0:
-              while qty > 0:
-                qty -= 1
-                self.irc.privmsg(self.lambbot, f'{cmd} {numitems}')
-                for _ in range(randint(1,2)):
-                  line = self.getlambmsg(self.irc.get_response())
-                  if line != '':
-                    self.print(line)
-                    if 'Usage' in line: break
-                    if line.startswith('I don\'t want'):
-                      with open('dontsell','a') as outfile:
-                        outfile.write(line+'\n')
-                        outfile.write(f'{items=}\n')
-                        outfile.write(f'{items[pos]=} {qty=}')
-                      break
-            numitems -= 1
-            pos -= 1
-            continue
-          self.irc.privmsg(self.lambbot, f'{cmd} {numitems} {qty}')
-        else:
-          self.irc.privmsg(self.lambbot, cmd + ' ' + str(numitems))
-        for _ in range(randint(1,3)):
-          line = self.irc.get_response(timeout=7)
-          line = self.getlambmsg(line)
-          if line == '':
-            continue
-          self.print(line)
-          if escortmatch and escortmatch.match(line):
-            if 'ready' in line.split('pm: ')[1]:
-              readyquit = True
-          elif 'Usage: #(se)ll <inv_id|item_name>.' in line:
-            domulti = False
-          elif line.startswith('I don\'t want'):
-            with open('dontsell','a') as outfile:
-              outfile.write(line+'\n')
-              outfile.write(f'{items=}\n')
-              outfile.write(f'{items[pos]=}\n')
-        numitems -= 1
-        pos -= 1
+    if self.inventory.needsync():
+      self.syncinventory()
+    # Pick up items other bots have had refused
+    self.dontsell.refresh()
+    # The caller already decided what to get rid of
+    if items is not None:
+      todo = deque(items)
+    # Otherwise work from the back, everything at or past invstop
+    else:
+      todo = deque()
+      for numitems, item, qty in reversed(self.inventory.entries()):
+        if numitems < self.invstop:
+          break
+        # Known unsellable or kept items are skipped before any command is sent
+        if cmd == '#sell' and self.dontsell.skip(item):
+          continue
+        todo.append((item, qty))
+    self.disposeitems(cmd, todo, escortmatch)
     if inescort:
       self.irc.privmsg(self.lambbot, f'#pm ready')
     elif escortmatch:
       while time.time() - flushstart < 60:
-        line = self.irc.get_response()
+        line = self.receive()
         line = self.getlambmsg(line)
         if line == '':
           continue
@@ -1054,75 +1134,342 @@ class ShadowThread():
         if escortmatch.match(line) and 'ready' in line.split('pm: ')[1]:
           break
     for _ in range(randint(1,2)):
-      line = self.irc.get_response(timeout=7)
+      line = self.receive(timeout=7)
       line = self.getlambmsg(line)
       if line != '':
         self.print(line)
     return
 
-  ''' shedinv     - goes to the secondhand and then the bank to shed inventory
+  ''' disposeitems
+      Sends disposal commands for items by name, keeping up to pipedepth
+       commands outstanding, the Disposal decides what to send, we wait for it
+      Prints the number of items disposed of per minute
+
       Parameters
-      fncounter   - unused, here only to match other "loop" functions
+      cmd         - string, the command to use, e.g., "#sell", "#push"
+      todo        - deque of (item name, quantity) to dispose of
+      escortmatch - None, or an re object matching our escort's pm
   '''
-  def shedinv(self, fncounter=0):
-    inescort = False
-    if self.cancast:
-      self.irc.privmsg(self.lambbot, f'#cast teleport {self.store}')
-      self.awaitresponse('now outside of')
-      self.irc.privmsg(self.lambbot, '#enter')
-      self.awaitresponse('You enter the')
-    else:
-      self.irc.privmsg(self.lambbot, f'#goto {self.store}')
-      self.awaitresponse('You enter the')
-    '''
-    # TODO: fix escort pairing
-    elif self.escortcasts and self.escortnick != '':
-      self.irc.privmsg(self.lambbot, '#part')
-      self.awaitresponse('left the party')
-      self.irc.privmsg(self.lambbot, '#join ' + self.escortnick)
-      self.awaitresponse('joined the party')
-      self.irc.privmsg(self.lambbot, f'#pm docmd #cast teleport {self.store}')
-      self.awaitresponse('now outside of')
-      self.irc.privmsg(self.lambbot, '#pm docmd #enter')
-      self.awaitresponse('You enter the')
-      self.irc.privmsg(self.lambbot, '#pm invflush #sell')
-    '''
-    self.invflush(inescort=inescort, cmd='#sell')
-    for _ in range(randint(1,2)):
-      line = self.irc.get_response(timeout=7)
-      line = self.getlambmsg(line)
+  def disposeitems(self, cmd, todo, escortmatch=None):
+    disposal = Disposal(self, cmd, todo, escortmatch)
+    while True:
+      disposal.poll()
+      if disposal.done:
+        return
+      deadline = disposal.deadline()
+      wait = 30 if deadline is None else max(0, deadline - time.time())
+      line = self.getlambmsg(self.receive(timeout=wait))
       if line != '':
         self.print(line)
-    if self.cancast:
-      self.irc.privmsg(self.lambbot, '#cast teleport bank')
-      self.awaitresponse('now outside of')
-      self.irc.privmsg(self.lambbot, '#enter')
-      self.awaitresponse('In a bank')
+        disposal.feed(line)
+
+  ''' query
+      Returns the response to an info command,
+       from the querycache unless it has expired or been invalidated
+
+      Parameters
+      command     - string, the command, e.g., '#kp Redmond'
+      expect      - string, part of the response to await
+  '''
+  def query(self, command, expect):
+    response = self.querycache.get(command)
+    if response is not None:
+      self.print(' ~ Cached ' + command + ': ' + response)
+      return response
+    response = self.wait(self.send(command, expect))[0].line
+    self.querycache.put(command, response)
+    return response
+
+  ''' prefetch
+      Sends every query that isn't cached at once and caches the responses
+      Queries that fail are left for query() to try again
+
+      Parameters
+      queries     - list of (command, expect)
+  '''
+  def prefetch(self, queries):
+    pending = [self.send(command, expect) for command, expect in queries
+                                          if not self.querycache.fresh(command)]
+    if len(pending) == 0:
+      return
+    try:
+      self.wait(*pending)
+    except CommandError as e:
+      self.print(' ~ ' + str(e))
+    for command in pending:
+      if command.done() and command.future.exception() is None:
+        self.querycache.put(command.text, command.future.result().line)
+
+  ''' send
+      Sends a command to the Lamb bot, returns its LambCommand
+      The command's future is resolved by the first response matching expect,
+       or failed by a response matching errors or by the timeout
+
+      Parameters
+      command     - string, the command
+      expect      - substring / re object, or a tuple of them
+      errors      - tuple of substrings / re objects meaning the command failed
+      timeout     - None, or the seconds to wait for a response
+  '''
+  def send(self, command, expect, errors=commonerrors, timeout=120):
+    pending = self.commands.submit(command, expect, errors, timeout)
+    self.irc.privmsg(self.lambbot, command)
+    self.expirecommands()
+    return pending
+
+  ''' expirecommands
+      Fails the commands past their deadline, then sets a timer for the
+       next deadline, so receive() only wakes for it while commands are pending
+  '''
+  def expirecommands(self):
+    self.commands.expire()
+    deadline = self.commands.nextdeadline()
+    if deadline is None:
+      self.timers.cancel('expirecommands')
     else:
-      self.irc.privmsg(self.lambbot, '#goto bank')
-      self.awaitresponse('In a bank')
-    '''
-    # TODO: fix escort pairing
-    elif self.escortcasts and self.escortnick != '':
-      self.irc.privmsg(self.lambbot, '#pm docmd #cast teleport bank')
-      self.awaitresponse('now outside of')
-      self.irc.privmsg(self.lambbot, '#pm docmd #enter')
-      self.awaitresponse('You enter the')
-      self.irc.privmsg(self.lambbot, '#pm invflush #push')
-    '''
-    self.invflush(inescort=inescort, cmd='#push')
-    for _ in range(randint(1,2)):
-      line = self.irc.get_response(timeout=7)
-      line = self.getlambmsg(line)
-      if line != '':
-        self.print(line)
-    if inescort:
-      # This won't work!
-      #self.irc.privmsg(self.lambbot, '#pm docmd #part')
-      #self.awaitresponse('left the party')
-      #self.irc.privmsg(self.escortnick, 'docmd #join ' + self.irc.username)
-      #self.awaitresponse('joined the party')
-      print('Don\'t do this here')
+      self.timers.at('expirecommands', deadline, self.expirecommands)
+
+  ''' wait
+      Waits until every command is done, handling other messages meanwhile
+      Returns a list of CommandResult, raises the CommandError of the first
+       command that failed
+  '''
+  def wait(self, *pending):
+    self.awaitresponse(self.commands.waiter(pending))
+    return [command.future.result() for command in pending]
+
+  ''' rest
+      Sleeps until we are rested, we may not need it
+  '''
+  def rest(self):
+    self.wait(self.send('#sleep', ('ready to go', 'You don\'t need to rest'),
+                        timeout=None))
+
+  ''' cachereport
+      Prints the querycache hit / miss counters
+  '''
+  def cachereport(self):
+    self.print(' ~ Query cache: ' + self.querycache.report())
+
+  ''' status
+      Asks for #status, the charstate and inventory are updated as it arrives
+      Returns the response
+  '''
+  def status(self):
+    self.irc.privmsg(self.lambbot, '#status')
+    return self.awaitresponse(' Weight ')
+
+  ''' needrest
+      Returns True if our HP or MP is below restbelow of the max
+      Only asks for #status if we haven't seen them recently
+  '''
+  def needrest(self):
+    if self.charstate.stale(('hp', 'mp', 'maxhp', 'maxmp'), self.statusage):
+      self.status()
+    full = self.charstate.full(self.restbelow)
+    if full:
+      self.print(f' ~ HP {self.charstate.hp}/{self.charstate.maxhp},',
+                  f'MP {self.charstate.mp}/{self.charstate.maxmp}, no need to rest')
+    return not full
+
+  ''' load
+      Returns the fraction of our carrying capacity we carry, or None
+      Items gained since we were last weighed are added using the ledger,
+       those we haven't weighed yet at the average weight we know of,
+       only if we know none or we were never weighed we ask with #status
+  '''
+  def load(self):
+    extra = 0
+    for name, qty in self.inventory.sinceweigh.items():
+      weight = self.ledger.estimate(name)
+      if weight is None:
+        extra = None
+        break
+      extra += weight * qty
+    if self.inventory.carried is None or extra is None:
+      self.status()
+      extra = 0
+    if self.inventory.carried is None or not self.inventory.capacity:
+      return None
+    return (self.inventory.carried + extra) / self.inventory.capacity
+
+  ''' shedroom
+      Returns (kg we carry, kg we should carry at most after shedding),
+       or (None, None) if we can't tell
+      Half of the load we shed at leaves room for the next trip's loot
+  '''
+  def shedroom(self):
+    load = self.load()
+    if load is None:
+      return None, None
+    capacity = self.inventory.capacity
+    return load * capacity, self.shedload * capacity / 2
+
+  ''' needshed
+      Returns True if we carry at least shedload of our capacity
+      Being over our capacity slows us down, so that always sheds
+      If we can't tell what we carry, we shed every shedevery seconds
+  '''
+  def needshed(self):
+    if self.invstop < 1:
+      return False
+    load = self.load()
+    if load is None:
+      return self.timers.deadline('shed') is None
+    self.print(f' ~ Carrying {round(100*load)}% of our capacity')
+    return load >= min(self.shedload, 1.0)
+
+  ''' needstatus
+      Returns True if needrest or needshed would have to ask for #status
+  '''
+  def needstatus(self):
+    if self.charstate.stale(('hp', 'mp', 'maxhp', 'maxmp'), self.statusage):
+      return True
+    if self.invstop < 1:
+      return False
+    return self.inventory.carried is None or \
+      any(self.ledger.estimate(name) is None for name in self.inventory.sinceweigh)
+
+  ''' statusstates
+      Returns states asking for #status when needstatus, so the needrest and
+       needshed after them don't block a Scheduler
+
+      Parameters
+      name        - string, the first state's name, the others start with it
+      then        - string, the state after
+  '''
+  def statusstates(self, name, then):
+    return [State(name, lambda bot: name+'ask' if bot.needstatus() else then),
+            State(name+'ask', sendcmd('#status'), {'status':then, 'timeout':then},
+                  timeout=30, delay=2),
+           ]
+
+  ''' travelstates
+      Returns states going to a place and entering it,
+       with the teleport spell when we can cast
+
+      Parameters
+      name        - string, the first state's name, the others start with it
+      place       - string, e.g., 'hotel', 'bank'
+      entered     - string, the message once we are inside
+      then        - string, the state after
+      cast        - None, or the command to use whether or not we can cast
+  '''
+  def travelstates(self, name, place, entered, then, cast=None):
+    def go(bot):
+      if cast is not None:
+        command = cast
+      elif bot.cancast:
+        command = f'#cast teleport {place}'
+      else:
+        command = f'#goto {place}'
+      bot.irc.privmsg(bot.lambbot, command, delay=0)
+    on = awaiting(entered, then)
+    inside = on['arrived']
+    on['arrived'] = lambda bot, event: name+'enter' \
+                      if 'now outside of' in event.line else inside(bot, event)
+    return [State(name, go, on, delay=2),
+            State(name+'enter', sendcmd('#enter'), awaiting(entered, then), delay=2),
+           ]
+
+  ''' reststates
+      Returns states going to the hotel to #sleep when needrest
+
+      Parameters
+      name        - string, the first state's name, the others start with it
+      then        - string, the state after
+      place       - None when we are already there, or the hotel to go to
+      cast        - None, or the command to use whether or not we can cast
+  '''
+  def reststates(self, name, then, place='hotel', cast=None):
+    sleep = name+'sleep' if place is None else name+'go'
+    states = self.statusstates(name, name+'check')
+    states.append(State(name+'check', lambda bot: sleep if bot.needrest() else then))
+    if place is not None:
+      states += self.travelstates(name+'go', place, 'You enter', name+'sleep', cast)
+    states.append(State(name+'sleep', sendcmd('#sleep'), {'rested':then}, delay=2))
+    return states
+
+  ''' shedstates  - states going to the secondhand and then the bank to shed inventory
+      The ledger decides what to sell, bank and keep before we go anywhere
+      The store is skipped when we expect less than mintrip from selling,
+       the bank is skipped when there is nothing to bank
+      Escort pairing is only done by invflush
+
+      Parameters
+      name        - string, the first state's name, the others start with it
+      then        - string, the state after
+  '''
+  def shedstates(self, name, then):
+    trip = {'page':1, 'sell':[], 'bank':[]}
+    def begin(bot):
+      if bot.invstop < 1:
+        return then
+      bot.timers.after('shed', bot.shedevery)
+      if not bot.inventory.needsync():
+        return name+'weigh'
+      bot.inventory.beginsync()
+      trip['page'] = 1
+      return name+'page'
+    def page(bot, event):
+      if 'There are no items here' in event.line:
+        bot.inventory.setempty()
+        return name+'weigh'
+      pages = invpage.search(event.line)
+      if pages is None:
+        return None
+      # The page has been indexed, get the next one
+      if int(pages.group(1)) >= int(pages.group(2)):
+        return name+'weigh'
+      trip['page'] = int(pages.group(1)) + 1
+      return name+'page'
+    def plan(bot, dosell):
+      bot.dontsell.refresh()
+      sell, bank, keep = bot.ledger.plan(bot.inventory.entries(), bot.invstop,
+                                         bot.dontsell, *bot.shedroom())
+      trip['sell'], trip['bank'] = sell, bank
+      if not dosell:
+        return name+'bank' if len(bank) > 0 else then
+      expected = bot.ledger.expected(sell)
+      bot.print(f' ~ shedinv: sell {len(sell)} (~${expected:.2f}),',
+                f'bank {len(bank)}, keep {len(keep)}')
+      if len(sell) > 0 and expected >= bot.mintrip:
+        return name+'store'
+      return name+'replan'
+    def inventory(bot):
+      page = trip['page']
+      bot.irc.privmsg(bot.lambbot, '#inventory' if page == 1 else f'#inventory {page}',
+                      delay=0)
+    pageon = awaiting('', page)
+    pageon['timeout'] = name+'weigh'
+    states = [State(name, begin),
+              State(name+'page', inventory, pageon, timeout=30, delay=2)]
+    states += self.statusstates(name+'weigh', name+'plan')
+    states.append(State(name+'plan', lambda bot: plan(bot, True)))
+    states += self.travelstates(name+'store', self.store, 'You enter the', name+'sell')
+    # A pause before and after, for the lines still arriving
+    states += [State(name+'sell', timeout=7, on={'timeout':name+'selling'}),
+               State(name+'selling',
+                     lambda bot: Disposal(bot, '#sell', deque(trip['sell'])),
+                     {'done':name+'sold'}),
+               State(name+'sold', timeout=7, on={'timeout':name+'replan'}),
+               # Anything refused at the store may be banked as well
+               State(name+'replan', lambda bot: plan(bot, False))]
+    states += self.travelstates(name+'bank', 'bank', 'In a bank', name+'push')
+    states += [State(name+'push', timeout=7, on={'timeout':name+'pushing'}),
+               State(name+'pushing',
+                     lambda bot: Disposal(bot, '#push', deque(trip['bank'])),
+                     {'done':name+'pushed'}),
+               State(name+'pushed', timeout=7, on={'timeout':then})]
+    return states
+
+  ''' shedinv     - goes to the secondhand and then the bank to shed inventory
+      Parameters
+      fncounter   - unused, here only to match other "loop" functions
+  '''
+  def shedinv(self, fncounter=0):
+    shed = Machine(self, self.shedstates('shed', 'done'), 'shed', machineinterrupts)
+    Scheduler([shed]).run()
 
   ''' getbacon
       This function goes to the OrkHQ_StorageRoom to battle the FatOrk
@@ -1135,63 +1482,64 @@ class ShadowThread():
                     On subsequent calls we are already at the Redmond_OrkHQ
   '''
   def getbacon(self, fncounter=0):
-    # Get outside of the OrkHQ
-    if fncounter < 1:
-      self.irc.privmsg(self.lambbot, '#kp')
-      kp = self.awaitresponse('Known Places')
-      # Handle getting back to Redmond (if we aren't in the OrkHQ)
+    Scheduler([self.getbaconmachine(fncounter)]).run()
+
+  ''' getbaconmachine
+      Returns a Machine doing one iteration of getbacon
+  '''
+  def getbaconmachine(self, fncounter=0):
+    # Handle getting back to Redmond (if we aren't in the OrkHQ)
+    def fromplace(bot, kp):
       if 'in OrkHQ' in kp:
-        if False: #self.cancast:
-          self.irc.privmsg(self.lambbot, '#cast teleport Exit')
-          self.awaitresponse('now outside')
-          self.irc.privmsg(self.lambbot, '#enter')
-          self.awaitresponse('You enter')
-          self.irc.privmsg(self.lambbot, '#leave')
-        else:
-          self.irc.privmsg(self.lambbot, '#goto Exit')
-          self.awaitresponse('You enter')
-          self.irc.privmsg(self.lambbot, '#leave')
-      elif 'in Redmond' not in kp:
-        if self.cancast:
-          self.irc.privmsg(self.lambbot, '#cast teleportii Redmond_OrkHQ')
-          self.awaitresponse('now outside')
-        else:
-          # TODO: need to revisit travel logic !
-          pass
+        return 'exit'
+      if 'in Redmond' not in kp and bot.cancast:
+        return 'toredmond'
+      # TODO: need to revisit travel logic !
+      return 'orkhq'
+    # Get outside of the OrkHQ
+    def where(bot):
+      if fncounter > 0:
+        return 'orkhq'
+      # Our position may already be known, from this or an earlier run
+      position = bot.worldstore.position(bot.irc.username, maxage=3600)
+      if position is not None:
+        # Outside of Redmond_OrkHQ is only in Redmond
+        location, inside = position
+        return fromplace(bot, 'in OrkHQ' if inside and 'OrkHQ' in location
+                              else 'in ' + location.split('_')[0])
+      kp = bot.querycache.get('#kp')
+      if kp is not None:
+        return fromplace(bot, kp)
+      bot.irc.privmsg(bot.lambbot, '#kp', delay=0)
+    def knownplaces(bot, event):
+      bot.querycache.put('#kp', event.line)
+      return fromplace(bot, event.line)
+    states = [State('where', where, dict(awaiting('Known Places', knownplaces),
+                                         timeout='orkhq'), timeout=30),
+              # The Exit may not answer if we weren't inside after all
+              State('exit', sendcmd('#goto Exit'),
+                    dict(awaiting('You enter', 'leaveexit'), timeout='orkhq'),
+                    timeout=30, delay=2),
+              State('leaveexit', lambda bot: sendcmd('#leave')(bot) or 'orkhq', delay=2),
+              State('toredmond', sendcmd('#cast teleportii Redmond_OrkHQ'),
+                    awaiting('now outside', 'orkhq'), delay=2),
+             ]
+    states += self.travelstates('orkhq', 'OrkHQ', 'You enter', 'storage')
     # Go to the storage room, will fight the FatOrk on entrance
-    if self.cancast:
-      self.irc.privmsg(self.lambbot, '#cast teleport OrkHQ')
-      self.awaitresponse('OrkHQ')
-      self.irc.privmsg(self.lambbot, '#enter')
-    else:
-      self.irc.privmsg(self.lambbot, '#goto OrkHQ')
-    self.awaitresponse('You enter')
-    for location in ['StorageRoom', 'Exit']:
-      if False: #self.cancast:
-        self.irc.privmsg(self.lambbot, f'#cast teleport {location}')
-        self.awaitresponse('now outside')
-        self.irc.privmsg(self.lambbot, '#enter')
-      else:
-        self.irc.privmsg(self.lambbot, f'#goto {location}')
-      if location == 'StorageRoom':
-        self.awaitresponse('You continue inside')
-        #self.irc.privmsg(self.lambbot, '#search')
-      else:
-        self.awaitresponse('You enter')
-    # Leave the OrkHQ
-    self.irc.privmsg(self.lambbot, '#leave')
-    self.awaitresponse(entermsg['Redmond'])
-    if self.invstop > 0 and fncounter > 0 and fncounter % 20 == 0:
-      self.shedinv()
-      if self.cancast:
-        self.irc.privmsg(self.lambbot, '#cast teleport hotel')
-        self.awaitresponse('now outside of')
-        self.irc.privmsg(self.lambbot, '#enter')
-      else:
-        self.irc.privmsg(self.lambbot, '#goto hotel')
-      self.awaitresponse('You enter')
-      self.irc.privmsg(self.lambbot, '#sleep')
-      self.awaitresponse('ready to go')
+    states += [State('storage', sendcmd('#goto StorageRoom'),
+                     awaiting('You continue inside', 'leaveroom'), delay=2),
+               State('leaveroom', sendcmd('#goto Exit'),
+                     awaiting('You enter', 'leave'), delay=2),
+               # Leave the OrkHQ
+               State('leave', sendcmd('#leave'),
+                     awaiting(self.worldstore.entermsg('Redmond'),
+                              'status' if fncounter > 0 else 'done'), delay=2),
+              ]
+    states += self.statusstates('status', 'shedcheck')
+    states.append(State('shedcheck', lambda bot: 'shed' if bot.needshed() else 'done'))
+    states += self.shedstates('shed', 'rest')
+    states += self.reststates('rest', 'done')
+    return Machine(self, states, 'where', machineinterrupts)
 
   ''' ensurestopped
       This function ensures we are stopped and ready to begin a funciton loop
@@ -1207,26 +1555,25 @@ class ShadowThread():
     self.irc.privmsg(self.lambbot, '#stop')
     line = ''
     while line == '':
-      line = self.getlambmsg(self.irc.get_response())
+      line = self.getlambmsg(self.receive())
     self.print(line)
     if 'fighting' in line:
       while line.endswith(','):
-        line += self.getlambmsg(self.irc.get_response())
+        line += self.getlambmsg(self.receive())
       self.handlecombat(line)
       return self.ensurestopped()
     if not any([word in line for word in ('What now','outside','inside')]):
       self.irc.privmsg(self.lambbot, '#party')
       line = ''
       while line == '':
-        line = self.getlambmsg(self.irc.get_response())
+        line = self.getlambmsg(self.receive())
       self.print(line)
       if not any([msg in line for msg in ('What now','outside','inside')]):
         self.sleepreceive()
         return self.ensurestopped()
     # At bot start we set our server identifier
     if self.server == 'None':
-      self.irc.privmsg(self.lambbot, '#level')
-      line = self.awaitresponse('has level')
+      line = self.query('#level', 'has level')
       party = re.findall(r'\d+-([^{]+){(\d+)}\(L(\d+)',line)
       # We are alone
       if len(party) == 1:
@@ -1244,14 +1591,17 @@ class ShadowThread():
           self.server = list(choices.keys())[0]
         # Shared username on a different server
         else:
-          # Get _our_ level from status
-          self.irc.privmsg(self.lambbot, '#status')
-          line = self.awaitresponse('male')
-          level = line.split('(')[0].split('L')[-1]
+          # Get _our_ level from status, unless we've seen it recently
+          if self.charstate.stale(('level',), self.statusage):
+            self.status()
+          level = str(self.charstate.level)
           for choice in choices:
             if choices[choice] == level:
               self.server = choice
               break
+    self.charstate.server = None if self.server == 'None' else self.server
+    self.inventory.server = self.charstate.server
+    self.roster.me = None if self.server == 'None' else self.irc.username+'{'+self.server+'}'
 
   ''' explore
       This function simply explores the players current city in a loop.
@@ -1269,83 +1619,141 @@ class ShadowThread():
     # Ensure we are stopped
     if fncounter < 1:
       self.ensurestopped()
-    self.irc.privmsg(self.lambbot, '#explore')
+    Scheduler([self.exploremachine(fncounter)]).run()
+
+  ''' exploremachine
+      Returns a Machine doing one iteration of explore
+      Combat and meetings are interrupts, handled in whichever state we are in
+  '''
+  def exploremachine(self, fncounter=0):
     # Not sure if this is the right response if not all locations discovered yet.
-    self.awaitresponse('explored')
-    if self.invstop > 0 and fncounter%3 == 0:
-      self.shedinv()
-    if self.cancast:
-      self.irc.privmsg(self.lambbot, '#cast teleport hotel')
-      self.awaitresponse('now outside of')
-      self.irc.privmsg(self.lambbot, '#enter')
-      self.awaitresponse('You enter')
-      self.irc.privmsg(self.lambbot, '#sleep')
-      self.awaitresponse('ready to go')
-    else:
-      self.irc.privmsg(self.lambbot, '#goto hotel')
-      self.awaitresponse('You enter')
-      self.irc.privmsg(self.lambbot, '#sleep')
-      self.awaitresponse('ready to go')
-    '''
-    # TODO: fix the escort pairing
-    elif self.escortcasts and self.escortnick != '':
-      # This won't work!
-      self.irc.privmsg(self.lambbot, '#part')
-      self.awaitresponse('left the party')
-      self.irc.privmsg(self.lambbot, '#join ' + self.escortnick)
-      self.awaitresponse('joined the party')
-      self.irc.privmsg(self.lambbot, '#pm docmd #cast teleport hotel')
-      self.awaitresponse('outside of')
-      self.irc.privmsg(self.lambbot, '#pm docmd #enter')
-      self.awaitresponse('enter the')
-      self.irc.privmsg(self.lambbot, '#pm docmd #sleep')
-      self.awaitresponse('ready to go')
-      self.irc.privmsg(self.lambbot, '#part')
-      self.awaitresponse('left the party')
-      self.irc.privmsg(self.lambbot, '#pm docmd #join ' + self.irc.username)
-      self.awaitresponse('joined the party')
-      print('Don\'t do this here!')
-    '''
-    self.sleepreceive(duration=5)
+    states = [State('explore', sendcmd('#explore'), {'explored':'status'}, delay=2)]
+    states += self.statusstates('status', 'shedcheck')
+    states.append(State('shedcheck', lambda bot: 'shed' if bot.needshed() else 'rest'))
+    states += self.shedstates('shed', 'rest')
+    states += self.reststates('rest', 'pause')
+    states.append(State('pause', timeout=5, on={'timeout':'done'}))
+    return Machine(self, states, 'explore', machineinterrupts)
+
+  ''' precmdsteps
+      Returns a list of (precmd, step), compiling the precmds only when they change
+      Lamb commands "#cast berzerk", sleeps "sleep(30)" and messages "msg nick hi"
+  '''
+  def precmdsteps(self):
+    if self.precmdsource == tuple(self.precmds):
+      return self.precmdplan
+    self.precmdplan = []
+    for num, cmd in enumerate(self.precmds, 1):
+      try:
+        step = compileline(cmd, num, 'precmds')
+      except ScriptError:
+        step = None
+      if step is None or step.kind not in ('cmd', 'sleep', 'msg'):
+        self.print('Unknown pre-command: \"' + cmd + '\"')
+        continue
+      self.precmdplan.append((cmd, step))
+    self.precmdsource = tuple(self.precmds)
+    return self.precmdplan
+
+  ''' runsteps
+      Runs a list of compiled loop script steps
+
+      Parameters
+      steps       - list of loopscript.Step
+      fncounter   - integer, the iteration of the loop function
+  '''
+  def runsteps(self, steps, fncounter=0):
+    for step in steps:
+      if step.kind == 'cmd':
+        command, expect = step.args
+        if expect is None:
+          self.irc.privmsg(self.lambbot, command)
+          self.sleepreceive(duration=5)
+        else:
+          self.wait(self.send(command, expect, timeout=None))
+      elif step.kind == 'sleep':
+        self.sleepreceive(duration=step.args)
+      elif step.kind == 'msg':
+        self.irc.privmsg(*step.args)
+        self.sleepreceive(duration=5)
+      elif step.kind == 'call':
+        getattr(self, step.args)(fncounter)
+      elif step.kind == 'if':
+        if test(step.args, self, fncounter):
+          self.runsteps(step.body, fncounter)
+        else:
+          self.runsteps(step.orelse, fncounter)
+      elif step.kind == 'repeat':
+        for _ in range(step.args):
+          self.runsteps(step.body, fncounter)
+
+  ''' script
+      Runs the loop script in self.loopscript, reloaded when the file changes
+      A script that no longer compiles keeps running its last good version
+  '''
+  def script(self, fncounter=0):
+    if self.loopscript is None:
+      raise Exception('No loop script is set')
+    if self.scriptfile is None or self.scriptfile.filename != self.loopscript:
+      callables = [name for name in dir(self) if not name.startswith('_')
+                   and name != 'script' and callable(getattr(self, name))]
+      self.scriptfile = LoopScript(self.loopscript, callables)
+      self.print(' ~ Compiled', self.loopscript)
+    elif self.scriptfile.reload():
+      self.print(' ~ Reloaded', self.loopscript)
+    if self.scriptfile.error is not None:
+      self.print(' ~ ' + str(self.scriptfile.error))
+    if self.scriptfile.steps is None:
+      raise Exception(f'Loop script {self.loopscript} doesn\'t compile')
+    if fncounter < 1:
+      self.ensurestopped()
+    self.runsteps(self.scriptfile.steps, fncounter)
 
   def forest(self, fncounter=0):
     # Ensure we are stopped
     if fncounter < 1:
       self.ensurestopped()
-    line = self.irc.get_response(timeout=5)
-    line = self.getlambmsg(line)
-    if line != '': self.print(line)
-    self.irc.privmsg(self.lambbot, '#cast teleportii forest_lake')
-    self.awaitresponse('dark forest')
-    self.irc.privmsg(self.lambbot, '#enter')
-    self.awaitresponse('grab')
-    count = 0
-    while count < 9:
-      if count % 3 == 0:
-        for i in range(1,4):
-          self.irc.privmsg(self.lambbot, f'#cast calm {i}')
-          self.awaitresponse('casts')
-      count += 1
-      self.colorprint(f'Grab #{count}')
-      self.irc.privmsg(self.lambbot, '#grab')
-      line = self.awaitresponse('grab')
-      if 'nothing' in line: break
-      self.awaitresponse('continue')
-    self.irc.privmsg(self.lambbot, '#cast teleportii redmond_hotel')
-    self.awaitresponse('now outside of')
-    self.irc.privmsg(self.lambbot, '#enter')
-    self.awaitresponse('You enter')
-    self.irc.privmsg(self.lambbot, '#sleep')
-    self.awaitresponse('ready to go')
-    if self.invstop >= 0:
-      self.shedinv()
-    self.irc.privmsg(self.lambbot, '#cast teleport redmond_hotel')
-    self.awaitresponse('now outside of')
-    self.irc.privmsg(self.lambbot, '#enter')
-    self.awaitresponse('You enter')
-    self.irc.privmsg(self.lambbot, '#sleep')
-    self.awaitresponse('ready to go')
-    self.sleepreceive(duration=5)
+    Scheduler([self.forestmachine(fncounter)]).run()
+
+  ''' forestmachine
+      Returns a Machine doing one iteration of forest,
+       three calms before every third of up to nine grabs
+  '''
+  def forestmachine(self, fncounter=0):
+    run = {'grabs':0, 'calms':0}
+    def calm(bot):
+      run['calms'] += 1
+      bot.irc.privmsg(bot.lambbot, f'#cast calm {run["calms"]}', delay=0)
+    def grab(bot):
+      run['grabs'] += 1
+      bot.colorprint(f'Grab #{run["grabs"]}')
+      bot.irc.privmsg(bot.lambbot, '#grab', delay=0)
+    def grabbed(bot, event):
+      return 'tohotel' if 'nothing' in event.line else 'continue'
+    def nextgrab(bot, event):
+      if run['grabs'] >= 9:
+        return 'tohotel'
+      if run['grabs'] % 3 == 0:
+        run['calms'] = 0
+        return 'calm'
+      return 'grab'
+    states = [State('settle', timeout=5, on={'timeout':'toforest'}),
+              State('toforest', sendcmd('#cast teleportii forest_lake'),
+                    awaiting('dark forest', 'enterforest'), delay=2),
+              State('enterforest', sendcmd('#enter'), awaiting('grab', 'calm'), delay=2),
+              State('calm', calm, awaiting('casts', lambda bot, event:
+                                   'calm' if run['calms'] < 3 else 'grab'), delay=2),
+              State('grab', grab, awaiting('grab', grabbed), delay=2),
+              State('continue', on=awaiting('continue', nextgrab)),
+             ]
+    states += self.travelstates('tohotel', 'redmond_hotel', 'You enter', 'rest',
+                                cast='#cast teleportii redmond_hotel')
+    states += self.reststates('rest', 'shed', place=None)
+    states += self.shedstates('shed', 'back')
+    states += self.reststates('back', 'pause', place='redmond_hotel',
+                              cast='#cast teleport redmond_hotel')
+    states.append(State('pause', timeout=5, on={'timeout':'done'}))
+    return Machine(self, states, 'settle', machineinterrupts)
 
   ''' escort
       Escort someone else, handling combat / etc automatically
@@ -1371,7 +1779,7 @@ class ShadowThread():
       # Need to communicate to people on other servers!
       print(helpstring)
     while not self.doquit and 'escort' == str(self.doloop):
-      line = self.irc.get_response()
+      line = self.receive()
       lambline = self.getlambmsg(line)
       if lambline == '':
         continue
@@ -1398,35 +1806,53 @@ class ShadowThread():
           bad = 'Refusing to do a command containing ' + bad
           self.irc.privmsg(self.lambbot, f'#pm: {bad}')
       elif 'sharekp' in line:
-        self.irc.privmsg(self.lambmsg, '#pm OK, starting places')
+        self.irc.privmsg(self.lambbot, '#pm OK, starting places')
         cities = ['Redmond','Seattle','Delaware','Chicago']
         cmd = '#givekp ' + self.escortnick + ' '
+        # Ask for the places in every city we don't know at once
+        self.prefetch([('#kp ' + city, 'Known Places in ' + city)
+                       for city in cities
+                       if self.worldstore.knownplaces(self.irc.username, city,
+                                                      maxage=3600) is None])
         for city in cities:
-          self.irc.privmsg(self.lambbot, '#kp ' + city)
-          fullcmd = cmd + city + '_'
-          response = self.awaitresponse(city).strip('.')
-          places = response.split(':')[-1].split(', ')
-          places[0] = places[0].strip()
-          # Redmond has numbered places, "1-Hotel", . . .
-          # Could check the city or just . . .
-          if any('-' in place for place in places):
-            places = [place.split('-')[1] for place in places]
+          # Use our places from the worldstore unless they're an hour old
+          places = self.worldstore.knownplaces(self.irc.username, city,
+                                               maxage=3600)
+          if places is None:
+            # Redmond has numbered places, "1-Hotel", . . .
+            places = listentries(self.query('#kp ' + city,
+                                             'Known Places in ' + city).strip('.'))
+            self.worldstore.setknownplaces(self.irc.username, city, places)
+          # Only give the places our escort doesn't already know
+          escortknows = self.worldstore.knownplaces(self.escortnick, city) or []
+          given = []
           for place in places:
-            self.irc.privmsg(self.lambbot, fullcmd + place)
+            if place in escortknows: continue
+            self.irc.privmsg(self.lambbot, cmd + city + '_' + place)
+            given.append(place)
+            self.sleepreceive(duration=3)
+          if len(given) > 0:
+            self.worldstore.addknownplaces(self.escortnick, city, given)
             self.sleepreceive(duration=3)
-          self.sleepreceive(duration=3)
         self.irc.privmsg(self.lambbot, '#pm Those are my places !!!')
       elif 'sharekw' in line:
         self.irc.privmsg(self.lambbot, '#pm OK, starting words')
-        self.irc.privmsg(self.lambbot, '#kw')
         cmd = '#givekw ' + self.escortnick + ' '
-        response = self.awaitresponse('Known Words').strip('.')
-        words = response.split(':')[-1].split(', ')
-        words = [word.strip().split('-')[1] for word in words]
+        words = self.worldstore.knownwords(self.irc.username, maxage=3600)
+        if words is None:
+          words = listentries(self.query('#kw', 'Known Words').strip('.'))
+          self.worldstore.setknownwords(self.irc.username, words)
+        # Only give the words our escort doesn't already know
+        escortknows = self.worldstore.knownwords(self.escortnick) or []
+        given = []
         for word in words:
+          if word in escortknows: continue
           self.irc.privmsg(self.lambbot, cmd + word)
+          given.append(word)
+          self.sleepreceive(duration=3)
+        if len(given) > 0:
+          self.worldstore.addknownwords(self.escortnick, given)
           self.sleepreceive(duration=3)
-        self.sleepreceive(duration=3)
         self.irc.privmsg(self.lambbot, '#pm Those are my words !!!')
       elif 'help' in line:
         for helpstring in helpstrings:
@@ -1453,9 +1879,8 @@ class ShadowThread():
           if iterations == 0: iterations = -1
           loop = cmd.split(' ')[0]
           while iterations != 0:
-            for cmd in self.precmds:
-              self.irc.privmsg(self.lambbot, cmd)
-              self.sleepreceive(duration=3)
+            self.runsteps([step for _, step in self.precmdsteps()],
+                          int(fncounter))
             getattr(self,loop)(int(fncounter))
             if iterations > 0:
               iterations -= 1
@@ -1468,3 +1893,15 @@ class ShadowThread():
             info, error = format_exception(etype, value, tb)[-2:]
             print(f'Exception:\n{info}\n{error}')
 
+
+''' setting
+    Returns a read-only property for a setting in the bot's config,
+     so self.invstop reads self.config.invstop
+    Change settings with control() or setconfig()
+'''
+def setting(name):
+  return property(lambda self: getattr(self.config, name))
+
+for name in BotConfig._fields:
+  setattr(ShadowThread, name, setting(name))
+del name
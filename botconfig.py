@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  botconfig.py
+#  A bot's settings as one immutable snapshot, replaced whole on every change,
+#   loaded from and saved to JSON files
+##
+#  Author: Chase LP
+###
+
+import json
+from collections import namedtuple
+from dontsell import defaultkeep
+
+# Escort restricted commands
+defaultbadcmds = (
+        '#unequip','#uq', # Unequip item
+        '#swap','#sw',    # Swapping items could interfere with shedinv()
+        '#l','#lvlup',    # Use karma to lvlup traits
+        '#reset',         # Delete the player
+        '#aslset',        # Change asl
+        '#rm',           '#running_mode',
+        '#gi','#gy',      # (give item/money)
+        '#give','#giveny',
+        '#dr',           '#drop',
+        '#mo',           '#mount',
+        '#sh',           '#shout',
+        '#w',            '#whisper',
+        '#cm',           '#clan_message',
+        '#pm',           '#party_message',
+        '#ban',          '#unban',
+                 )
+
+# The settings with their defaults, in the order they're saved
+fields = [('lambbot',     'Lamb3_1'), # The nick of the Shadow Lamb bot
+          ('meetsay',     None),      # None, or what we say when we 'meet' civilians
+          ('invstop',     0),         # Inventory stop position for shedinv
+          ('shedload',    0.9),       # Fraction of our capacity at which we shedinv
+          ('shedevery',   1800),      # Seconds between sheds when we can't tell our load
+          ('store',       'store'),   # The location to #goto or #teleport to sell things
+          ('pipedepth',   4),         # Disposal commands outstanding at once in invflush
+          ('mintrip',     0),         # Only go to the store when we expect this much
+          ('restbelow',   1.0),       # Rest when HP or MP is below this fraction
+          ('statusage',   300),       # Ask for #status when HP / MP are older than this
+          ('precmds',     ()),        # Commands to run when beginning doloop()
+          ('loopscript',  None),      # None, or the filename of a loop script
+          ('escortnick',  ''),        # The nick of the person we're escorting
+          ('badcmds',     defaultbadcmds), # Commands not to do during escort
+          ('cancast',     True),      # Whether we can cast teleport/calm/heal
+          ('escortcasts', False),     # Whether our escort can cast spells
+          ('attacklow',   True),      # Prioritize quicker kills during fight
+          ('targetdb',    True),      # Rank targets by what we know of them
+          ('keep',        tuple(defaultkeep)), # Keywords of items we never sell
+          ('tracefile',   None),      # None, or a file to write tracing spans to
+         ]
+
+# Settings holding a list of strings, kept as tuples
+listfields = ('precmds', 'badcmds', 'keep')
+# Settings which may be None instead of a string
+nonefields = ('meetsay', 'loopscript', 'tracefile')
+# Number settings which may have a fraction, the others are whole numbers
+floatfields = ('shedload', 'mintrip', 'restbelow')
+# The least a number setting may be
+minimums = {'invstop':0, 'shedload':0, 'shedevery':1, 'pipedepth':1,
+            'mintrip':0, 'restbelow':0, 'statusage':0}
+# String settings which may not be empty
+nonempty = ('lambbot', 'store')
+
+''' check
+    Returns a setting's value in the type it is kept as
+    Raises a ValueError for a value of the wrong type or out of range
+
+    Parameters
+    name          - string, the setting
+    value         - its new value
+'''
+def check(name, value):
+  default = dict(fields)[name]
+  if name in listfields:
+    if not isinstance(value, (list, tuple)) \
+       or not all(isinstance(item, str) for item in value):
+      raise ValueError(f'{name} must be a list of strings')
+    return tuple(value)
+  if isinstance(default, bool):
+    if not isinstance(value, bool):
+      raise ValueError(f'{name} must be true or false')
+  elif name in floatfields:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      raise ValueError(f'{name} must be a number')
+  elif isinstance(default, int):
+    if isinstance(value, bool) or not isinstance(value, int):
+      raise ValueError(f'{name} must be a whole number')
+  elif value is None:
+    if name not in nonefields:
+      raise ValueError(f'{name} must be a string')
+  elif not isinstance(value, str):
+    raise ValueError(f'{name} must be a string')
+  elif value == '' and name in nonempty:
+    raise ValueError(f'{name} must not be empty')
+  if name in minimums and value < minimums[name]:
+    raise ValueError(f'{name} must be at least {minimums[name]}')
+  return value
+
+''' class BotConfig
+    Nothing changes a BotConfig, replace() returns a new one,
+     so a bot reading its settings never needs a lock,
+     whoever changes them assigns the new snapshot in one step
+
+    Methods
+    replace       - Returns a copy with some settings changed
+    todict        - Returns the settings as a dict for json
+'''
+class BotConfig(namedtuple('BotConfig', [name for name, _ in fields],
+                           defaults=[default for _, default in fields])):
+  __slots__ = ()
+
+  def replace(self, **changes):
+    for name in changes:
+      if name not in self._fields:
+        raise ValueError(f'unknown setting "{name}"')
+    return self._replace(**{name:check(name, value) for name, value in changes.items()})
+
+  def todict(self):
+    return {name:list(value) if name in listfields else value
+            for name, value in self._asdict().items()}
+
+''' load
+    Returns the settings in a JSON file, over the base settings
+    Settings missing from the file keep their value in base
+    Raises a ValueError naming the file for an unknown setting or bad value
+
+    Parameters
+    filename      - string, a JSON file with an object of settings
+    base          - BotConfig, for the settings the file doesn't have
+'''
+def load(filename, base=BotConfig()):
+  with open(filename) as infile:
+    try:
+      settings = json.load(infile)
+    except json.JSONDecodeError as e:
+      raise ValueError(f'{filename}: {e}')
+  if not isinstance(settings, dict):
+    raise ValueError(f'{filename}: expected an object of settings')
+  try:
+    return base.replace(**settings)
+  except ValueError as e:
+    raise ValueError(f'{filename}: {e}')
+
+def save(config, filename):
+  with open(filename, 'w') as outfile:
+    json.dump(config.todict(), outfile, indent=2)
+    outfile.write('\n')
@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  charstate.py
+#  Our character's HP, MP, level, XP, karma and nuyen,
+#   kept from passive messages instead of asking with #status
+##
+#  Author: Chase LP
+###
+
+import re, time
+
+from roster import levelmember, memberhp
+
+# The response from #status
+# male darkelve L59(101). HP :58.5/72.6, MP :135.38/135.38, Atk :132.2, Def :9.2, Dmg :15.6-37.2, Arm (M/F):2.5/1.9, XP :25.87, Karma :18, $ :17340.23, Weight :48.16kg/42.62kg
+statusline = re.compile(r'L(\d+)\(\d+\)\. HP :([\d.]+)/([\d.]+), ' +
+                        r'MP :([\d.]+)/([\d.]+),.* XP :([\d.]+), ' +
+                        r'Karma :(\d+), \$ :([\d.]+)')
+# You loot 12.5$, 1.2XP and Bacon
+lootnuyen = re.compile(r'You loot.*?([\d.]+)\$')
+lootxp = re.compile(r'You loot.*?([\d.]+)XP')
+# You sold 1 of your DarkBow for 56.63$
+soldnuyen = re.compile(r'You sold \d+ of your \S+? for ([\d.]+)\$')
+# 1-chaseleif{57} casts a level 3 teleport ...
+castline = re.compile(r'(?:\d+-)?([^{ ,.]+){(\d+)} casts a level \d+ (\w+)')
+# Messages telling us we have rested
+restedlines = ('ready to go', 'You don\'t need to rest')
+
+''' class CharState
+    Every field is None until we have seen it
+    updated holds the time each field was last seen,
+     a field we know has changed without seeing its value is dropped from it
+
+    Attributes
+    nick          - string, our nick
+    server        - None or a string, our server number
+    inventory     - Inventory, which also keeps what we carry and can carry
+    level         - None or an integer
+    hp, maxhp     - None or floats
+    mp, maxmp     - None or floats
+    xp, karma     - None or floats
+    nuyen         - None or a float
+    updated       - dict, field name -> time last seen
+    spellcost     - dict, spell -> MP it cost us, learned from our MP around a cast
+    lastcast      - None, or (spell, MP before it) for the one cast since MP was seen
+
+    Methods
+    observe       - Updates the fields from a stripped message from the Lamb bot
+    set           - Sets fields and marks them seen now
+    ismine        - Returns True if a name and server from a message are us
+    age           - Returns the seconds since a field was last seen
+    stale         - Returns True if any of the fields are unknown or too old
+    full          - Returns True if HP and MP are at least a fraction of their max
+    weight        - Returns (carried, capacity) in kg, or None
+    cast          - Takes a spell we cast from our MP, or marks MP unknown
+'''
+class CharState():
+  def __init__(self, nick, inventory=None):
+    self.nick = nick
+    self.server = None
+    self.inventory = inventory
+    self.level = None
+    self.hp = self.maxhp = None
+    self.mp = self.maxmp = None
+    self.xp = self.karma = None
+    self.nuyen = None
+    self.updated = {}
+    self.spellcost = {}
+    self.lastcast = None
+
+  def set(self, **fields):
+    now = time.time()
+    for name, value in fields.items():
+      setattr(self, name, value)
+      self.updated[name] = now
+
+  def age(self, name):
+    if name not in self.updated:
+      return None
+    return time.time() - self.updated[name]
+
+  def stale(self, names, maxage):
+    for name in names:
+      age = self.age(name)
+      if age is None or age > maxage:
+        return True
+    return False
+
+  def weight(self):
+    if self.inventory is None or self.inventory.carried is None:
+      return None
+    return self.inventory.carried, self.inventory.capacity
+
+  ''' ismine
+      Returns True if a name and server from a message are us
+  '''
+  def ismine(self, name, server):
+    return name == self.nick and (self.server is None or server == self.server)
+
+  ''' full
+      Returns True if our HP and MP are both at least a fraction of their max
+      Returns None if we don't know them
+
+      Parameters
+      fraction    - float, 1.0 is completely full
+  '''
+  def full(self, fraction=1.0):
+    if None in (self.hp, self.maxhp, self.mp, self.maxmp):
+      return None
+    if 'hp' not in self.updated or 'mp' not in self.updated:
+      return None
+    return self.hp >= fraction*self.maxhp and self.mp >= fraction*self.maxmp
+
+  ''' observe
+      Returns True if the line changed a field
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    match = statusline.search(line)
+    if match is not None:
+      level, hp, maxhp, mp, maxmp, xp, karma, nuyen = match.groups()
+      # A cast since we last saw our MP tells us what that spell costs
+      if self.lastcast is not None:
+        spell, before = self.lastcast
+        if before > float(mp):
+          self.spellcost[spell] = before - float(mp)
+        self.lastcast = None
+      self.set(level=int(level), hp=float(hp), maxhp=float(maxhp),
+               mp=float(mp), maxmp=float(maxmp), xp=float(xp),
+               karma=float(karma), nuyen=float(nuyen))
+      return True
+    if any(msg in line for msg in restedlines):
+      if self.maxhp is not None and self.maxmp is not None:
+        self.lastcast = None
+        self.set(hp=self.maxhp, mp=self.maxmp)
+        return True
+      return False
+    changed = False
+    if 'You loot' in line:
+      match = lootnuyen.search(line)
+      if match is not None and self.nuyen is not None:
+        self.set(nuyen=self.nuyen + float(match.group(1)))
+        changed = True
+      match = lootxp.search(line)
+      if match is not None and self.xp is not None:
+        self.set(xp=self.xp + float(match.group(1)))
+        changed = True
+    match = soldnuyen.search(line)
+    if match is not None and self.nuyen is not None:
+      self.set(nuyen=self.nuyen + float(match.group(1)))
+      return True
+    if 'has level' in line:
+      # Someone else may share our nick on another server
+      mine = [level for _, name, server, level in levelmember.findall(line)
+                    if self.ismine(name, server)]
+      if len(mine) == 1:
+        self.set(level=int(mine[0]))
+        return True
+    match = memberhp.search(line)
+    if match is not None and self.ismine(match.group(2), match.group(3)):
+      self.set(hp=float(match.group(4)), maxhp=float(match.group(5)))
+      return True
+    match = castline.search(line)
+    if match is not None and self.ismine(match.group(1), match.group(2)):
+      return self.cast(match.group(3)) or changed
+    return changed
+
+  ''' cast
+      Takes what a spell we cast costs from our MP
+      Without its cost our MP is unknown until we see it again,
+       the next time we see it we learn the cost
+      The time MP was seen isn't changed, it still ages to statusage
+  '''
+  def cast(self, spell):
+    if 'mp' not in self.updated:
+      # A second cast before we saw our MP, we can't tell which cost what
+      self.lastcast = None
+      return False
+    if spell in self.spellcost:
+      self.mp = max(0, self.mp - self.spellcost[spell])
+      return True
+    self.lastcast = (spell, self.mp)
+    del self.updated['mp']
+    return True
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  combatqueue.py
+#  Tracks "N seconds busy" from combat lines and holds combat commands
+#  until the actor that has to perform them is free
+##
+#  Author: Chase LP
+###
+
+import re, time
+
+# The actor is the first name in the line, the busy time is at the end
+# 1-chaseleif{57} attacks 4-Ninja[8027866] with Ninjaken and caused 21.1 damage. 34 seconds busy
+# (the "... used Stimpatch ..." message is missing "seconds")
+busyline = re.compile(r'(?:\d+-)?([^{\[ ]+(?: [^{\[ ]+)?[{\[]\d+[}\]]).* (\d+) (?:seconds )?busy$')
+
+''' class CombatScheduler
+    Attributes
+    me            - string, our actor key, e.g. 'chaseleif{57}'
+    busy          - dict, actor key -> time when that actor will be free
+    pending       - dict, slot -> [time queued, priority, command]
+    staleafter    - seconds after which a queued command is dropped
+    guard         - seconds we assume we are busy after sending a command,
+                     until the server tells us the real busy time
+
+    Methods
+    observe       - Updates the busy time of the actor in a combat line
+    busyfor       - Returns the seconds until an actor is free
+    schedule      - Queues a command, replacing any stale or weaker command in its slot
+    due           - Returns the commands that should be sent now
+    nextdue       - Returns the seconds until a queued command can be sent
+    clear         - Forgets queued commands and busy times
+'''
+class CombatScheduler():
+  staleafter = 60
+  guard      = 5
+
+  def __init__(self, me=''):
+    self.me = me
+    self.busy = {}
+    self.pending = {}
+
+  ''' observe
+      Returns the actor key of a line ending in "N seconds busy", or None
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    match = busyline.match(line)
+    if match is None:
+      return None
+    actor, secs = match.groups()
+    self.busy[actor] = time.time() + int(secs)
+    return actor
+
+  ''' busyfor
+      Returns the seconds until the actor is free, zero if they are free now
+
+      Parameters
+      actor       - string, actor key, defaults to our own
+  '''
+  def busyfor(self, actor=None):
+    if actor is None:
+      actor = self.me
+    return max(0, self.busy.get(actor, 0) - time.time())
+
+  ''' schedule
+      Queues a command for us to send when we are free
+      Each slot holds only the newest command
+       unless the queued command has a higher priority and isn't stale
+
+      Parameters
+      command     - string, the Lamb command, e.g., '#attack 3'
+      slot        - string, commands in the same slot replace each other
+      priority    - integer, higher priority commands are sent first
+
+      Returns True if the command was queued
+  '''
+  def schedule(self, command, slot='attack', priority=0):
+    now = time.time()
+    queued = self.pending.get(slot)
+    if queued is not None and queued[1] > priority \
+        and now - queued[0] < self.staleafter:
+      return False
+    self.pending[slot] = [now, priority, command]
+    return True
+
+  ''' due
+      Returns a list with the command to send now (or an empty list)
+      Only one command is released per busy period, the highest priority
+  '''
+  def due(self):
+    now = time.time()
+    for slot in [s for s in self.pending
+                  if now - self.pending[s][0] >= self.staleafter]:
+      del self.pending[slot]
+    if len(self.pending) == 0 or self.busyfor() > 0:
+      return []
+    slot = max(self.pending, key=lambda s: self.pending[s][1])
+    command = self.pending.pop(slot)[2]
+    # We'll be busy once the command lands, hold the rest until we hear back
+    self.busy[self.me] = now + self.guard
+    return [command]
+
+  ''' nextdue
+      Returns the seconds until a queued command may be sent
+      Returns None if there is nothing queued
+  '''
+  def nextdue(self):
+    if len(self.pending) == 0:
+      return None
+    return self.busyfor()
+
+  def clear(self):
+    self.pending = {}
+    self.busy = {}
@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  controlapi.py
+#  Everything the menus do, and queries of a bot's state,
+#   as JSON requests on a Unix socket
+##
+#  Author: Chase LP
+###
+
+'''
+    One JSON object per line, answered with one JSON object per line
+    {"op": "state", "bot": "nick"}  ->  {"ok": true, "result": {...}}
+    A failed request is answered with {"ok": false, "error": "..."}
+    "bot" may be left out when the socket serves a single bot
+
+    bots                                - The nicks served here
+    state                               - Loop, iteration, position, HP, MP,
+                                          inventory count, loot, ...
+    settings                            - Every setting in botconfig.py
+    set       name, value               - Changes a setting (or bumsleft)
+    add       name, value               - Adds a word to precmds, badcmds or keep
+    remove    name, value               - Removes one
+    loops                               - The loop functions we can start
+    loop      name                      - Starts a loop, null stops it
+    load      file                      - Loads settings from a file
+    save      file                      - Saves settings to a file
+    msg       text, to                  - Messages a nick or channel, the Lamb bot
+                                          when "to" is left out
+    join      channel                   - Joins a channel
+    report    kind, limit               - Lines of the "enemies", "items", "latency"
+                                          or "cache" report
+    colors                              - Toggles colored output
+    quit      soft                      - Quits, letting the loop finish when soft
+'''
+
+import os, sys, json, time, socket, threading, socketserver
+import botconfig
+import startbot
+
+# Settings that aren't in BotConfig but the menus change
+runtimesettings = ('bumsleft',)
+
+class RequestError(Exception):
+  pass
+
+''' state
+    Returns a dict of what a bot is doing now
+'''
+def state(thread):
+  charstate = thread.charstate
+  return {'nick':thread.irc.username,
+          'server':thread.server,
+          'lambbot':thread.lambbot,
+          'loop':thread.doloop,
+          'iteration':thread.iteration,
+          'position':thread.position,
+          'incombat':thread.incombat,
+          'alive':thread.th.is_alive(),
+          'hp':charstate.hp, 'maxhp':charstate.maxhp,
+          'mp':charstate.mp, 'maxmp':charstate.maxmp,
+          'level':charstate.level,
+          'xp':charstate.xp,
+          'karma':charstate.karma,
+          'nuyen':charstate.nuyen,
+          'items':len(thread.inventory),
+          'carried':thread.inventory.carried,
+          'capacity':thread.inventory.capacity,
+          'lootmoney':thread.lootmoney,
+          'lootxp':thread.lootxp,
+          'remaining':max(0, thread.remaining - time.time()) if thread.remaining else 0,
+          'untilaction':thread.untilaction}
+
+''' lines
+    Returns the lines a report function prints
+'''
+def lines(printreport, limit):
+  printed = []
+  printreport(limit=limit, printfn=lambda *args, **kwargs:
+                                     printed.append(' '.join(str(arg) for arg in args)))
+  return printed
+
+''' class ControlAPI
+    Answers requests for the bots given by a function
+
+    Attributes
+    bots          - function returning a dict, nick -> ShadowThread
+
+    Methods
+    handle        - Returns the response to a request
+'''
+class ControlAPI():
+  def __init__(self, bots):
+    self.bots = bots
+
+  def bot(self, request):
+    bots = self.bots()
+    nick = request.get('bot')
+    if nick is None:
+      if len(bots) != 1:
+        raise RequestError(f'"bot" is one of {", ".join(sorted(bots))}')
+      return next(iter(bots.values()))
+    if nick not in bots:
+      raise RequestError(f'Not serving {nick}')
+    return bots[nick]
+
+  ''' handle
+      Returns the response for a request, a dict
+  '''
+  def handle(self, request):
+    try:
+      if not isinstance(request, dict):
+        raise RequestError('A request is a JSON object')
+      op = request.get('op')
+      if op == 'bots':
+        return {'ok':True, 'result':sorted(self.bots())}
+      handler = getattr(self, 'op_' + str(op), None)
+      if handler is None:
+        raise RequestError(f'Unknown op {op}')
+      return {'ok':True, 'result':handler(self.bot(request), request)}
+    except KeyError as e:
+      return {'ok':False, 'error':f'Missing {e}'}
+    except (RequestError, ValueError, TypeError, OSError) as e:
+      return {'ok':False, 'error':str(e)}
+
+  def op_state(self, thread, request):
+    return state(thread)
+
+  def op_settings(self, thread, request):
+    return thread.config.todict()
+
+  def op_set(self, thread, request):
+    name, value = request['name'], request['value']
+    if name not in runtimesettings:
+      # Raises a ValueError here rather than in the bot's thread
+      thread.config.replace(**{name:value})
+    elif not isinstance(value, int) or isinstance(value, bool):
+      raise RequestError(f'{name} must be a whole number')
+    return thread.control(name, value)
+
+  def op_add(self, thread, request):
+    name, value = request['name'], request['value']
+    if name not in botconfig.listfields:
+      raise RequestError(f'{name} is not one of {", ".join(botconfig.listfields)}')
+    current = getattr(thread.config, name)
+    if value in current:
+      return True
+    # Raises a ValueError here rather than in the bot's thread
+    thread.config.replace(**{name:current + (value,)})
+    return thread.control(name, current + (value,))
+
+  def op_remove(self, thread, request):
+    name, value = request['name'], request['value']
+    if name not in botconfig.listfields:
+      raise RequestError(f'{name} is not one of {", ".join(botconfig.listfields)}')
+    current = getattr(thread.config, name)
+    if value not in current:
+      raise RequestError(f'{value} is not in {name}')
+    remaining = tuple(item for item in current if item != value)
+    thread.config.replace(**{name:remaining})
+    return thread.control(name, remaining)
+
+  def op_loops(self, thread, request):
+    return startbot.loopfunctions(thread)
+
+  def op_loop(self, thread, request):
+    name = request.get('name')
+    if name is None:
+      return thread.control('doloop', None)
+    startbot.startloop(thread, name)
+    return True
+
+  def op_load(self, thread, request):
+    return thread.control('config', botconfig.load(request['file'], thread.config))
+
+  def op_save(self, thread, request):
+    botconfig.save(thread.config, request['file'])
+    return True
+
+  def op_msg(self, thread, request):
+    text = request['text']
+    if text == '':
+      raise RequestError('An empty message')
+    thread.irc.privmsg(request.get('to', thread.lambbot), text, delay=0)
+    return True
+
+  def op_join(self, thread, request):
+    thread.irc.joinchan(request['channel'])
+    return True
+
+  def op_report(self, thread, request):
+    kind, limit = request['kind'], request.get('limit', 20)
+    if kind == 'enemies':
+      return lines(thread.enemydb.printreport, limit)
+    if kind == 'items':
+      return lines(thread.ledger.printreport, limit)
+    if kind == 'latency':
+      return lines(thread.latency.printreport, limit)
+    if kind == 'cache':
+      return [thread.querycache.report()]
+    raise RequestError('kind is one of enemies, items, latency, cache')
+
+  def op_colors(self, thread, request):
+    thread.togglecolors()
+    return thread.colors
+
+  def op_quit(self, thread, request):
+    thread.control('doloop', None)
+    return thread.control('softquit' if request.get('soft', True) else 'doquit', True)
+
+''' class RequestHandler
+    Answers each line on a connection
+'''
+class RequestHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    for line in self.rfile:
+      try:
+        request = json.loads(line)
+      except ValueError as e:
+        response = {'ok':False, 'error':f'Bad JSON: {e}'}
+      else:
+        response = self.server.api.handle(request)
+      self.wfile.write(json.dumps(response, default=str).encode() + b'\n')
+
+''' class ControlServer
+    Serves a ControlAPI on a Unix socket from a daemon thread,
+     a thread for each connection
+    Only our user may connect, the socket can send messages as the bot
+
+    Attributes
+    path          - string, the socket's filename
+    api           - ControlAPI
+    server        - socketserver.ThreadingUnixStreamServer
+    th            - threading object, serving requests
+
+    Methods
+    close         - Stops serving and removes the socket file
+'''
+class ControlServer():
+  def __init__(self, path, bots):
+    self.path = path
+    self.api = ControlAPI(bots)
+    self.removestale()
+    oldmask = os.umask(0o177)
+    try:
+      self.server = socketserver.ThreadingUnixStreamServer(path, RequestHandler)
+    finally:
+      os.umask(oldmask)
+    self.server.daemon_threads = True
+    self.server.api = self.api
+    self.th = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.th.start()
+
+  ''' removestale
+      Removes the socket file left by a server that has gone,
+       raises an OSError if another server is using it
+  '''
+  def removestale(self):
+    if not os.path.exists(self.path):
+      return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(self.path)
+    except (ConnectionRefusedError, FileNotFoundError):
+      os.unlink(self.path)
+      return
+    finally:
+      probe.close()
+    raise OSError(f'{self.path} is in use')
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+    try:
+      os.unlink(self.path)
+    except FileNotFoundError:
+      pass
+
+''' request
+    Sends one request to a control socket, returns the response
+'''
+def request(path, **fields):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(path)
+    client.sendall(json.dumps(fields).encode() + b'\n')
+    response = b''
+    while not response.endswith(b'\n'):
+      data = client.recv(65536)
+      if data == b'':
+        break
+      response += data
+  return json.loads(response)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    sys.exit('usage: controlapi.py SOCKET \'{"op": "state"}\'')
+  print(json.dumps(request(sys.argv[1], **json.loads(sys.argv[2])), indent=2))
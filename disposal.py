@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  disposal.py
+#  Pipelined disposal commands (#sell, #push, #drop), fed a line at a time,
+#   so disposeitems can wait for them and a state machine can run them
+##
+#  Author: Chase LP
+###
+
+import time
+from inventory import removed, disposedhints
+from dontsell import refusedname
+
+# Seconds between commands, the same courtesy as the delay in IRCHandler.privmsg
+senddelay = 1
+# Seconds without a line before we give up on the oldest command
+giveup = 7
+
+''' class Disposal
+    Sends disposal commands for items by name, keeping up to pipedepth
+     commands outstanding, a whole stack per command when the server
+     accepts a quantity (domulti), one command per unit when it doesn't
+    Responses are matched to their command by the item name, a #drop or #give
+     reply has no count we parse, it answers a whole stack or one unit
+
+    Attributes
+    bot           - ShadowThread
+    cmd           - string, the command to use, e.g., "#sell", "#push"
+    todo          - deque of (item name, quantity) to dispose of
+    escortmatch   - None, or an re object matching our escort's pm
+    domulti       - whether to send a quantity with each command
+    outstanding   - dict, name -> [time sent, units still expected, sent as a stack]
+    disposed      - number of units disposed of
+    started       - time we started
+    nextsend      - time the next command may be sent
+    lastline      - time of the last line we were fed
+    done          - True once nothing is left to send or hear back about
+
+    Methods
+    feed          - Handles a stripped Lamb message
+    countoff      - Counts off one reply to the commands for an item
+    poll          - Fills the pipeline, gives up on a command we heard nothing of
+    deadline      - Returns when poll has something to do, or None
+'''
+class Disposal():
+  name = 'dispose'
+
+  def __init__(self, bot, cmd, todo, escortmatch=None):
+    self.bot = bot
+    self.cmd = cmd
+    self.todo = todo
+    self.escortmatch = escortmatch
+    self.domulti = bot.domulti.get(cmd, True)
+    self.outstanding = {}
+    self.disposed = 0
+    self.started = time.time()
+    self.nextsend = self.started
+    self.lastline = self.started
+    self.done = False
+    self.line = ''
+
+  ''' inflight
+      Returns the number of commands outstanding, a stack counts once
+  '''
+  def inflight(self):
+    return sum(1 if sent[2] else sent[1] for sent in self.outstanding.values())
+
+  ''' cansend
+      Returns True if the next item in todo may be sent once the delay is up
+  '''
+  def cansend(self):
+    if len(self.todo) == 0 or self.inflight() >= self.bot.pipedepth:
+      return False
+    item = self.todo[0][0]
+    # Only one stack of an item may be outstanding to match its response
+    return not (item in self.outstanding
+                and (self.domulti or self.outstanding[item][2]))
+
+  ''' send
+      Sends one command, one stack or one unit
+  '''
+  def send(self):
+    bot, cmd, outstanding = self.bot, self.cmd, self.outstanding
+    item, qty = self.todo.popleft()
+    self.nextsend = time.time() + senddelay
+    if self.domulti and qty > 1:
+      bot.irc.privmsg(bot.lambbot, f'{cmd} {item} {qty}', delay=0)
+      outstanding[item] = [time.time(), qty, True]
+      return
+    bot.irc.privmsg(bot.lambbot, f'{cmd} {item}', delay=0)
+    if item in outstanding:
+      outstanding[item][1] += 1
+    else:
+      outstanding[item] = [time.time(), 1, False]
+    if qty > 1:
+      self.todo.appendleft((item, qty-1))
+
+  def poll(self):
+    if self.done:
+      return
+    now = time.time()
+    if self.cansend() and now >= self.nextsend:
+      self.send()
+    # Nothing for a while, give up on the oldest command
+    oldest = min(self.outstanding, key=lambda i: self.outstanding[i][0], default=None)
+    if oldest is not None and now - self.lastline >= giveup \
+        and now - self.outstanding[oldest][0] > giveup:
+      del self.outstanding[oldest]
+      self.bot.inventory.stale = True
+      self.lastline = now
+    self.finishifdone()
+
+  def deadline(self):
+    if self.done:
+      return None
+    if self.cansend():
+      return self.nextsend
+    if len(self.outstanding) > 0:
+      return self.lastline + giveup
+    return None
+
+  def finishifdone(self):
+    if len(self.todo) > 0 or len(self.outstanding) > 0:
+      return
+    self.done = True
+    elapsed = time.time() - self.started
+    if self.disposed > 0:
+      self.bot.print(f' ~ {self.cmd}: {self.disposed} items in',
+                     '%d:%02d' % (elapsed//60, elapsed%60),
+                     f'({60*self.disposed/max(elapsed,1):.1f} items/minute)')
+
+  ''' countoff
+      Counts off one reply to the commands for an item, returns the units
+      A stack is answered at once, each unit sent gets its own reply
+  '''
+  def countoff(self, item):
+    sent = self.outstanding[item]
+    units = sent[1] if sent[2] else 1
+    sent[1] -= units
+    if sent[1] <= 0:
+      del self.outstanding[item]
+    return units
+
+  ''' feed
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def feed(self, line):
+    if self.done or line == '':
+      return
+    self.lastline = time.time()
+    if self.escortmatch and self.escortmatch.match(line):
+      return
+    bot, outstanding, todo = self.bot, self.outstanding, self.todo
+    sold = removed.search(line)
+    if sold is not None:
+      qty, item = int(sold.group(1)), sold.group(2)
+      self.disposed += qty
+      if item in outstanding:
+        outstanding[item][1] -= qty
+        if outstanding[item][1] <= 0:
+          del outstanding[item]
+    # The server doesn't take a quantity, send the stack again as units
+    elif line.startswith('Usage'):
+      stacks = [i for i in outstanding if outstanding[i][2]]
+      if len(stacks) == 0:
+        return
+      self.domulti = False
+      bot.domulti[self.cmd] = False
+      for item in sorted(stacks, key=lambda i: outstanding[i][0],
+                          reverse=True):
+        todo.appendleft((item, outstanding[item][1]))
+        del outstanding[item]
+    elif line.startswith(disposedhints) and len(outstanding) > 0:
+      # The reply names the item, the longest name in it, or else the oldest
+      named = [i for i in outstanding if i in line]
+      if len(named) > 0:
+        item = max(named, key=len)
+      else:
+        item = min(outstanding, key=lambda i: outstanding[i][0])
+      self.disposed += self.countoff(item)
+    elif line.startswith('I don\'t want') and len(outstanding) > 0:
+      # The refused item is named in the line, if we can't tell which it is
+      #  the oldest is counted off but not recorded as refused
+      item = refusedname(line)
+      named = item in outstanding
+      if not named:
+        item = min(outstanding, key=lambda i: outstanding[i][0])
+      self.countoff(item)
+      for queued in [q for q in todo if q[0] == item]:
+        todo.remove(queued)
+      if self.cmd == '#sell' and named:
+        bot.dontsell.refuse(item)
+    self.finishifdone()
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  dontsell.py
+#  Which items not to sell: items the store refused, and items we keep
+##
+#  Author: Chase LP
+###
+
+import os, re
+
+# Keywords of items we keep by default, an item containing one is kept
+defaultkeep = [ 'Loki', 'Quartz', 'Orchid', 'Beer', 'Wine', 'Booze',
+                'IDCard', 'Stimpatch', 'Milk', 'Ammo', 'Circuits',
+                'Coke', 'Potion', 'Pizza', 'Apple', 'Smith', 'Elixir',
+                'Bone', 'Ether', 'Moon', 'AimWater', 'Rune', 'Diamond',
+                'FirstAid', 'Hematite', 'Alcopop', 'Mandrake',
+                'ScrollOfWisdom', 'CopCap', 'EmptyBottle', 'Tenugui']
+
+# I don't want your Junk
+refusedline = re.compile(r"I don't want your (.+)")
+
+''' refusedname
+    Returns the item named in a store's refusal, or None
+'''
+def refusedname(line):
+  match = refusedline.search(line)
+  if match is None:
+    return None
+  return match.group(1).strip().rstrip('.!')
+
+''' class DontSellIndex
+    Refused items are exact names kept in the worldstore, shared between bots
+    Kept items are keywords, each item name is matched against them once
+     and the answer is remembered, so every check is a dict/set lookup
+
+    Attributes
+    worldstore    - WorldStore, where refusals are kept
+    refused       - set of item names the store refused to buy
+    keep          - list of keywords of items we keep
+    memo          - dict, item name -> whether it matches a keep keyword
+
+    Methods
+    skip          - Returns True if we shouldn't try to sell this item
+    iskept        - Returns True if the item matches a keep keyword
+    refuse        - Records that the store refused an item
+    setkeep       - Replaces the keep keywords
+    refresh       - Picks up refusals recorded by other bots
+'''
+class DontSellIndex():
+  def __init__(self, worldstore, keep=defaultkeep):
+    self.worldstore = worldstore
+    self.setkeep(keep)
+    self.refresh()
+
+  def refresh(self):
+    self.refused = set(self.worldstore.refused())
+
+  def setkeep(self, keep):
+    self.keep = list(keep)
+    self.memo = {}
+
+  def iskept(self, name):
+    kept = self.memo.get(name)
+    if kept is None:
+      kept = any(keyword in name for keyword in self.keep)
+      self.memo[name] = kept
+    return kept
+
+  def skip(self, name):
+    return name in self.refused or self.iskept(name)
+
+  def refuse(self, name):
+    if name in self.refused:
+      return
+    self.refused.add(name)
+    self.worldstore.addrefused(name)
+
+  ''' importlegacy
+      Records the refusals logged to the old 'dontsell' text file
+      The old log could name the wrong item, so a name is only taken
+       when it is the item the refusal line before it names
+      The file is renamed to filename.imported after, so this is done once
+      Returns the number of item names found
+
+      Parameters
+      filename    - string, the old log file
+  '''
+  def importlegacy(self, filename='dontsell'):
+    names = set()
+    refused = None
+    try:
+      infile = open(filename)
+    except FileNotFoundError:
+      return 0
+    with infile:
+      for line in infile:
+        if refusedname(line) is not None:
+          refused = refusedname(line)
+          continue
+        # item='DarkBow' or items[pos]='12-DarkBow(3)'
+        for name in re.findall(r"item(?:s\[pos\])?='(?:\d+-)?([^'(]+)", line):
+          if name.strip() == refused:
+            names.add(refused)
+        refused = None
+    for name in names:
+      self.refuse(name)
+    # Another bot may have imported and renamed it first, refuse is idempotent
+    try:
+      os.replace(filename, filename + '.imported')
+    except OSError:
+      pass
+    return len(names)
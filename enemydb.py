@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  enemydb.py
+#  An on-disk SQLite index of what we have learned about each enemy type
+##
+#  Author: Chase LP
+###
+
+import sys, time, sqlite3, threading
+
+''' class EnemyDB
+    Attributes
+    filename      - string, the SQLite database file
+    db            - the sqlite3 connection
+    lock          - a lock, the bot thread records while the menu thread reports
+
+    Methods
+    record        - Adds the statistics of one killed enemy
+    stats         - Returns the per-kill averages for an enemy name
+    priority      - Returns a target priority for an enemy name, or None
+    report        - Returns the most profitable enemies per minute of combat
+    printreport   - Prints the report
+'''
+class EnemyDB():
+  def __init__(self, filename='enemies.db'):
+    self.filename = filename
+    self.lock = threading.Lock()
+    # The bot thread records kills, the menu thread may print a report
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    # Each column other than name / lastseen is a sum over all kills
+    self.db.execute('''CREATE TABLE IF NOT EXISTS enemies (
+                        name     TEXT PRIMARY KEY,
+                        kills    INTEGER NOT NULL DEFAULT 0,
+                        hp       REAL NOT NULL DEFAULT 0,
+                        hurt     REAL NOT NULL DEFAULT 0,
+                        ttk      REAL NOT NULL DEFAULT 0,
+                        loot     REAL NOT NULL DEFAULT 0,
+                        xp       REAL NOT NULL DEFAULT 0,
+                        lastseen REAL NOT NULL DEFAULT 0)''')
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  ''' record
+      Adds the statistics of one killed enemy
+
+      Parameters
+      name        - string, the enemy name, e.g., 'FatOrk'
+      hp          - float, damage we dealt to it until it died
+      hurt        - float, damage it dealt to our party
+      ttk         - float, seconds from our first attack on it until it died
+      loot        - float, nuyen looted from the kill
+      xp          - float, XP from the kill
+  '''
+  def record(self, name, hp=0, hurt=0, ttk=0, loot=0, xp=0):
+    with self.lock:
+      self.db.execute('''INSERT INTO enemies
+                          (name, kills, hp, hurt, ttk, loot, xp, lastseen)
+                          VALUES (?, 1, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT(name) DO UPDATE SET
+                          kills=kills+1, hp=hp+excluded.hp,
+                          hurt=hurt+excluded.hurt, ttk=ttk+excluded.ttk,
+                          loot=loot+excluded.loot, xp=xp+excluded.xp,
+                          lastseen=excluded.lastseen''',
+                      (name, hp, hurt, ttk, loot, xp, time.time()))
+      self.db.commit()
+
+  ''' stats
+      Returns a dict with kills and the per-kill averages, or None
+
+      Parameters
+      name        - string, the enemy name
+  '''
+  def stats(self, name):
+    with self.lock:
+      row = self.db.execute('''SELECT kills, hp/kills, hurt/kills, ttk/kills,
+                                loot/kills, xp/kills FROM enemies
+                                WHERE name=? AND kills>0''', (name,)).fetchone()
+    if row is None:
+      return None
+    return dict(zip(('kills','hp','hurt','ttk','loot','xp'), row))
+
+  ''' priority
+      Returns a priority to attack this enemy first, higher is more urgent
+      The priority is the damage it deals per second over its time to kill,
+       so the enemies that hurt us the most and die quickest go first
+      Returns None if we haven't killed one of these yet
+
+      Parameters
+      name        - string, the enemy name
+  '''
+  def priority(self, name):
+    stats = self.stats(name)
+    if stats is None:
+      return None
+    ttk = max(stats['ttk'], 1)
+    return (stats['hurt'] / ttk) / ttk
+
+  ''' report
+      Returns a list of (name, kills, ttk, nuyen/min, xp/min, hurt)
+       sorted by the most nuyen per minute of combat
+
+      Parameters
+      limit       - integer, the number of enemies to return
+  '''
+  def report(self, limit=10):
+    with self.lock:
+      rows = self.db.execute('''SELECT name, kills, ttk/kills,
+                                 60*loot/MAX(ttk,1), 60*xp/MAX(ttk,1),
+                                 hurt/kills FROM enemies WHERE kills>0
+                                 ORDER BY 60*loot/MAX(ttk,1) DESC LIMIT ?''',
+                              (limit,)).fetchall()
+    return rows
+
+  def printreport(self, limit=10, printfn=print):
+    rows = self.report(limit)
+    if len(rows) == 0:
+      printfn(' ~ No enemies recorded yet')
+      return
+    printfn(' ~ %-20s %6s %7s %9s %8s %7s' % \
+            ('Enemy','Kills','TTK(s)','$/min','XP/min','Hurt'))
+    for row in rows:
+      printfn(' ~ %-20s %6d %7.1f %9.2f %8.2f %7.1f' % row)
+
+if __name__ == '__main__':
+  enemydb = EnemyDB(sys.argv[1] if len(sys.argv) > 1 else 'enemies.db')
+  enemydb.printreport(limit=int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+  enemydb.close()
@@ -0,0 +1,346 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  fight.py
+#  One combat, fed a line at a time, so handlecombat can wait for it
+#   and a state machine can run it without blocking
+##
+#  Author: Chase LP
+###
+
+import re, time
+
+#                     1-Killer[8023221](-8.0m)(L17(34))[H]
+enemypart = re.compile(r'(\d+)-([^\[ ]+[ ]?[^\[ ]*)\[\d+\]\(([-]?[\d\.]+)m\)\(L(\d+)')
+# Only need to match one of these (beginning of line match)
+#                              1-chaseleif{57}
+friendlyattack = re.compile(r'\d+-[\S]+{')
+#                             7-DarkElve[8023234]
+hostileaction = re.compile(r'\d+-[\S]+\[\d+\]')
+
+# Seconds between calms while we are above half health
+calmcastgap = 90
+
+class ShadowEnemy():
+  def __init__(self,num,name,pos,lvl):
+    self.num = num
+    self.name = name
+    self.pos = pos
+    self.lvl = lvl
+    self.damage = 0 # damage our party dealt to it
+    self.hurt = 0   # damage it dealt to our party
+    self.firstattack = None # time our party first attacked it
+  def __str__(self):
+    return f' ~ Enemy {self.num}) {self.name} L{self.lvl} at {self.pos}m'
+
+''' class Fight
+    A combat from the encounter until "You continue"
+    * This currently requires the calm spell for healing *
+    Any special combat actions go here
+
+    Attributes
+    bot           - ShadowThread, whose party is fighting
+    encounter     - string, the encounter line, joined while it ends with ','
+    enemies       - dict, number -> ShadowEnemy
+    priority      - dict, enemy name -> priority from the enemydb
+    havetarget    - None, or the number of the enemy we attack
+    mypos         - our position
+    fightstart    - time the fight started
+    calmcasttime  - time of our last calm
+    done          - True once the fight is over
+    line          - the line that ended the fight
+
+    Methods
+    feed          - Handles a stripped Lamb message
+    poll          - Sends a queued combat command once we are free
+    deadline      - Returns when poll has something to do, or None
+'''
+class Fight():
+  name = 'combat'
+
+  ''' init
+      Parameters
+      bot         - ShadowThread
+      line        - string, the message with 'You ENCOUNTER' or 'are fighting'
+  '''
+  def __init__(self, bot, line):
+    self.bot = bot
+    self.encounter = line
+    self.enemies = {}
+    self.priority = {}
+    self.havetarget = None
+    self.mypos = 1
+    self.fightstart = time.time()
+    self.calmcasttime = 0
+    self.done = False
+    self.line = ''
+    # If we had a message that we had time remaining
+    if time.time() < bot.remaining:
+      bot.print(bot.untilaction,
+                f'{int((bot.remaining-time.time())/60)}m',
+                f'{int((bot.remaining-time.time())%60)}s remaining')
+      bot.freezetime = time.time()
+    else:
+      bot.freezetime = None
+    bot.incombat = True
+    # Our actor key, for the busy times in combat lines
+    bot.combatq.me = bot.irc.username+'{'+bot.server+'}'
+    bot.combatq.clear()
+    self.myaction = re.compile(r'\d+-'+bot.irc.username+r'\{'+bot.server+r'\}')
+    if not self.joining():
+      self.start()
+
+  ''' joining
+      Returns True while the encounter line continues on the next line
+  '''
+  def joining(self):
+    return self.encounter.startswith('You ENCOUNTER') and self.encounter.endswith(',')
+
+  ''' start
+      Finds the enemies in the encounter and picks the first target
+  '''
+  def start(self):
+    bot = self.bot
+    for part in enemypart.findall(self.encounter):
+      num = int(part[0])
+      self.enemies[num] = ShadowEnemy(num, part[1], float(part[2]), int(part[3]))
+    # What the enemy knowledge base says about each enemy type in this fight
+    if bot.targetdb:
+      for name in set(enemy.name for enemy in self.enemies.values()):
+        self.priority[name] = bot.enemydb.priority(name)
+    if len(self.enemies) > 1:
+      self.havetarget = self.picktarget()
+    self.printenemies()
+    # havetarget should be set
+    if self.havetarget is not None and len(self.enemies) > 1:
+      bot.combatq.schedule('#attack ' + str(self.havetarget))
+
+  def printenemies(self):
+    for enemy in self.enemies:
+      self.bot.print(self.enemies[enemy])
+
+  ''' dotarget
+      Returns True if we should prefer the level of x over y
+  '''
+  def dotarget(self, x, y):
+    if self.bot.attacklow:
+      return x < y
+    return x > y
+
+  ''' picktarget
+      Returns the number of the enemy to attack
+      Drones first, then by the enemy knowledge base if it knows all of them,
+       otherwise by level, ties are broken by the distance from us
+  '''
+  def picktarget(self):
+    enemies, mypos = self.enemies, self.mypos
+    target = None
+    for enemy in enemies:
+      if 'Drone' not in enemies[enemy].name: continue
+      if target is None or \
+          abs(mypos-enemies[enemy].pos) < abs(mypos-enemies[target].pos):
+        target = enemy
+    if target is not None:
+      return target
+    if len(self.priority) > 0 and \
+        all(self.priority.get(enemies[enemy].name) is not None for enemy in enemies):
+      return max(enemies, key=lambda e: (self.priority[enemies[e].name],
+                                          -abs(mypos-enemies[e].pos)))
+    targetlvl = 0
+    for enemy in enemies:
+      if target is None:
+        targetlvl = enemies[enemy].lvl
+        target = enemy
+      elif self.dotarget(enemies[enemy].lvl, targetlvl):
+        targetlvl = enemies[enemy].lvl
+        target = enemy
+      elif enemies[enemy].lvl == targetlvl \
+            and abs(mypos-enemies[enemy].pos) < abs(mypos-enemies[target].pos):
+        target = enemy
+    return target
+
+  def poll(self):
+    for cmd in self.bot.combatq.due():
+      self.bot.irc.privmsg(self.bot.lambbot, cmd, delay=0)
+
+  ''' deadline
+      Returns the time we become free to send a queued command, or None
+  '''
+  def deadline(self):
+    wait = self.bot.combatq.nextdue()
+    return None if wait is None else time.time() + wait
+
+  ''' finish
+      Ends the fight on the line that ended it
+  '''
+  def finish(self, line):
+    # Anything still queued is stale after combat
+    self.bot.combatq.clear()
+    self.bot.incombat = False
+    self.bot.metrics.combat.observe(time.time() - self.fightstart)
+    self.done = True
+    self.line = line
+
+  ''' feed
+      Handles a stripped Lamb message, raises an Exception if we died
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def feed(self, line):
+    if self.done or line == '':
+      return
+    if self.joining():
+      self.encounter += ' ' + line
+      if not self.joining():
+        self.start()
+      return
+    bot, enemies = self.bot, self.enemies
+    # Track our and everyone else's "N seconds busy"
+    bot.combatq.observe(line)
+    # observe has set when we arrive from any time remaining
+    if 'You continue' in line:
+      self.finish(line)
+      return
+    # The line starts with our player
+    if self.myaction.match(line):
+      action = line[self.myaction.match(line).span()[1]+1:]
+      # We are moving
+      if action.startswith('moves'):
+        # Our current position
+        self.mypos = float(action.split('position')[1].split()[0])
+        return
+      # A calm was cast which did nothing, do a heal
+      if line.startswith('casts') and '+0HP for' in line:
+        target = line.split('.')[1].split(' ')[-1]
+        bot.combatq.schedule('#cast heal ' + target, 'spell', 2)
+        return
+    # The line starts with an enemy
+    elif hostileaction.match(line):
+      action = line[hostileaction.match(line).span()[1]+1:]
+      if action.startswith('moves'):
+        try:
+          enemy = int(hostileaction.search(line)[0].split('-')[0])
+          enemies[enemy].pos = float(action.split('position')[1].split()[0])
+        except:
+          pass
+        return
+    # An attack was made but it missed
+    if 'misses' in line: pass
+    # Combat
+    elif 'attacks' in line:
+      # Friendly attack
+      if friendlyattack.match(line):
+        self.friendlyattack(line)
+      # An enemy attacked
+      else:
+        self.hostileattack(line)
+
+  def friendlyattack(self, line):
+    bot, enemies = self.bot, self.enemies
+    try:
+      num = int(line.split('attacks ')[1].split('-')[0].strip())
+    except ValueError:
+      num = None
+    if num in enemies and enemies[num].firstattack is None:
+      enemies[num].firstattack = time.time()
+    damage = re.search(r'caused ([\d.]+) damage', line)
+    if damage and num in enemies:
+      enemies[num].damage += float(damage.group(1))
+    # We killed an enemy
+    if 'killed them' not in line:
+      return
+    bot.metrics.kills.inc()
+    loot = xp = 0
+    if 'You loot' in line:
+      loot = line.split('loot')[1].lstrip()
+      xp = float(loot.split()[-1][:-2])
+      loot = float(loot.split('$')[0])
+      bot.lootmoney += loot
+      bot.lootxp += xp
+      bot.metrics.lootnuyen.inc(loot)
+      bot.metrics.lootxp.inc(xp)
+      if bot.stats is not None:
+        bot.stats.loot(bot.lootmoney, bot.lootxp)
+    # If we didn't fill out the enemies dict
+    if num not in enemies:
+      return
+    bot.enemydb.record(enemies[num].name, hp=enemies[num].damage,
+                       hurt=enemies[num].hurt,
+                       ttk=time.time()-enemies[num].firstattack, loot=loot, xp=xp)
+    del(enemies[num])
+    self.printenemies()
+    # it wasn't us that killed the enemy . . .
+    if bot.irc.username+'{'+bot.server+'}' not in line:
+      if self.havetarget is None or self.havetarget != num:
+        return
+    # No need to explicitly set an enemy if there aren't multiple
+    if len(enemies) < 2:
+      return
+    self.havetarget = self.picktarget()
+    if self.havetarget is not None:
+      bot.combatq.schedule('#attack ' + str(self.havetarget))
+
+  def hostileattack(self, line):
+    bot, enemies = self.bot, self.enemies
+    # uh oh
+    if 'killed' in line:
+      raise Exception('Player died')
+    # Remember how much this enemy hurt us
+    damage = re.search(r'caused ([\d.]+) damage', line)
+    try:
+      num = int(line.split('-')[0])
+      if damage and num in enemies:
+        enemies[num].hurt += float(damage.group(1))
+    except ValueError:
+      pass
+    # Add some logic for using potions / first aid (?)
+    if not bot.cancast:
+      return
+    # The roster has the latest HP of everyone in the party
+    member = bot.roster.mosturgent()
+    if member is not None:
+      player = member.pos if member.pos is not None else member.name
+      health = member.health()
+    else:
+      player = line.split('-')[1].split(' ')[-1]
+      # "68.7/72.6"
+      health = line.split(', ')[1].split('HP')[0]
+      numerator = health.split('/')[0]
+      denominator = health.split('/')[1]
+      health = float(numerator)/float(denominator)
+    doheal = False
+    docalm = False
+    # Less than 30% health
+    if health < 0.3:
+      doheal = True
+    # Less than 50% health
+    elif health < 0.5:
+      docalm = True
+    # Less than 80% health
+    elif health < 0.8 and (time.time() - self.calmcasttime) > calmcastgap:
+      docalm = True
+    # A heal replaces a queued calm, a calm won't replace a queued heal
+    if doheal:
+      bot.combatq.schedule('#cast heal ' + player, 'spell', 2)
+    elif docalm:
+      if bot.combatq.schedule('#cast calm ' + player, 'spell', 1):
+        self.calmcasttime = time.time()
@@ -0,0 +1,396 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  fleet.py
+#  Runs many accounts headless across a pool of worker processes,
+#   restarting crashed bots and workers, with their loot totalled here
+##
+#  Author: Chase LP
+###
+
+'''
+    fleet.py fleet.json [--workers N] [--report SECONDS]
+
+    A fleet file is a JSON object
+    {"workers": 4,                      - Worker processes, the number of cores by default
+     "defaults": {"doloop": "explore"}, - Given to every bot, each bot's own keys win
+     "control": "/run/shadowbot",       - Optional, a directory for the control sockets
+     "metrics": 9100,                   - Optional, worker N serves metrics on this port + N
+     "bots": [{"passfile": "pass1"},    - One startbot.py config per account
+              {"passfile": "pass2", "invstop": 12}]}
+
+    Bots are dealt to the workers in turn, several bots share a process
+    Each worker writes what its bots print to fleet-N.log
+    With "control" each worker serves its bots' JSON control API on
+     fleet-N.sock in that directory, see controlapi.py
+    Ctrl-c or SIGTERM lets every bot finish its current activity and quit,
+     a second ctrl-c kills the workers
+'''
+
+import os, sys, json, time, queue, signal, argparse
+import multiprocessing
+import startbot
+from fleetstats import StatsBlock
+from controlapi import ControlServer
+import metrics
+
+# Seconds between status reports from a worker
+interval = 10
+# Seconds without a report before a worker is taken as hung and restarted
+stalled = 120
+# Seconds waited before a restart, doubled for each crash in a row up to the most
+backoff = 5
+maxbackoff = 300
+# Seconds a bot or worker must run before its crashes stop counting as in a row
+healthy = 600
+
+''' botstatus
+    Returns a dict with what the parent reports about a bot
+'''
+def botstatus(thread):
+  return {'nick':thread.irc.username,
+          'doloop':thread.doloop,
+          'alive':thread.th.is_alive(),
+          'lootmoney':thread.lootmoney,
+          'lootxp':thread.lootxp,
+          'nuyen':thread.charstate.nuyen,
+          'level':thread.charstate.level,
+          'time':time.time()}
+
+''' class Restarter
+    Backoff for something restarted when it crashes
+
+    Attributes
+    delay         - seconds to wait before the next start
+    started       - time of the last start
+    restarts      - number of restarts
+'''
+class Restarter():
+  def __init__(self):
+    self.delay = 0
+    self.started = 0
+    self.restarts = 0
+
+  def start(self):
+    self.started = time.time()
+
+  ''' crashed
+      Returns the time the next start is due
+  '''
+  def crashed(self):
+    self.restarts += 1
+    if time.time() - self.started >= healthy:
+      self.delay = backoff
+    else:
+      self.delay = min(maxbackoff, max(backoff, self.delay * 2))
+    return time.time() + self.delay
+
+''' class WorkerBot
+    A bot run by a worker, connected again when its thread dies
+
+    Attributes
+    spec          - dict, the bot's startbot config
+    nick          - string, the account's username
+    stats         - (StatsBlock, index), the bot's slot in the fleet's stats
+    thread        - None, or its ShadowThread
+    restarter     - Restarter
+    due           - the time to (re)connect, None while connected
+'''
+class WorkerBot():
+  def __init__(self, spec, stats):
+    self.spec = spec
+    self.stats = stats
+    self.nick = startbot.loadspec(spec)[0]['username']
+    self.thread = None
+    self.restarter = Restarter()
+    self.due = 0
+
+  def connect(self):
+    self.restarter.start()
+    self.due = None
+    try:
+      account, doloop, config = startbot.loadspec(self.spec)
+      self.thread = startbot.connect(account, config)
+      del account
+      block, index = self.stats
+      self.thread.control('stats', block.slot(index, self.nick))
+      if doloop is not None:
+        startbot.startloop(self.thread, doloop)
+    except Exception as e:
+      print(f'| Can\'t start {self.nick}: {e}', flush=True)
+      self.thread = None
+      self.due = self.restarter.crashed()
+
+  def check(self):
+    if self.thread is not None and not self.thread.th.is_alive():
+      metrics.botmetrics(self.nick).reconnects.inc()
+      print(f'| {self.nick} stopped, restarting', flush=True)
+      # Close the dead bot's connection now, not whenever it is collected,
+      #  so it is gone before we connect again
+      self.thread.irc.close()
+      self.thread = None
+      self.due = self.restarter.crashed()
+    if self.due is not None and time.time() >= self.due:
+      self.connect()
+
+  def status(self):
+    if self.thread is None:
+      return {'nick':self.nick, 'alive':False, 'time':time.time(),
+              'restarts':self.restarter.restarts}
+    status = botstatus(self.thread)
+    status['restarts'] = self.restarter.restarts
+    return status
+
+''' worker
+    The function of a worker process, runs its bots until stop is set
+
+    Parameters
+    index         - integer, the worker's number
+    specs         - list of (slot, spec), a stats slot and startbot config for each bot
+    statsname     - string, the fleet's StatsBlock
+    control       - None, or the directory for the worker's control socket
+    metricsport   - None, or the port the worker serves its metrics on
+    statusq       - multiprocessing.Queue, gets (index, list of botstatus)
+    stop          - multiprocessing.Event, set when the fleet quits
+'''
+def worker(index, specs, statsname, control, metricsport, statusq, stop):
+  # Ctrl-c is for the parent, which sets stop
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+  sys.stdout = open(f'fleet-{index}.log', 'a', buffering=1)
+  sys.stderr = sys.stdout
+  # Forked from the fleet, we share its resource tracker
+  block = StatsBlock.attach(statsname, untrack=False)
+  bots = [WorkerBot(spec, (block, slot)) for slot, spec in specs]
+  if metricsport is not None:
+    metrics.serve(metricsport)
+  server = None
+  if control is not None:
+    server = ControlServer(os.path.join(control, f'fleet-{index}.sock'),
+                           lambda: {bot.nick:bot.thread for bot in bots
+                                                        if bot.thread is not None})
+  while not stop.is_set():
+    for bot in bots:
+      bot.check()
+    statusq.put((index, [bot.status() for bot in bots]))
+    stop.wait(interval)
+  threads = [bot.thread for bot in bots if bot.thread is not None]
+  for thread in threads:
+    thread.control('doloop', None)
+    thread.control('softquit', True)
+  for thread in threads:
+    thread.th.join()
+  statusq.put((index, [bot.status() for bot in bots]))
+  block.close()
+  if server is not None:
+    server.close()
+
+''' class Fleet
+    Starts the worker processes and restarts those that die or hang,
+     keeping the last status of every bot
+
+    Attributes
+    groups        - list of lists of (slot, spec), one for each worker
+    block         - StatsBlock, a stats slot for every bot in shared memory
+    processes     - list of multiprocessing.Process, None while waiting to restart
+    restarters    - list of Restarter, one for each worker
+    due           - list of the time each dead worker is restarted
+    heard         - list of the time each worker last reported
+    bots          - dict, nick -> its last botstatus
+    banked        - dict, nick -> (nuyen, xp) looted before its last restart
+    control       - None, or the directory for the workers' control sockets
+    metricsport   - None, or the port of worker 0's metrics, worker N's is N above
+    statusq       - multiprocessing.Queue, from the workers
+    stop          - multiprocessing.Event, set to quit every worker
+
+    Methods
+    start         - Starts a worker process
+    supervise     - Collects reports and restarts workers until stop is set
+    report        - Returns the fleet's totals and each bot as a string
+    shutdown      - Lets every bot finish and joins the workers
+'''
+class Fleet():
+  def __init__(self, specs, workers=None, control=None, metricsport=None):
+    workers = min(workers or os.cpu_count() or 1, len(specs))
+    self.block = StatsBlock.create(len(specs))
+    specs = list(enumerate(specs))
+    self.groups = [specs[index::workers] for index in range(workers)]
+    self.processes = [None] * workers
+    self.restarters = [Restarter() for _ in range(workers)]
+    self.due = [0] * workers
+    self.heard = [0] * workers
+    self.bots = {}
+    self.banked = {}
+    self.started = time.time()
+    self.control = control
+    self.metricsport = metricsport
+    self.statusq = multiprocessing.Queue()
+    self.stop = multiprocessing.Event()
+
+  def start(self, index):
+    process = multiprocessing.Process(target=worker, name=f'fleet-{index}',
+                    args=(index, self.groups[index], self.block.name,
+                          self.control,
+                          None if self.metricsport is None else self.metricsport + index,
+                          self.statusq, self.stop))
+    process.start()
+    self.processes[index] = process
+    self.restarters[index].start()
+    self.heard[index] = time.time()
+    self.due[index] = None
+
+  ''' collect
+      Keeps the statuses from a worker's report
+  '''
+  def collect(self, index, statuses):
+    self.heard[index] = time.time()
+    for status in statuses:
+      status['worker'] = index
+      nick = status['nick']
+      last = self.bots.get(nick)
+      if 'lootmoney' not in status:
+        # A bot that's down keeps its last loot until it reports again
+        self.bots[nick] = status if last is None else \
+                          dict(last, alive=False, time=status['time'],
+                               restarts=status['restarts'])
+        continue
+      # A restarted bot counts its loot from zero again
+      if last is not None and last.get('lootmoney', 0) > status['lootmoney']:
+        money, xp = self.banked.get(nick, (0, 0))
+        self.banked[nick] = (money + last['lootmoney'], xp + last['lootxp'])
+      self.bots[nick] = status
+
+  def check(self):
+    now = time.time()
+    for index, process in enumerate(self.processes):
+      if process is not None:
+        hung = now - self.heard[index] > stalled
+        if process.is_alive() and not hung:
+          continue
+        if hung and process.is_alive():
+          print(f'| Worker {index} stopped reporting, restarting it')
+          process.terminate()
+        else:
+          print(f'| Worker {index} exited with {process.exitcode}, restarting it')
+        process.join()
+        self.processes[index] = None
+        self.due[index] = self.restarters[index].crashed()
+      if self.due[index] is not None and now >= self.due[index]:
+        self.start(index)
+
+  def supervise(self, reportevery=60):
+    print(f'| Stats are in shared memory, see ./fleetstats.py {self.block.name}')
+    for index in range(len(self.groups)):
+      self.start(index)
+    nextreport = time.time() + reportevery
+    while not self.stop.is_set():
+      try:
+        self.collect(*self.statusq.get(timeout=1))
+      except queue.Empty:
+        pass
+      self.check()
+      if time.time() >= nextreport:
+        print(self.report())
+        nextreport = time.time() + reportevery
+
+  ''' loot
+      Returns the (nuyen, xp) a bot has looted since the fleet started
+  '''
+  def loot(self, nick):
+    money, xp = self.banked.get(nick, (0, 0))
+    status = self.bots.get(nick, {})
+    return money + status.get('lootmoney', 0), xp + status.get('lootxp', 0)
+
+  def report(self):
+    hours = max(time.time() - self.started, 1) / 3600
+    lines = [' ___', f'| Fleet: {len(self.bots)} bots in {len(self.groups)} workers,'
+             + f' {sum(restarter.restarts for restarter in self.restarters)} worker restarts']
+    totalmoney = totalxp = 0
+    for nick in sorted(self.bots):
+      status = self.bots[nick]
+      money, xp = self.loot(nick)
+      totalmoney += money
+      totalxp += xp
+      state = status.get('doloop') if status.get('alive') else 'down'
+      lines.append(f'| {nick:16} w{status["worker"]} {str(state):12}'
+                   + f' ${money:10.2f} {xp:8.2f}XP  L{status.get("level") or "?"}'
+                   + f'  {status.get("restarts", 0)} restarts')
+    lines.append(f'| Total ${totalmoney:.2f} (${totalmoney/hours:.2f}/hour),'
+                 + f' {totalxp:.2f}XP ({totalxp/hours:.2f}/hour)')
+    return '\n'.join(lines)
+
+  def shutdown(self):
+    self.stop.set()
+    print('| Letting every bot finish its current activity, ctrl-c again to kill . . .')
+    try:
+      for process in self.processes:
+        if process is not None:
+          process.join()
+    except KeyboardInterrupt:
+      for process in self.processes:
+        if process is not None:
+          process.kill()
+          process.join()
+    # The last reports from the workers
+    while True:
+      try:
+        self.collect(*self.statusq.get_nowait())
+      except queue.Empty:
+        break
+    print(self.report())
+    self.block.close()
+
+''' loadfleet
+    Returns (specs, workers, control, metricsport) from a fleet file,
+     each spec with the defaults
+'''
+def loadfleet(filename):
+  with open(filename) as infile:
+    fleet = json.load(infile)
+  defaults = fleet.get('defaults', {})
+  specs = [dict(defaults, **spec) for spec in fleet['bots']]
+  # Check every spec before starting anything
+  for spec in specs:
+    if 'username' not in startbot.loadspec(spec)[0]:
+      raise ValueError(f'No account for {spec}')
+  return specs, fleet.get('workers'), fleet.get('control'), fleet.get('metrics')
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Runs many bots in worker processes')
+  parser.add_argument('fleetfile', help='a JSON file with the bots to run')
+  parser.add_argument('--workers', type=int, help='the number of worker processes')
+  parser.add_argument('--report', type=float, default=60,
+                      help='seconds between reports')
+  args = parser.parse_args(argv)
+  try:
+    specs, workers, control, metricsport = loadfleet(args.fleetfile)
+  except (OSError, ValueError, KeyError, IndexError) as e:
+    sys.exit(f'| {e}')
+  fleet = Fleet(specs, args.workers or workers, control, metricsport)
+  signal.signal(signal.SIGTERM, lambda signum, frame: fleet.stop.set())
+  try:
+    fleet.supervise(args.report)
+  except KeyboardInterrupt:
+    pass
+  fleet.shutdown()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
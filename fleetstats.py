@@ -0,0 +1,239 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  fleetstats.py
+#  A block of shared memory with a fixed-layout slot of stats for each bot,
+#   written without locks by the bot and read by anyone on the host
+##
+#  Author: Chase LP
+###
+
+'''
+    fleetstats.py NAME [--every SECONDS]    - Prints the stats in a block
+
+    Every slot has one writer, its bot, so a seqlock is enough:
+     the writer makes the sequence odd, writes the fields and makes it even again,
+     a reader copies the slot and tries again if the sequence was odd or changed
+'''
+
+import os, sys, time, struct, argparse
+from multiprocessing import shared_memory, resource_tracker
+
+# The block starts with a header: magic, layout version, number of slots
+header = struct.Struct('<4sII')
+magic = b'SBST'
+version = 1
+
+# sequence, pid, nick, doloop, started, updated, lootmoney, lootxp,
+#  iterations, lastiter, totaliter, maxiter, errors, restarts
+slotlayout = struct.Struct('<Qi32s16sddddQdddQQ')
+sequence = struct.Struct('<Q')
+fields = ['pid', 'nick', 'doloop', 'started', 'updated', 'lootmoney', 'lootxp',
+          'iterations', 'lastiter', 'totaliter', 'maxiter', 'errors', 'restarts']
+# The fields after the sequence
+record = struct.Struct('<' + slotlayout.format[2:])
+
+''' class StatsBlock
+    Attributes
+    shm           - multiprocessing.shared_memory.SharedMemory
+    nslots        - number of slots
+    owner         - True if we created it, and unlink it when closed
+
+    Methods
+    create        - Returns a new block with a number of slots
+    attach        - Returns an existing block by name
+    slot          - Returns the StatsSlot a bot writes to
+    read          - Returns a slot's stats as a dict, None for an unused slot
+    readall       - Returns the stats of every used slot
+    close         - Detaches, and removes the block if we created it
+'''
+class StatsBlock():
+  def __init__(self, shm, owner):
+    self.shm = shm
+    self.owner = owner
+    tag, layout, self.nslots = header.unpack_from(shm.buf, 0)
+    if tag != magic or layout != version:
+      raise ValueError(f'{shm.name} is not a version {version} stats block')
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  @classmethod
+  def create(cls, nslots, name=None):
+    shm = shared_memory.SharedMemory(name=name, create=True,
+                                     size=header.size + nslots * slotlayout.size)
+    shm.buf[:shm.size] = bytes(shm.size)
+    header.pack_into(shm.buf, 0, magic, version, nslots)
+    return cls(shm, True)
+
+  ''' attach
+      untrack is for a process with its own resource tracker, which would
+       otherwise remove the block when the process exits
+      Processes forked from the creator share its tracker and leave it be
+  '''
+  @classmethod
+  def attach(cls, name, untrack=True):
+    shm = shared_memory.SharedMemory(name=name)
+    if untrack:
+      resource_tracker.unregister(shm._name, 'shared_memory')
+    return cls(shm, False)
+
+  def offset(self, index):
+    if not 0 <= index < self.nslots:
+      raise IndexError(f'slot {index} of {self.nslots}')
+    return header.size + index * slotlayout.size
+
+  def slot(self, index, nick):
+    return StatsSlot(self, index, nick)
+
+  def read(self, index):
+    offset = self.offset(index)
+    while True:
+      before, = sequence.unpack_from(self.shm.buf, offset)
+      if before % 2 == 1:
+        time.sleep(0)
+        continue
+      data = bytes(self.shm.buf[offset:offset + slotlayout.size])
+      after, = sequence.unpack_from(self.shm.buf, offset)
+      if before == after:
+        break
+    if before == 0:
+      return None
+    stats = dict(zip(fields, slotlayout.unpack(data)[1:]))
+    stats['nick'] = stats['nick'].rstrip(b'\0').decode(errors='replace')
+    stats['doloop'] = stats['doloop'].rstrip(b'\0').decode(errors='replace')
+    return stats
+
+  def readall(self):
+    stats = (self.read(index) for index in range(self.nslots))
+    return [entry for entry in stats if entry is not None]
+
+  def close(self):
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+
+''' class StatsSlot
+    A bot's slot, only the bot writes to it
+    A bot restarted in the same slot carries on from the totals already there
+
+    Attributes
+    block         - StatsBlock
+    offset        - the slot's offset in the block
+    values        - dict, the fields as last written
+    base          - (lootmoney, lootxp) from before the bot was restarted
+
+    Methods
+    write         - Sets some fields, with updated set to now
+    iteration     - Counts a finished loop iteration, with its seconds
+    error         - Counts an exception
+'''
+class StatsSlot():
+  def __init__(self, block, index, nick):
+    self.block = block
+    self.offset = block.offset(index)
+    last = block.read(index)
+    if last is None:
+      last = dict.fromkeys(fields, 0)
+      last['started'] = time.time()
+    else:
+      last['restarts'] += 1
+    self.base = (last['lootmoney'], last['lootxp'])
+    self.values = last
+    self.write(nick=nick, pid=os.getpid())
+
+  def write(self, **changes):
+    self.values.update(changes)
+    self.values['updated'] = time.time()
+    values = dict(self.values)
+    values['nick'] = str(values['nick']).encode()[:32]
+    values['doloop'] = str(values['doloop'] or '').encode()[:16]
+    buf = self.block.shm.buf
+    current, = sequence.unpack_from(buf, self.offset)
+    sequence.pack_into(buf, self.offset, current + 1)
+    record.pack_into(buf, self.offset + sequence.size,
+                     *[values[field] for field in fields])
+    sequence.pack_into(buf, self.offset, current + 2)
+
+  ''' loot
+      Sets the loot, the bot's totals since it started
+  '''
+  def loot(self, lootmoney, lootxp):
+    self.write(lootmoney=self.base[0] + lootmoney, lootxp=self.base[1] + lootxp)
+
+  def iteration(self, seconds, doloop):
+    self.write(iterations=self.values['iterations'] + 1, lastiter=seconds,
+               totaliter=self.values['totaliter'] + seconds,
+               maxiter=max(self.values['maxiter'], seconds), doloop=doloop)
+
+  def error(self):
+    self.write(errors=self.values['errors'] + 1)
+
+''' report
+    Returns the stats of every bot and the fleet's totals as a string
+'''
+def report(stats):
+  now = time.time()
+  lines = [' ___', f'| {"nick":16} {"loop":12} {"nuyen/h":>10} {"XP/h":>8}'
+           + f' {"iters":>6} {"mean":>6} {"max":>6} {"errors":>6} {"restarts":>8}']
+  totals = {'money':0, 'xp':0, 'moneyrate':0, 'xprate':0, 'iterations':0,
+            'totaliter':0, 'errors':0}
+  for entry in sorted(stats, key=lambda entry: entry['nick']):
+    hours = max(now - entry['started'], 60) / 3600
+    moneyrate, xprate = entry['lootmoney'] / hours, entry['lootxp'] / hours
+    mean = entry['totaliter'] / entry['iterations'] if entry['iterations'] else 0
+    lines.append(f'| {entry["nick"]:16} {entry["doloop"]:12} {moneyrate:10.2f}'
+                 + f' {xprate:8.2f} {entry["iterations"]:6} {mean:6.0f}'
+                 + f' {entry["maxiter"]:6.0f} {entry["errors"]:6} {entry["restarts"]:8}')
+    totals['money'] += entry['lootmoney']
+    totals['xp'] += entry['lootxp']
+    totals['moneyrate'] += moneyrate
+    totals['xprate'] += xprate
+    totals['iterations'] += entry['iterations']
+    totals['totaliter'] += entry['totaliter']
+    totals['errors'] += entry['errors']
+  mean = totals['totaliter'] / totals['iterations'] if totals['iterations'] else 0
+  lines.append(f'| {len(stats)} bots: ${totals["money"]:.2f}'
+               + f' (${totals["moneyrate"]:.2f}/hour), {totals["xp"]:.2f}XP'
+               + f' ({totals["xprate"]:.2f}/hour), {totals["iterations"]} iterations'
+               + f' ({mean:.0f}s mean), {totals["errors"]} errors')
+  return '\n'.join(lines)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Prints the stats of a fleet')
+  parser.add_argument('name', help='the shared memory block, printed by fleet.py')
+  parser.add_argument('--every', type=float, help='print again every so many seconds')
+  args = parser.parse_args()
+  try:
+    block = StatsBlock.attach(args.name)
+  except (FileNotFoundError, ValueError) as e:
+    sys.exit(f'| {e}')
+  try:
+    while True:
+      print(report(block.readall()))
+      if args.every is None:
+        break
+      time.sleep(args.every)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    block.close()
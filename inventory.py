@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  inventory.py
+#  An inventory index kept up to date from passive messages
+##
+#  Author: Chase LP
+###
+
+import re, time
+
+# You sold 1 of your DarkBow for 56.63$. You now carry 25.85kg/45.19kg
+# You put 1 of your ID4Card into your bank account. You now carry 25.22kg/45.19kg
+removed = re.compile(r'You (?:sold|put) (\d+) of your (\S+?)(?: for | into )')
+# You found 2xBacon, You received a Stimpatch, You loot 12.5$, 1.2XP and Bacon
+gained = re.compile(r'^You (?:found|received|loot) (.*)$')
+# A single item in the messages above, '2xBacon', '2 Bacon', 'a Bacon'
+gaineditem = re.compile(r'^(?:(\d+) ?x? ?|an? )?([A-Z][A-Za-z0-9_]*)$')
+# One page of "#inventory", 'Your Inventory, page 1/3: 1-DarkBow, 2-Bacon(3)'
+invpage = re.compile(r'Your Inventory\D*(\d+)/(\d+): (.*)$')
+invitem = re.compile(r'^(\d+)-(\S+?)(?:\((\d+)\))?$')
+# 'You now carry 25.85kg/45.19kg' after a sale, 'Weight :48.16kg/42.62kg' in #status
+carryline = re.compile(r'(?:You now carry |Weight :)([\d.]+)kg/([\d.]+)kg')
+# The replies to #drop and #give, which name the item but aren't parsed for a count
+disposedhints = ('You drop', 'You gave', 'You give')
+# Messages that change the inventory in ways we don't follow
+drifthints = disposedhints + ('You equip', 'You unequip', 'You swap')
+# A player using an item, '1-chaseleif{57} used Stimpatch', only ours is drift
+usedline = re.compile(r'^(?:\d+-)?([^{ ,]+){(\d+)} used ')
+
+''' class Inventory
+    The index mirrors the server's inventory ids,
+     items are in id order and new items are added at the end
+
+    Attributes
+    items         - dict, item name -> quantity, in inventory id order
+    stale         - boolean, a message changed the inventory in a way we can't follow
+    synced        - time of the last full refetch of every page
+    pages         - dict, page number -> list of (name, qty), during a refetch
+    maxage        - seconds after which the index is refetched anyway
+    carried       - None, or the kg we carried when last weighed
+    capacity      - None, or the kg we can carry when last weighed
+    sinceweigh    - dict, item name -> quantity gained since we were last weighed
+    nick          - None, or our nick, whose used items leave the inventory
+    server        - None or a string, our server number once it is known
+
+    Methods
+    observe       - Updates the index from a stripped message from the Lamb bot
+    entries       - Returns a list of (inventory id, name, qty)
+    needsync      - Returns True if the pages should be refetched
+    beginsync     - Starts collecting "#inventory" pages
+    setempty      - Sets the index to an empty inventory
+    weigh         - Sets what we carry and can carry
+'''
+class Inventory():
+  maxage = 900
+
+  def __init__(self, nick=None):
+    self.nick = nick
+    self.server = None
+    self.items = {}
+    self.stale = True
+    self.synced = 0
+    self.pages = None
+    self.carried = None
+    self.capacity = None
+    self.sinceweigh = {}
+
+  def __len__(self):
+    return len(self.items)
+
+  def __contains__(self, name):
+    return name in self.items
+
+  def add(self, name, qty=1):
+    self.items[name] = self.items.get(name, 0) + qty
+
+  def remove(self, name, qty=1):
+    if self.items.get(name, 0) < qty:
+      # We have lost track of this item
+      self.stale = True
+      self.items.pop(name, None)
+      return
+    self.items[name] -= qty
+    if self.items[name] == 0:
+      del self.items[name]
+
+  def entries(self):
+    return [(num+1, name, qty)
+            for num, (name, qty) in enumerate(self.items.items())]
+
+  def weigh(self, carried, capacity):
+    self.carried = carried
+    self.capacity = capacity
+    self.sinceweigh = {}
+
+  def needsync(self):
+    return self.stale or time.time() - self.synced > self.maxage
+
+  def beginsync(self):
+    self.pages = {}
+
+  def setempty(self):
+    self.items = {}
+    self.pages = None
+    self.stale = False
+    self.synced = time.time()
+
+  ''' observe
+      Returns True if the line changed the index
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    match = carryline.search(line)
+    if match is not None:
+      self.weigh(float(match.group(1)), float(match.group(2)))
+    match = removed.search(line)
+    if match is not None:
+      self.remove(match.group(2), int(match.group(1)))
+      return True
+    match = invpage.search(line)
+    if match is not None:
+      self.page(int(match.group(1)), int(match.group(2)), match.group(3))
+      return True
+    # Loot is part of a kill line in combat
+    if 'You loot ' in line:
+      line = line[line.find('You loot '):]
+    match = gained.match(line)
+    if match is not None:
+      for part in re.split(r', | and ', match.group(1)):
+        part = part.strip()
+        # Money and XP aren't items
+        if re.match(r'^[\d.]+(\$|XP)$', part) or part == '':
+          continue
+        item = gaineditem.match(part)
+        if item is None:
+          self.stale = True
+          continue
+        name, qty = item.group(2), int(item.group(1)) if item.group(1) else 1
+        self.add(name, qty)
+        self.sinceweigh[name] = self.sinceweigh.get(name, 0) + qty
+      return True
+    if any(hint in line for hint in drifthints):
+      self.stale = True
+      return True
+    # Someone else using an item doesn't change our inventory
+    used = usedline.match(line)
+    if used is not None and (self.nick is None or (used.group(1) == self.nick
+                             and self.server in (None, used.group(2)))):
+      self.stale = True
+      return True
+    return False
+
+  ''' page
+      Collects one page of "#inventory", rebuilding the index from
+       the pages once we have all of them since the sync began
+
+      Parameters
+      num         - integer, this page number
+      numpages    - integer, the number of pages
+      text        - string, the items on this page
+  '''
+  def page(self, num, numpages, text):
+    if self.pages is None:
+      return
+    self.pages[num] = []
+    for part in text.split(', '):
+      item = invitem.match(part.strip())
+      if item is None:
+        continue
+      qty = int(item.group(3)) if item.group(3) else 1
+      self.pages[num].append((item.group(2), qty))
+    if all(page in self.pages for page in range(1, numpages+1)):
+      self.items = {}
+      for page in range(1, numpages+1):
+        for name, qty in self.pages[page]:
+          self.add(name, qty)
+      self.pages = None
+      self.stale = False
+      self.synced = time.time()
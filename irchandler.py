@@ -26,7 +26,8 @@
 ###
 
 import time
-import re, socket, selectors
+import os, re, socket, selectors
+from metrics import botmetrics
 
 ''' class IRCHandler
     Attributes
@@ -36,6 +37,14 @@ import re, socket, selectors
     poller        - A DefaultSelector, used to make reads non-blocking
     username      - The username of the irc connection
     printinmsg    - Boolean, indicates whether to print irc messages
+    listeners     - List of functions called with each line get_response returns
+    senders       - List of functions called with each PRIVMSG privmsg sends
+    wakeread      - The read end of a pipe in the poller, wake() makes
+                     get_response return right away
+    wakewrite     - The write end of that pipe
+    metrics       - BotMetrics, lines and bytes each way and PING round trips
+    pingsent      - None, or the time our last PING was sent
+    closed        - Boolean, whether close() has been called
 
     Internal Methods
     send          - Sends a string as bytes to the irc connection
@@ -43,11 +52,17 @@ import re, socket, selectors
     privmsg       - Sends a PRIVMSG to a recipient
     get_response  - Receives from the irc socket, with an optional timeout
     joinchan      - Sends a join channel message
+    addlistener   - Adds a function to be called with each received line
+    addsender     - Adds a function to be called with each PRIVMSG sent
+    wake          - Makes a get_response waiting in another thread return now
+    ping          - Sends a PING to time the round trip to the server
+    close         - Closes the socket, its poller and the wake pipe
 '''
 class IRCHandler():
   remainder  = ''   # Remainder string, used to return only complete lines
   readybuff  = []   # A list of full lines that have been received
   printinmsg = True # Whether to print incoming irc text
+  closed     = False # Whether close() has been called
 
   ''' init
       Initialize the irc socket and poller
@@ -55,6 +70,13 @@ class IRCHandler():
       Returns after completion of identify to nickserv
   '''
   def __init__(self, server, port, botnick, botpass):
+    # Functions that see every line we return
+    self.listeners = []
+    # Functions that see every PRIVMSG we send
+    self.senders = []
+    # Counted as they go, only read when someone asks for the metrics
+    self.metrics = botmetrics(botnick)
+    self.pingsent = None
     # Get our tcp socket
     self.irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Connect the socket
@@ -63,7 +85,12 @@ class IRCHandler():
     self.irc.setblocking(False)
     # Initialize the polling object
     self.poller = selectors.DefaultSelector()
-    self.poller.register(self.irc, selectors.EVENT_READ)
+    self.poller.register(self.irc, selectors.EVENT_READ, 'irc')
+    # A self-pipe, so another thread can interrupt a wait for input
+    self.wakeread, self.wakewrite = os.pipe()
+    os.set_blocking(self.wakeread, False)
+    os.set_blocking(self.wakewrite, False)
+    self.poller.register(self.wakeread, selectors.EVENT_READ, 'wake')
     # Wait to receive message indicating we are identified with NickServ
     print('    Waiting for identify for ' + botnick)
     while 'NickServ IDENTIFY' not in self.get_response():
@@ -72,10 +99,14 @@ class IRCHandler():
     del botpass
     self.username = botnick
 
-  ''' del
-      Closes the poller and shuts down the irc socket
+  ''' close
+      Closes the poller, shuts down the irc socket and closes the wake pipe
+      Only the first call does anything, __del__ calls it again
   '''
-  def __del__(self):
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
     try:
       self.poller.close()
     except Exception as e:
@@ -85,6 +116,20 @@ class IRCHandler():
       self.irc.close()
     except Exception as e:
       print('    IRCHandler exception closing socket: ' + str(e))
+    # Not there when the connection failed
+    for fd in (getattr(self, 'wakeread', None), getattr(self, 'wakewrite', None)):
+      if fd is None:
+        continue
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+  ''' del
+      Closes the connection if close wasn't called
+  '''
+  def __del__(self):
+    self.close()
 
   ''' toggle_prints
       Set printinmsg to enable/disable printing of all incoming IRC messages
@@ -104,7 +149,10 @@ class IRCHandler():
       print('    IRC -> PING PONG PING PONG ! ! !')
     else:
       print('    IRC -> \"'+msg+'\"')
-    self.irc.sendall(bytes(msg + '\n', 'UTF-8'))
+    data = bytes(msg + '\n', 'UTF-8')
+    self.irc.sendall(data)
+    self.metrics.linesout.inc()
+    self.metrics.bytesout.inc(len(data))
 
   ''' connect
       Connects to an irc server:port
@@ -125,6 +173,8 @@ class IRCHandler():
     msg += botpass
     # Don't use self.send so we don't echo the pass to console
     self.irc.sendall(bytes(msg + '\n', 'UTF-8'))
+    self.metrics.linesout.inc()
+    self.metrics.bytesout.inc(len(msg) + 1)
     del msg
 
   ''' privmsg
@@ -136,6 +186,8 @@ class IRCHandler():
     if delay > 0:
       time.sleep(delay)
     self.send('PRIVMSG ' + recipient + ' :' + msg)
+    for sender in self.senders:
+      sender(recipient, msg)
 
   ''' get_response
       Method to get text from the irc socket, handles PING PONG messages
@@ -154,14 +206,26 @@ class IRCHandler():
       # The flag for printing incoming irc messages is set, print the message
       if self.printinmsg:
         print(ret)
+      self.metrics.linesin.inc()
+      for listener in self.listeners:
+        listener(ret)
       return ret
     # See if we have a read event on the irc socket
-    event = self.poller.select(timeout=timeout)
-    # There are no read events, return
-    if len(event) == 0:
+    events = [key.data for key, _ in self.poller.select(timeout=timeout)]
+    # Another thread woke us, empty the pipe
+    if 'wake' in events:
+      try:
+        while os.read(self.wakeread, 512):
+          pass
+      except BlockingIOError:
+        pass
+    # There are no read events on the socket, return
+    if 'irc' not in events:
       return ''
     # Read from the socket
-    resp = self.irc.recv(2048).decode('UTF-8')
+    resp = self.irc.recv(2048)
+    self.metrics.bytesin.inc(len(resp))
+    resp = resp.decode('UTF-8')
 
     # remove garbage special characters
     # \002: 02: START OF TEXT
@@ -196,19 +260,27 @@ class IRCHandler():
     if resp[-1] != '\n':
       # Set a flag to indicate that the last line is incomplete
       self.remainder = True
-    # Split the lines into a list for enumeration
-    resp = resp.split('\n')
-    for i, line in enumerate(resp):
-      # Delete empty lines
+    # Split the lines into a list, keeping those that aren't handled here
+    # Deleting from the list while enumerating it would skip the next line
+    lines = resp.split('\n')
+    resp = []
+    for i, line in enumerate(lines):
+      # (If this is the final line with a remainder the line is incomplete)
+      complete = not self.remainder or i+1 < len(lines)
+      # Drop empty lines
       if len(line) == 0:
-        del(resp[i])
-      # Immediately respond to complete PING messages
-      elif line.startswith('PING'):
-        # (If this is the final line with no remainder the line is incomplete)
-        if not self.remainder or i+1 < len(resp):
-          self.send('PONG' + line[4:])
-          # Delete the PING message from our response
-          del(resp[i])
+        continue
+      # Immediately respond to complete PING messages, dropping them
+      if line.startswith('PING') and complete:
+        self.send('PONG' + line[4:])
+        continue
+      # The answer to our own PING, ":server PONG server :shadowbot"
+      if self.pingsent is not None and ' PONG ' in line \
+          and line.endswith(':shadowbot') and complete:
+        self.metrics.ping.observe(time.time() - self.pingsent)
+        self.pingsent = None
+        continue
+      resp.append(line)
     # We have a remainder and at least one line in the list
     if self.remainder and len(resp) > 0:
       # Take the last line as the remainder
@@ -234,12 +306,54 @@ class IRCHandler():
       # The flag for printing incoming irc messages is set, print the message
       if self.printinmsg:
         print(ret)
+      self.metrics.linesin.inc()
+      for listener in self.listeners:
+        listener(ret)
 
     return ret
 
+  ''' ping
+      Sends a PING, the round trip is timed when the server's PONG arrives
+  '''
+  def ping(self):
+    # Quietly, unlike send()
+    self.irc.sendall(b'PING :shadowbot\n')
+    self.metrics.linesout.inc()
+    self.metrics.bytesout.inc(len('PING :shadowbot\n'))
+    self.pingsent = time.time()
+
   ''' joinchan
       Sends a message to join a channel
   '''
   def joinchan(self,chan):
     self.send('JOIN ' + chan)
 
+  ''' wake
+      Makes get_response return right away if it is waiting, or the next time
+      Safe to call from any thread
+  '''
+  def wake(self):
+    try:
+      os.write(self.wakewrite, b'!')
+    except BlockingIOError:
+      # The pipe is full, a wake up is already pending
+      pass
+
+  ''' addlistener
+      Adds a function to be called with each line returned by get_response
+      Listeners are called once per line, before the line is returned
+
+      Parameters
+      listener    - function taking the full line as its only parameter
+  '''
+  def addlistener(self, listener):
+    self.listeners.append(listener)
+
+  ''' addsender
+      Adds a function to be called with each PRIVMSG, once it has been sent
+
+      Parameters
+      sender      - function taking the recipient and the message
+  '''
+  def addsender(self, sender):
+    self.senders.append(sender)
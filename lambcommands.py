@@ -0,0 +1,178 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  lambcommands.py
+#  Commands sent to the Lamb bot, each with a future resolved
+#   by the first response matching what the command expects
+##
+#  Author: Chase LP
+###
+
+import re, time
+from collections import namedtuple
+from concurrent.futures import Future
+
+# Responses that mean a command failed, whatever the command was
+commonerrors = ('The command is not available', 'Unknown command')
+
+# The result of a command
+# command is the command sent, line the stripped response that resolved it,
+#  match the re match object or the substring found, elapsed the seconds taken
+CommandResult = namedtuple('CommandResult', ['command', 'line', 'match', 'elapsed'])
+
+''' class CommandError
+    Set on a command's future when an error matcher matched, or it timed out
+'''
+class CommandError(Exception):
+  def __init__(self, command, line):
+    super().__init__(f'{command}: {line}')
+    self.command = command
+    self.line = line
+
+class CommandTimeout(CommandError):
+  def __init__(self, command, timeout):
+    super().__init__(command, f'no response after {timeout}s')
+
+''' matches
+    Returns the match for the first pattern found in the line, or None
+    Patterns are substrings or compiled re objects
+'''
+def matches(patterns, line):
+  for pattern in patterns:
+    if isinstance(pattern, str):
+      if pattern in line:
+        return pattern
+    else:
+      match = pattern.search(line)
+      if match is not None:
+        return match
+  return None
+
+''' class LambCommand
+    Attributes
+    text          - string, the command sent
+    expect        - tuple of substrings / re objects, any one resolves the future
+    errors        - tuple of substrings / re objects, any one fails the future
+    timeout       - None, or the seconds to wait before failing the future
+    sent          - time the command was sent
+    future        - concurrent.futures.Future, a CommandResult or a CommandError
+'''
+class LambCommand():
+  def __init__(self, text, expect, errors=commonerrors, timeout=120):
+    self.text = text
+    self.expect = (expect,) if isinstance(expect, (str, re.Pattern)) else tuple(expect)
+    self.errors = tuple(errors)
+    self.timeout = timeout
+    self.sent = time.time()
+    self.future = Future()
+    self.future.set_running_or_notify_cancel()
+
+  @property
+  def deadline(self):
+    return None if self.timeout is None else self.sent + self.timeout
+
+  def done(self):
+    return self.future.done()
+
+''' class CommandTracker
+    Pending commands are kept in the order they were sent,
+     a response resolves the oldest pending command it matches
+    Each response resolves at most one command, so the same command
+     can be pipelined and its responses are handed out in order
+
+    Attributes
+    pending       - list of LambCommand, sent and not yet resolved
+
+    Methods
+    submit        - Adds a command, returns the LambCommand
+    observe       - Resolves the oldest command a stripped Lamb message matches
+    expire        - Fails the commands past their deadline
+    waiter        - Returns a callable telling awaitresponse when commands are done
+'''
+class CommandTracker():
+  def __init__(self):
+    self.pending = []
+
+  def submit(self, text, expect, errors=commonerrors, timeout=120):
+    command = LambCommand(text, expect, errors, timeout)
+    self.pending.append(command)
+    return command
+
+  ''' observe
+      Returns the LambCommand the line resolved, or None
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    for command in self.pending:
+      if matches(command.errors, line) is not None:
+        command.future.set_exception(CommandError(command.text, line))
+      else:
+        match = matches(command.expect, line)
+        if match is None:
+          continue
+        elapsed = time.time() - command.sent
+        command.future.set_result(CommandResult(command.text, line,
+                                                match, elapsed))
+      self.pending.remove(command)
+      return command
+    return None
+
+  def expire(self):
+    now = time.time()
+    for command in [command for command in self.pending
+                            if command.deadline is not None
+                               and command.deadline < now]:
+      command.future.set_exception(CommandTimeout(command.text, command.timeout))
+      self.pending.remove(command)
+
+  def nextdeadline(self):
+    deadlines = [command.deadline for command in self.pending
+                                  if command.deadline is not None]
+    return min(deadlines) if len(deadlines) > 0 else None
+
+  def waiter(self, commands):
+    return Waiter(self, commands)
+
+''' class Waiter
+    A quitmsg for awaitresponse, true once every command is done
+'''
+class Waiter():
+  def __init__(self, tracker, commands):
+    self.tracker = tracker
+    self.commands = commands
+
+  def __call__(self, line):
+    self.tracker.expire()
+    return all(command.done() for command in self.commands)
+
+  def __str__(self):
+    return ', '.join(command.text for command in self.commands)
+
+  ''' remaining
+      Returns the seconds until the next deadline, at most 30
+  '''
+  def remaining(self):
+    deadline = self.tracker.nextdeadline()
+    if deadline is None:
+      return 30
+    return min(30, max(0.1, deadline - time.time()))
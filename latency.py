@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  latency.py
+#  How long the Lamb bot takes to answer each command verb, to its first
+#   response and to the response we waited for, kept in SQLite histograms
+##
+#  Author: Chase LP
+###
+
+'''
+    A command is timed from when its PRIVMSG is sent, after privmsg()'s delay
+    Its first response is the next Lamb message not already taken as the first
+     response of an older command, so a message we didn't ask for can
+     shorten a command's first response
+    It is done when a send() command resolves, or when awaitresponse sees
+     what it was waiting for, which finishes the commands sent before it began
+    Commands never done are dropped after maxage seconds
+'''
+
+import sys, time, bisect, sqlite3, threading
+from metrics import commandbuckets
+
+# Seconds before an unanswered command is forgotten, a subway ride can be long
+maxage = 900
+# Commands waiting to be done at once, the oldest are forgotten after this
+maxopen = 32
+
+''' verb
+    Returns the verb a command is counted under, or None for text that isn't one
+    '#cast teleport Redmond_Hotel' -> '#cast teleport', '#inventory 2' -> '#inventory'
+'''
+def verb(text):
+  words = text.split()
+  if len(words) == 0 or not words[0].startswith('#'):
+    return None
+  if words[0] in ('#cast', '#ca') and len(words) > 1:
+    return words[0].lower() + ' ' + words[1].lower()
+  return words[0].lower()
+
+''' percentile
+    Returns the upper bound of the bucket holding a fraction of the counts,
+     the largest seen for the overflow bucket
+
+    Parameters
+    counts        - list of counts, one per bucket and one for overflow
+    fraction      - float, e.g., 0.9
+    largest       - float, the largest value seen
+'''
+def percentile(counts, fraction, largest):
+  total = sum(counts)
+  cumulative = 0
+  for index, count in enumerate(counts):
+    cumulative += count
+    if cumulative >= fraction * total:
+      return largest if index == len(commandbuckets) else min(commandbuckets[index], largest)
+  return largest
+
+''' class CommandLatency
+    Attributes
+    filename      - string, the SQLite database file
+    db            - the sqlite3 connection
+    lock          - a lock, commands are sent from the bot and control threads
+    metrics       - None, or BotMetrics to observe the latencies in too
+    open          - list of [verb, text, sent, answered], commands not done yet
+
+    Methods
+    sent          - Starts timing a command sent to the Lamb bot
+    observe       - Times the first response from a stripped Lamb message
+    complete      - Times a command, or the commands sent before a time, as done
+    record        - Adds one latency to the histograms
+    report        - Returns each verb's latencies
+    printreport   - Prints the report
+'''
+class CommandLatency():
+  def __init__(self, filename='latency.db', metrics=None):
+    self.filename = filename
+    self.metrics = metrics
+    self.open = []
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    # A row per histogram bucket, the bucket past the last bound is overflow
+    # count / total are summed over every command, largest is the maximum
+    self.db.execute('''CREATE TABLE IF NOT EXISTS latency (
+                        verb     TEXT NOT NULL,
+                        stage    TEXT NOT NULL,
+                        bucket   INTEGER NOT NULL,
+                        count    INTEGER NOT NULL DEFAULT 0,
+                        total    REAL NOT NULL DEFAULT 0,
+                        largest  REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (verb, stage, bucket))''')
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  ''' sent
+      Parameters
+      text        - string, the message sent to the Lamb bot
+  '''
+  def sent(self, text):
+    name = verb(text)
+    if name is None:
+      return
+    now = time.time()
+    with self.lock:
+      self.open = [command for command in self.open if now - command[2] < maxage]
+      self.open.append([name, text, now, False])
+      del self.open[:-maxopen]
+
+  ''' observe
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    with self.lock:
+      for command in self.open:
+        if not command[3]:
+          command[3] = True
+          break
+      else:
+        return
+    self.record(command[0], 'first', time.time() - command[2])
+
+  ''' complete
+      Times the oldest command with the text as done,
+       or every command sent before a time when there is no text
+
+      Parameters
+      text        - None, or string, the command sent
+      before      - time, with no text the commands sent before it are done
+  '''
+  def complete(self, text=None, before=None):
+    now = time.time()
+    with self.lock:
+      if text is not None:
+        done = [command for command in self.open if command[1] == text][:1]
+      else:
+        done = [command for command in self.open
+                        if before is None or command[2] <= before]
+      for command in done:
+        self.open.remove(command)
+    for command in done:
+      self.record(command[0], 'done', now - command[2])
+
+  ''' record
+      Parameters
+      name        - string, the verb
+      stage       - 'first' or 'done'
+      seconds     - float, the latency
+  '''
+  def record(self, name, stage, seconds):
+    if self.metrics is not None:
+      self.metrics.command(name, stage).observe(seconds)
+    with self.lock:
+      self.db.execute('''INSERT INTO latency
+                          (verb, stage, bucket, count, total, largest)
+                          VALUES (?, ?, ?, 1, ?, ?)
+                          ON CONFLICT(verb, stage, bucket) DO UPDATE SET
+                          count=count+1, total=total+excluded.total,
+                          largest=MAX(largest, excluded.largest)''',
+                      (name, stage, bisect.bisect_left(commandbuckets, seconds),
+                       seconds, seconds))
+      self.db.commit()
+
+  ''' report
+      Returns a list of (verb, stage, count, mean, p50, p90, p99, max)
+       sorted by the most commands
+
+      Parameters
+      limit       - integer, the number of verbs to return
+  '''
+  def report(self, limit=20):
+    with self.lock:
+      rows = self.db.execute('''SELECT verb, stage, bucket, count, total, largest
+                                 FROM latency''').fetchall()
+    histograms = {}
+    for name, stage, bucket, count, total, largest in rows:
+      if not 0 <= bucket <= len(commandbuckets):
+        continue
+      entry = histograms.setdefault((name, stage),
+                                    [[0] * (len(commandbuckets) + 1), 0, 0])
+      entry[0][bucket] += count
+      entry[1] += total
+      entry[2] = max(entry[2], largest)
+    verbs = {}
+    for (name, stage), (counts, _, _) in histograms.items():
+      verbs[name] = max(verbs.get(name, 0), sum(counts))
+    verbs = sorted(verbs, key=lambda name: -verbs[name])[:limit]
+    report = []
+    for name in verbs:
+      for stage in ('first', 'done'):
+        if (name, stage) not in histograms:
+          continue
+        counts, total, largest = histograms[(name, stage)]
+        count = sum(counts)
+        report.append((name, stage, count, total / count,
+                       percentile(counts, 0.5, largest),
+                       percentile(counts, 0.9, largest),
+                       percentile(counts, 0.99, largest), largest))
+    return report
+
+  def printreport(self, limit=20, printfn=print):
+    rows = self.report(limit)
+    if len(rows) == 0:
+      printfn(' ~ No command latencies recorded yet')
+      return
+    printfn(' ~ %-18s %-5s %6s %7s %6s %6s %6s %7s' % \
+            ('Command','Stage','Count','Mean(s)','p50','p90','p99','Max'))
+    for row in rows:
+      printfn(' ~ %-18s %-5s %6d %7.2f %6.2f %6.2f %6.2f %7.2f' % row)
+
+if __name__ == '__main__':
+  latency = CommandLatency(sys.argv[1] if len(sys.argv) > 1 else 'latency.db')
+  latency.printreport(limit=int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+  latency.close()
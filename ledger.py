@@ -0,0 +1,256 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  ledger.py
+#  An SQLite ledger of what items sell for and weigh,
+#   and the sell / bank / keep decisions made from it
+##
+#  Author: Chase LP
+###
+
+import re, sys, time, sqlite3, threading
+
+# You sold 1 of your DarkBow for 56.63$. You now carry 25.85kg/45.19kg
+soldline = re.compile(r'You sold (\d+) of your (\S+?) for ([\d.]+)\$')
+# You put 1 of your ID4Card into your bank account. You now carry 25.22kg/45.19kg
+putline = re.compile(r'You put (\d+) of your (\S+?) into')
+carryline = re.compile(r'You now carry ([\d.]+)kg/([\d.]+)kg')
+
+''' class ItemLedger
+    Attributes
+    filename      - string, the SQLite database file
+    db            - the sqlite3 connection
+    lock          - a lock, the bot thread records while other threads read
+    lastcarry     - None, or the kg we carried at the last "You now carry"
+
+    Methods
+    observe       - Records sales and weights from a stripped Lamb message
+    value         - Returns the nuyen an item sells for, or None
+    weight        - Returns the kg an item weighs, or None
+    estimate      - Returns the kg an item weighs, or the average we know of
+    learn         - Records the weight of an item gained between weighings
+    decide        - Returns 'sell' or 'bank' for an item
+    plan          - Splits inventory entries into what to sell, bank and keep
+    weights       - Returns the kg per unit of a list of items
+'''
+class ItemLedger():
+  def __init__(self, filename='items.db'):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.lastcarry = None
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    # sold / nuyen are sums over every sale, weight is the latest per unit
+    self.db.execute('''CREATE TABLE IF NOT EXISTS items (
+                        name     TEXT PRIMARY KEY,
+                        sold     INTEGER NOT NULL DEFAULT 0,
+                        nuyen    REAL NOT NULL DEFAULT 0,
+                        weight   REAL,
+                        lastsold REAL NOT NULL DEFAULT 0)''')
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  ''' observe
+      Returns True if the line was recorded
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    carry = carryline.search(line)
+    before = self.lastcarry
+    if carry is not None:
+      self.lastcarry = float(carry.group(1))
+    match = soldline.search(line) or putline.search(line)
+    if match is None:
+      return False
+    qty, name = int(match.group(1)), match.group(2)
+    # The weight is how much lighter we are
+    weight = None
+    if carry is not None and before is not None and before > self.lastcarry:
+      weight = round((before - self.lastcarry) / qty, 3)
+    with self.lock:
+      self.db.execute('INSERT OR IGNORE INTO items (name) VALUES (?)', (name,))
+      if match.re is soldline:
+        self.db.execute('''UPDATE items SET sold=sold+?, nuyen=nuyen+?,
+                            lastsold=? WHERE name=?''',
+                        (qty, float(match.group(3)), time.time(), name))
+      if weight is not None:
+        self.db.execute('UPDATE items SET weight=? WHERE name=?',
+                        (weight, name))
+      self.db.commit()
+    return True
+
+  def value(self, name):
+    with self.lock:
+      row = self.db.execute('''SELECT nuyen/sold FROM items
+                                WHERE name=? AND sold>0''', (name,)).fetchone()
+    return None if row is None else row[0]
+
+  def weight(self, name):
+    with self.lock:
+      row = self.db.execute('SELECT weight FROM items WHERE name=?',
+                            (name,)).fetchone()
+    return None if row is None else row[0]
+
+  ''' estimate
+      Returns the kg an item weighs, or if we haven't weighed it yet the average
+       of the items we have, None if we haven't weighed any
+  '''
+  def estimate(self, name):
+    weight = self.weight(name)
+    if weight is not None:
+      return weight
+    with self.lock:
+      row = self.db.execute('SELECT AVG(weight) FROM items').fetchone()
+    return row[0]
+
+  ''' learn
+      Records the weight of the one item we hadn't weighed among those gained
+       between two weighings, from how much heavier we got
+
+      Parameters
+      gained      - dict, item name -> quantity gained
+      kg          - float, how much heavier we are
+  '''
+  def learn(self, gained, kg):
+    unknown = [name for name in gained if self.weight(name) is None]
+    if len(unknown) != 1:
+      return
+    name = unknown[0]
+    kg -= sum(self.weight(other) * qty for other, qty in gained.items()
+              if other != name)
+    if kg <= 0:
+      return
+    with self.lock:
+      self.db.execute('INSERT OR IGNORE INTO items (name) VALUES (?)', (name,))
+      self.db.execute('UPDATE items SET weight=? WHERE name=?',
+                      (round(kg / gained[name], 3), name))
+      self.db.commit()
+
+  ''' decide
+      Returns 'sell' or 'bank' for an item past the stop position
+      Items the store refuses, that we keep, or that sell for nothing are banked
+      Everything else is sold, items we don't know the value of yet are sold
+       to learn it
+
+      Parameters
+      name        - string, the item name
+      dontsell    - DontSellIndex
+  '''
+  def decide(self, name, dontsell):
+    if dontsell.skip(name):
+      return 'bank'
+    value = self.value(name)
+    if value is not None and value <= 0:
+      return 'bank'
+    return 'sell'
+
+  ''' plan
+      Returns (sell, bank, keep), each a list of (name, qty)
+      sell is ordered by expected nuyen, the most first, so the valuable
+       items are sold even if the trip is cut short
+      Items before the stop position are kept
+      Of the items we can't sell, only the heaviest are banked, until what
+       we carry after the trip is down to room, the rest are kept rather
+       than making a bank trip for items that hardly weigh anything
+      Without our weight, or room, everything we can't sell is banked
+
+      Parameters
+      entries     - list of (inventory id, name, qty) from the inventory index
+      invstop     - integer, the first inventory id we may get rid of
+      dontsell    - DontSellIndex
+      carried     - None, or the kg we carry now
+      room        - None, or the kg we want to carry at most after the trip
+  '''
+  def plan(self, entries, invstop, dontsell, carried=None, room=None):
+    sell, bank, keep = [], [], []
+    for num, name, qty in entries:
+      if num < invstop:
+        keep.append((name, qty))
+      elif self.decide(name, dontsell) == 'sell':
+        sell.append((name, qty))
+      else:
+        bank.append((name, qty))
+    values = self.values(sell)
+    sell.sort(key=lambda item: -item[1] * values[item[0]])
+    if carried is None or room is None:
+      return sell, bank, keep
+    weights = self.weights(sell + bank)
+    # Selling frees its weight, what's left over room is banked, heaviest first
+    left = carried - sum(qty * weights[name] for name, qty in sell)
+    bank.sort(key=lambda item: -item[1] * weights[item[0]])
+    for index, (name, qty) in enumerate(bank):
+      if left <= room:
+        keep.extend(bank[index:])
+        bank = bank[:index]
+        break
+      left -= qty * weights[name]
+    return sell, bank, keep
+
+  ''' values
+      Returns a dict, name -> nuyen per unit, for a list of (name, qty)
+      Items we haven't sold yet are valued at the average of those we have
+  '''
+  def values(self, items):
+    values = {name:self.value(name) for name, _ in items}
+    known = [v for v in values.values() if v is not None]
+    average = sum(known) / len(known) if len(known) > 0 else 0
+    return {name:(average if v is None else v) for name, v in values.items()}
+
+  ''' weights
+      Returns a dict, name -> kg per unit, for a list of (name, qty)
+      Items we haven't weighed yet are taken to weigh the average of those we have
+  '''
+  def weights(self, items):
+    weights = {name:self.weight(name) for name, _ in items}
+    known = [w for w in weights.values() if w is not None]
+    average = sum(known) / len(known) if len(known) > 0 else 0
+    return {name:(average if w is None else w) for name, w in weights.items()}
+
+  ''' expected
+      Returns the nuyen we expect from selling a list of (name, qty)
+  '''
+  def expected(self, items):
+    values = self.values(items)
+    return sum(qty * values[name] for name, qty in items)
+
+  def printreport(self, limit=20, printfn=print):
+    with self.lock:
+      rows = self.db.execute('''SELECT name, sold, nuyen/sold, weight,
+                                 nuyen/sold/weight FROM items WHERE sold>0
+                                 ORDER BY nuyen/sold DESC LIMIT ?''',
+                              (limit,)).fetchall()
+    if len(rows) == 0:
+      printfn(' ~ No sales recorded yet')
+      return
+    printfn(' ~ %-20s %6s %9s %8s %9s' % ('Item','Sold','$/unit','kg','$/kg'))
+    for name, sold, value, weight, perkg in rows:
+      printfn(' ~ %-20s %6d %9.2f %8s %9s' % (name, sold, value,
+              '-' if weight is None else '%.2f' % weight,
+              '-' if perkg is None else '%.2f' % perkg))
+
+if __name__ == '__main__':
+  ledger = ItemLedger(sys.argv[1] if len(sys.argv) > 1 else 'items.db')
+  ledger.printreport(limit=int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+  ledger.close()
@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  loopscript.py
+#  Loop functions written as scripts, compiled once into a list of steps
+##
+#  Author: Chase LP
+###
+
+'''
+    A loop script has one statement per line, indentation is ignored
+    '#' followed by a space starts a comment, '#cmd' is a Lamb command
+
+    #explore                - Sends a command to the Lamb bot
+    expect explored         - After a command, waits for a response containing this
+                              Without one we receive for 5 seconds after the command
+    expect ready | rest     - Waits for a response containing either
+    sleep 30                - Receives messages for about 30 seconds, "sleep(30)" works too
+    msg nick some message   - Sends a message to a player
+    call shedinv            - Calls a ShadowThread loop function with the iteration
+    if <condition>          - The statements up to 'else' or 'end' run if it's true
+    else
+    end
+    repeat 3                - The statements up to 'end' run 3 times
+    end
+
+    A condition is "[not] name [op number]", or "every N" for every Nth iteration
+    op is one of <, <=, >, >=, ==, !=
+    Names are listed in the conditions dict below
+'''
+
+import os, re
+from collections import namedtuple
+
+# A compiled step
+# kind is 'cmd', 'sleep', 'msg', 'call', 'if' or 'repeat'
+# For 'cmd' args is (command, None or a tuple of expected responses)
+# For 'if' args is the condition and body / orelse are lists of steps
+# For 'repeat' args is the count and body the steps repeated
+Step = namedtuple('Step', ['kind', 'args', 'lineno', 'body', 'orelse'])
+
+''' percent
+    Returns a function giving a charstate value as a percent of its max
+'''
+def percent(value, maxvalue):
+  def get(bot, fncounter):
+    current, top = getattr(bot.charstate, value), getattr(bot.charstate, maxvalue)
+    if current is None or not top:
+      return None
+    return 100 * current / top
+  return get
+
+''' load
+    Returns the percent of our capacity we carried when last weighed, or None
+'''
+def load(bot, fncounter):
+  if bot.inventory.carried is None or not bot.inventory.capacity:
+    return None
+  return 100 * bot.inventory.carried / bot.inventory.capacity
+
+# The names a condition can test, each a function(bot, fncounter)
+# Unknown values (None) are false, and make any comparison false
+conditions = {'cancast':   lambda bot, fncounter: bot.cancast,
+              'needrest':  lambda bot, fncounter: bot.needrest(),
+              'needshed':  lambda bot, fncounter: bot.needshed(),
+              'hp':        percent('hp', 'maxhp'),
+              'mp':        percent('mp', 'maxmp'),
+              'load':      load,
+              'level':     lambda bot, fncounter: bot.charstate.level,
+              'nuyen':     lambda bot, fncounter: bot.charstate.nuyen,
+              'items':     lambda bot, fncounter: len(bot.inventory),
+              'iteration': lambda bot, fncounter: fncounter,
+             }
+
+operators = {'<':  lambda x, y: x < y,  '<=': lambda x, y: x <= y,
+             '>':  lambda x, y: x > y,  '>=': lambda x, y: x >= y,
+             '==': lambda x, y: x == y, '!=': lambda x, y: x != y}
+
+condition = re.compile(r'^(not )?(\w+)(?: (<=|>=|==|!=|<|>) (-?[\d.]+))?$')
+
+class ScriptError(Exception):
+  def __init__(self, filename, lineno, msg):
+    super().__init__(f'{filename}:{lineno}: {msg}')
+
+''' compileline
+    Returns a Step for a single statement, 'if' / 'repeat' bodies are empty
+    Returns None for 'else' and 'end'
+
+    Parameters
+    text          - string, the statement
+    lineno        - integer, for errors
+    filename      - string, for errors
+    callables     - None, or the names 'call' may use
+'''
+def compileline(text, lineno, filename, callables=None):
+  error = lambda msg: ScriptError(filename, lineno, msg)
+  if text.startswith('#'):
+    return Step('cmd', (text, None), lineno, None, None)
+  word, _, rest = text.partition(' ')
+  rest = rest.strip()
+  if word.startswith('sleep(') and text.endswith(')'):
+    word, rest = 'sleep', text[len('sleep('):-1]
+  if word == 'sleep':
+    try:
+      return Step('sleep', float(rest), lineno, None, None)
+    except ValueError:
+      raise error(f'sleep needs a number of seconds, not "{rest}"')
+  if word == 'msg':
+    recipient, _, message = rest.partition(' ')
+    if recipient == '' or message == '':
+      raise error('msg needs a nick and a message')
+    return Step('msg', (recipient, message), lineno, None, None)
+  if word == 'call':
+    if callables is not None and rest not in callables:
+      raise error(f'"{rest}" is not a loop function')
+    return Step('call', rest, lineno, None, None)
+  if word == 'if':
+    if rest.startswith('every '):
+      try:
+        every = int(rest.split(' ')[1])
+      except ValueError:
+        raise error(f'"{rest}" needs a whole number')
+      if every < 1:
+        raise error('every needs a positive number')
+      return Step('if', ('every', every), lineno, [], [])
+    match = condition.match(rest)
+    if match is None:
+      raise error(f'can\'t read the condition "{rest}"')
+    negate, name, op, value = match.groups()
+    if name not in conditions:
+      raise error(f'unknown condition "{name}", one of {", ".join(conditions)}')
+    value = None if value is None else float(value)
+    return Step('if', (negate is not None, name, op, value), lineno, [], [])
+  if word == 'repeat':
+    try:
+      count = int(rest)
+    except ValueError:
+      raise error(f'repeat needs a whole number, not "{rest}"')
+    return Step('repeat', count, lineno, [], None)
+  if word in ('else', 'end', 'expect'):
+    return None
+  raise error(f'unknown statement "{word}"')
+
+''' compilescript
+    Returns the list of steps for the lines of a script
+    Raises a ScriptError for the first problem found
+
+    Parameters
+    lines         - list of strings
+    filename      - string, for errors
+    callables     - None, or the names 'call' may use
+'''
+def compilescript(lines, filename='<script>', callables=None):
+  top = []
+  # Each open block, (step, the list statements are added to)
+  blocks = []
+  steps = top
+  for lineno, text in enumerate(lines, 1):
+    text = text.strip()
+    if text in ('', '#') or text.startswith('# '):
+      continue
+    word = text.split(' ')[0]
+    if word == 'expect':
+      if len(steps) == 0 or steps[-1].kind != 'cmd' or steps[-1].args[1] is not None:
+        raise ScriptError(filename, lineno, 'expect must follow a command')
+      expect = text[len('expect'):].strip()
+      if expect == '':
+        raise ScriptError(filename, lineno, 'expect needs the text of a response')
+      expect = tuple(part.strip() for part in expect.split(' | '))
+      steps[-1] = steps[-1]._replace(args=(steps[-1].args[0], expect))
+      continue
+    if word == 'else':
+      if len(blocks) == 0 or blocks[-1][0].kind != 'if' or blocks[-1][1] is blocks[-1][0].orelse:
+        raise ScriptError(filename, lineno, 'else without an if')
+      blocks[-1] = (blocks[-1][0], blocks[-1][0].orelse)
+      steps = blocks[-1][1]
+      continue
+    if word == 'end':
+      if len(blocks) == 0:
+        raise ScriptError(filename, lineno, 'end without an if or repeat')
+      blocks.pop()
+      steps = blocks[-1][1] if len(blocks) > 0 else top
+      continue
+    step = compileline(text, lineno, filename, callables)
+    steps.append(step)
+    if step.kind in ('if', 'repeat'):
+      blocks.append((step, step.body))
+      steps = step.body
+  if len(blocks) > 0:
+    raise ScriptError(filename, blocks[-1][0].lineno, f'{blocks[-1][0].kind} without an end')
+  return top
+
+''' test
+    Returns whether the condition of an 'if' step holds
+'''
+def test(args, bot, fncounter):
+  if args[0] == 'every':
+    return fncounter % args[1] == 0
+  negate, name, op, value = args
+  current = conditions[name](bot, fncounter)
+  if op is None:
+    result = bool(current)
+  else:
+    result = current is not None and operators[op](current, value)
+  return result != negate
+
+''' class LoopScript
+    A script file, recompiled only when the file changes
+    If a changed file doesn't compile the last good plan is kept
+
+    Attributes
+    filename      - string
+    callables     - None, or the names 'call' may use
+    steps         - the compiled steps, None if never compiled
+    mtime         - the modification time of the file when compiled
+    error         - None, or the last ScriptError
+'''
+class LoopScript():
+  def __init__(self, filename, callables=None):
+    self.filename = filename
+    self.callables = callables
+    self.steps = None
+    self.mtime = None
+    self.error = None
+    self.reload()
+
+  ''' reload
+      Recompiles the file if it changed, returns True if it was recompiled
+  '''
+  def reload(self):
+    try:
+      mtime = os.stat(self.filename).st_mtime_ns
+    except FileNotFoundError as e:
+      self.error = e
+      return False
+    if mtime == self.mtime:
+      return False
+    self.mtime = mtime
+    with open(self.filename) as infile:
+      lines = infile.read().splitlines()
+    try:
+      self.steps = compilescript(lines, self.filename, self.callables)
+      self.error = None
+    except ScriptError as e:
+      self.error = e
+      return False
+    return True
@@ -0,0 +1,420 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  menus.py
+#  The interactive menus of startbot.py
+##
+#  Author: Chase LP
+###
+
+import time
+import botconfig
+
+# The ShadowThread object we will interact with
+thread = None
+
+# The loop functions a user may choose, from startbot.loopfunctions
+availfuncs = []
+
+# The previous recipient of a private message from this bot
+# Used to ease sending repeated manual messages to some nick
+lastrecipient = ''
+
+def botcmdmenu():
+  while True:
+    print(' ___')
+    print('| These commands will be ran before the function loop starts')
+    print('| Each either:')
+    print('| Issue a command to the Lambbot, e.g., \"#cast berzerk\"')
+    print('| Send a player a message, e.g., \"msg nick a message\"')
+    print('| Sleep for about some time, e.g., \"sleep(30)\"')
+    print('|')
+    print(f'| Current commands: {list(thread.precmds)}')
+    print('| 1) Add a command')
+    if len(thread.precmds) > 0:
+      print('| 2) Remove a command')
+      print('| 3) Clear commands')
+    print('| 0) Return to bot menu')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      newcmd = input('| Enter a new command: ')
+      if newcmd != '':
+        thread.control('precmds', thread.precmds + (newcmd,))
+    elif response == '2' and len(thread.precmds) > 0:
+      delcmd = input('| Enter the command to remove: ')
+      try:
+        precmds = list(thread.precmds)
+        precmds.remove(delcmd)
+        thread.control('precmds', precmds)
+      except Exception as e:
+        print(f'| Exception: {e}')
+    elif response == '3' and len(thread.precmds) > 0:
+      thread.control('precmds', [])
+    elif response == '0':
+      break
+    else:
+      time.sleep(1)
+
+def botescortmenu():
+  while True:
+    print(' ___')
+    print('| Escort options')
+    print(f'| Escorting: {thread.escortnick}')
+    print('| 1) Set escort nick')
+    print('| 2) Set prohibited commands for the \"docmd\" command')
+    print('| 3) Accept configuration')
+    if thread.escortcasts:
+      print('| 4) Set that your escort can\'t cast spells')
+    else:
+      print('| 4) Set that your escort can cast spells')
+    print('| 0) Cancel escort')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      thread.control('escortnick', input('| Enter the nick to escort: '))
+    elif response == '2':
+      while True:
+        print('| Block when any word is matched in an escorted players docmd')
+        print(f'| Prohibited words: {list(thread.badcmds)}')
+        print('|')
+        print('| Short+long forms of many commands are prohibited by default')
+        print('| Commands affecting our player are also prohibited')
+        print('|')
+        print('| 1) Add prohibited word (must match a word of the command)')
+        print('| 2) Remove word from prohibited list')
+        print('| 0) Return to escort options')
+        response = input('| Enter your selection: ')
+        if response == '1':
+          response = input('| Enter new prohibited word: ')
+          if response != '':
+            thread.control('badcmds', thread.badcmds + (response,))
+        elif response == '2':
+          response = input('| Enter word to remove: ')
+          try:
+            badcmds = list(thread.badcmds)
+            badcmds.remove(response)
+            thread.control('badcmds', badcmds)
+          except Exception as e:
+            print(f'Exception: {e}')
+        elif response == '0':
+          break
+        else:
+          time.sleep(1)
+    elif response == '3':
+      if thread.escortnick != '':
+        return 'escort'
+      return None
+    elif response == '4':
+      thread.control('escortcasts', not thread.escortcasts)
+    elif response == '0':
+      return None
+    else:
+      time.sleep(1)
+
+def keepmenu():
+  while True:
+    print(' ___')
+    print('| Items containing any of these words are never sold')
+    print(f'| Keep words: {list(thread.keep)}')
+    print(f'| Refused by the store: {sorted(thread.dontsell.refused)}')
+    print('| 1) Add a keep word')
+    print('| 2) Remove a keep word')
+    print('| 0) Return to travel and combat options')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      response = input('| Enter new keep word: ')
+      if response != '':
+        thread.control('keep', thread.keep + (response,))
+    elif response == '2':
+      response = input('| Enter word to remove: ')
+      if response in thread.keep:
+        thread.control('keep', [word for word in thread.keep
+                                     if word != response])
+      else:
+        print(f'| Not a keep word: {response}')
+    elif response == '0':
+      break
+    else:
+      time.sleep(1)
+
+def travelmenu():
+  while True:
+    print(' ___')
+    print('| Travel and combat options:')
+    print(f'| 1) Set word to say on \'Meet\' events ({thread.meetsay})')
+    print(f'| 2) Set number of bums needed to kill ({thread.bumsleft})')
+    if thread.attacklow:
+      print('| 3) Set attack priority to high levels first')
+    else:
+      print('| 3) Set attack priority to low levels first (the default)')
+    if thread.cancast:
+      print('| 4) Disable casting (teleport + calm + heal)')
+    else:
+      print('| 4) Enable casting (teleport + calm + heal)')
+    print(f'| 5) Set sell location for explore loop ({thread.store})')
+    if thread.targetdb:
+      print('| 6) Disable choosing targets from the enemy knowledge base')
+    else:
+      print('| 6) Enable choosing targets from the enemy knowledge base')
+    print('| 7) Set items to keep (never sell)')
+    print(f'| 8) Set the least nuyen worth a sell trip ({thread.mintrip})')
+    print('| 9) Set the load at which to shed inventory',
+          f'({round(100*thread.shedload)}% of capacity)')
+    print('| 10) Set the HP / MP below which to rest',
+          f'({round(100*thread.restbelow)}% of max)')
+    print('| 0) Return to the bot menu')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      newword = input('| Enter what the bot says on meet: ')
+      thread.control('meetsay', newword)
+    elif response == '2':
+      print(' ___')
+      print(f'| Currently need to kill {thread.bumsleft} more bum',end='')
+      if thread.bumsleft != 1: print('s',end='')
+      newval = input('\n| Enter the number of bums to kill: ')
+      try:
+        newval = int(newval)
+        if newval < 0:
+          newval = 0
+        thread.control('bumsleft', newval)
+      except Exception as e:
+        print('| Exception: ' + str(e))
+    elif response == '3':
+      thread.control('attacklow', not thread.attacklow)
+    elif response == '4':
+      thread.control('cancast', not thread.cancast)
+    elif response == '5':
+      newval = input('| Enter sell location: ')
+      if input(f'| Confirm location \"{newval}\" (y/N): ').startswith('y'):
+        thread.control('store', newval)
+    elif response == '6':
+      thread.control('targetdb', not thread.targetdb)
+    elif response == '7':
+      keepmenu()
+    elif response == '8':
+      newval = input('| Enter the least expected nuyen for a sell trip: ')
+      try:
+        thread.control('mintrip', max(0, float(newval)))
+      except Exception as e:
+        print('| Exception: ' + str(e))
+    elif response == '9':
+      newval = input('| Enter the percent of capacity to shed inventory at: ')
+      try:
+        thread.control('shedload', min(100, max(1, float(newval))) / 100)
+      except Exception as e:
+        print('| Exception: ' + str(e))
+    elif response == '10':
+      newval = input('| Enter the percent of HP / MP below which to rest: ')
+      try:
+        thread.control('restbelow', min(100, max(0, float(newval))) / 100)
+      except Exception as e:
+        print('| Exception: ' + str(e))
+    elif response == '0':
+      break
+    else:
+      time.sleep(1)
+
+def botmenu():
+  while True:
+    print(' ___')
+    print(f'| Bot ({thread.irc.username}) Configuration:')
+    print(f'| 1) Set the Lamb bot nick ({thread.lambbot})')
+    print('| 2) Set the stop value for selling / pushing items to bank',
+          f'({thread.invstop})')
+    print('| 3) Set travel and combat options')
+    print('| 4) Set escort options')
+    print('| 5) Set command list to run before function loop')
+    print(f'| 6) Change the function loop ({thread.doloop})')
+    if thread.doloop is not None:
+      print('| 7) Clear current function loop')
+    print(f'| 8) Set the loop script file for "script" ({thread.loopscript})')
+    print('| 9) Load settings from a file')
+    print('| 10) Save settings to a file')
+    print(f'| 11) Set the file tracing spans are written to ({thread.tracefile})')
+    print('| 0) Return to the main menu')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      newnick = input('| Enter the Lamb bot\'s nick: ')
+      thread.control('lambbot', newnick)
+    elif response == '2':
+      print(f'| Currently the stop value is {thread.invstop}')
+      print('| Less than 1 indicates to not shed inventory')
+      print('| A positive value indicates',
+            'the highest number of inventory to sell')
+      newval = input('| Enter the inventory stop position: ')
+      try:
+        newval = int(newval)
+        if newval < 0:
+          newval = 0
+        thread.control('invstop', newval)
+      except Exception as e:
+        print(f'| Exception: {e}')
+    elif response == '3':
+      travelmenu()
+    elif response == '4':
+      botescortmenu()
+    elif response == '5':
+      botcmdmenu()
+    elif response == '6':
+      print(' ___')
+      print(f'| Bot function is {thread.doloop}')
+      print('| Available functions are', ', '.join(availfuncs))
+      newfunc = input('| Enter a function name: ')
+      if newfunc in availfuncs:
+        if newfunc == 'escort':
+          newfunc = botescortmenu()
+        thread.control('doloop', newfunc)
+      else:
+        print('| Invalid function name')
+    elif response == '7' and thread.doloop is not None:
+      thread.control('doloop', None)
+    elif response == '8':
+      newfile = input('| Enter the loop script filename (blank for none): ')
+      thread.control('loopscript', newfile if newfile != '' else None)
+    elif response == '9':
+      filename = input('| Enter the settings filename: ')
+      try:
+        thread.control('config', botconfig.load(filename, thread.config))
+      except Exception as e:
+        print(f'| Exception: {e}')
+    elif response == '10':
+      filename = input('| Enter the settings filename: ')
+      try:
+        botconfig.save(thread.config, filename)
+      except Exception as e:
+        print(f'| Exception: {e}')
+    elif response == '11':
+      newfile = input('| Enter the trace filename (blank for none): ')
+      thread.control('tracefile', newfile if newfile != '' else None)
+    elif response == '0':
+      break
+    else:
+      time.sleep(1)
+
+def ircmenu():
+  global lastrecipient
+  while True:
+    print(' ___')
+    print('| IRC Commands:')
+    print('| 1) Join a channel')
+    print('| 2) Send a message to a nick or channel')
+    print(f'| 3) Send a message to {thread.lambbot}')
+    if lastrecipient != '':
+      print(f'| 4) Send a message to {lastrecipient}')
+    print('| 0) Return to the main menu')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      chan = input('| Enter the channel name to join: ')
+      if chan != '1':
+        thread.irc.joinchan(chan)
+    elif response == '2':
+      recipient = input('| Enter the recipient: ')
+      if recipient == '2':
+        continue
+      if recipient != thread.lambbot and recipient != '':
+        lastrecipient = recipient
+      msg = input('| Enter the message: ')
+      if msg != '' and msg != '2':
+        thread.irc.privmsg(recipient, msg, delay=0)
+    elif response == '3':
+      msg = input('| Enter the message: ')
+      if msg != '' and msg != '3':
+        thread.irc.privmsg(thread.lambbot, msg, delay=0)
+    elif response == '4' and lastrecipient != '':
+      msg = input('| Enter the message: ')
+      if msg != '4':
+        thread.irc.privmsg(lastrecipient, msg, delay=0)
+    elif response == '0':
+      break
+    else:
+      time.sleep(1)
+
+def mainmenu():
+  while True:
+    print(' ___')
+    print('| Main Menu:')
+    print('| 1) Bot configuration')
+    print('| 2) IRC commands')
+    print('| 3) Quit')
+    print(f'| 4) Toggle colors ({thread.colors})')
+    print('| 5) Hide menu')
+    print('| 6) Enemy report (most profitable per minute)')
+    print('| 7) Item report (what items sell for)')
+    print('| 8) Query cache hits / misses')
+    print('| 9) Command latency report (how long the Lamb bot takes to answer)')
+    response = input('| Enter your selection: ')
+    if response == '1':
+      botmenu()
+    elif response == '2':
+      ircmenu()
+    elif response == '3':
+      print(' ___')
+      print('| Quit')
+      print('| 1) Allow thread to finish its current activity before exit')
+      print('| 2) More immediately abort thread and quit')
+      print('| (anything else to cancel)')
+      response = input('| Enter your selection: ')
+      if response == '1':
+        thread.control('doloop', None)
+        thread.control('softquit', True)
+        print('| Finishing current activity, joining thread . . .')
+        thread.th.join()
+        print('| Goodbye')
+        break
+      if response == '2':
+        print('| Aborting current activity, joining thread . . .')
+        thread.control('doloop', None)
+        thread.control('doquit', True)
+        #time.sleep(2)
+        thread.th.join()
+        print('| Goodbye')
+        break
+    elif response == '4':
+      thread.togglecolors()
+    elif response == '5':
+      print(' ___')
+      input('| Hiding menu until the enter key is pressed . . .\n')
+    elif response == '6':
+      print(' ___')
+      thread.enemyreport()
+    elif response == '7':
+      print(' ___')
+      thread.itemreport()
+    elif response == '8':
+      print(' ___')
+      thread.cachereport()
+    elif response == '9':
+      print(' ___')
+      thread.latencyreport()
+    else:
+      time.sleep(1)
+
+''' run
+    Runs the main menu for a bot until the user quits
+
+    Parameters
+    bot           - ShadowThread, the bot the menus configure
+    funcs         - list of strings, the loop functions it may do
+'''
+def run(bot, funcs):
+  global thread, availfuncs
+  thread = bot
+  availfuncs = funcs
+  mainmenu()
@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  metrics.py
+#  Counters, gauges and histograms for every bot in the process,
+#   served in the Prometheus text format
+##
+#  Author: Chase LP
+###
+
+'''
+    Updating a metric is an addition to a number we already hold,
+     the text is only made when /metrics is fetched
+    Gauges for queue depths are functions called when fetched,
+     so nothing is done for them as the queues change
+'''
+
+import time, bisect, threading, functools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Histogram buckets, in seconds
+fastbuckets = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+waitbuckets = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+slowbuckets = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Around privmsg()'s 2 second delay and the 7, 30 and 45 second timeouts
+commandbuckets = (0.25, 0.5, 1, 2, 3, 5, 7, 10, 15, 30, 45, 60, 120, 300)
+
+''' escape
+    Returns a label value escaped for the text format
+'''
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labeltext(labels):
+  if len(labels) == 0:
+    return ''
+  return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+class CounterChild():
+  def __init__(self):
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+class GaugeChild():
+  def __init__(self):
+    self.value = 0
+    self.function = None
+
+  def set(self, value):
+    self.value = value
+
+  ''' setfunction
+      The gauge is the function's result whenever it is read
+  '''
+  def setfunction(self, function):
+    self.function = function
+
+  def get(self):
+    return self.value if self.function is None else self.function()
+
+class HistogramChild():
+  def __init__(self, buckets):
+    self.buckets = buckets
+    # One count per bucket and one for +Inf, not cumulative until written out
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+''' class Metric
+    A metric with its children, one for each set of label values
+
+    Attributes
+    name          - string, the metric's name
+    help          - string, its description
+    kind          - 'counter', 'gauge' or 'histogram'
+    labelnames    - tuple of strings
+    buckets       - for a histogram, the upper bounds of its buckets
+    children      - dict, tuple of label values -> child
+
+    Methods
+    labels        - Returns the child for some label values
+    lines         - Returns the metric in the text format
+'''
+class Metric():
+  def __init__(self, name, help, kind, labelnames=(), buckets=fastbuckets):
+    self.name = name
+    self.help = help
+    self.kind = kind
+    self.labelnames = tuple(labelnames)
+    self.buckets = tuple(buckets)
+    self.children = {}
+    self.lock = threading.Lock()
+
+  def labels(self, *values):
+    child = self.children.get(values)
+    if child is not None:
+      return child
+    if len(values) != len(self.labelnames):
+      raise ValueError(f'{self.name} has labels {self.labelnames}')
+    with self.lock:
+      if values not in self.children:
+        if self.kind == 'counter':
+          self.children[values] = CounterChild()
+        elif self.kind == 'gauge':
+          self.children[values] = GaugeChild()
+        else:
+          self.children[values] = HistogramChild(self.buckets)
+      return self.children[values]
+
+  def lines(self):
+    lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+    for values, child in list(self.children.items()):
+      labels = list(zip(self.labelnames, values))
+      if self.kind == 'counter':
+        lines.append(f'{self.name}{labeltext(labels)} {child.value}')
+      elif self.kind == 'gauge':
+        try:
+          value = child.get()
+        except Exception:
+          continue
+        lines.append(f'{self.name}{labeltext(labels)} {value}')
+      else:
+        counts, cumulative = list(child.counts), 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+          cumulative += count
+          lines.append(f'{self.name}_bucket{labeltext(labels + [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_sum{labeltext(labels)} {child.sum}')
+        lines.append(f'{self.name}_count{labeltext(labels)} {cumulative}')
+    return lines
+
+''' class Registry
+    Methods
+    counter       - Adds and returns a counter
+    gauge         - Adds and returns a gauge
+    histogram     - Adds and returns a histogram
+    exposition    - Returns every metric in the text format
+'''
+class Registry():
+  def __init__(self):
+    self.metrics = []
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def counter(self, name, help, labelnames=()):
+    return self.add(Metric(name, help, 'counter', labelnames))
+
+  def gauge(self, name, help, labelnames=()):
+    return self.add(Metric(name, help, 'gauge', labelnames))
+
+  def histogram(self, name, help, labelnames=(), buckets=fastbuckets):
+    return self.add(Metric(name, help, 'histogram', labelnames, buckets))
+
+  def exposition(self):
+    lines = []
+    for metric in self.metrics:
+      lines.extend(metric.lines())
+    return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+ircbytes = registry.counter('shadowbot_irc_bytes_total',
+                            'Bytes received from and sent to IRC', ('bot', 'direction'))
+irclines = registry.counter('shadowbot_irc_lines_total',
+                            'Lines received from and sent to IRC', ('bot', 'direction'))
+pingseconds = registry.histogram('shadowbot_irc_ping_seconds',
+                                 'Round trip of our PING to the IRC server', ('bot',))
+awaitseconds = registry.histogram('shadowbot_await_seconds',
+                                  'Time spent in awaitresponse', ('bot',), waitbuckets)
+combatseconds = registry.histogram('shadowbot_combat_seconds',
+                                   'Duration of each combat', ('bot',), slowbuckets)
+kills = registry.counter('shadowbot_kills_total', 'Enemies killed', ('bot',))
+lootnuyen = registry.counter('shadowbot_loot_nuyen_total', 'Nuyen looted', ('bot',))
+lootxp = registry.counter('shadowbot_loot_xp_total', 'XP from kills', ('bot',))
+iterationseconds = registry.histogram('shadowbot_iteration_seconds',
+                                      'Duration of each loop iteration',
+                                      ('bot', 'loop'), slowbuckets)
+reconnects = registry.counter('shadowbot_reconnects_total',
+                              'Times the bot was connected again', ('bot',))
+exceptions = registry.counter('shadowbot_exceptions_total',
+                              'Exceptions in loop functions and pre-commands', ('bot',))
+commandseconds = registry.histogram('shadowbot_command_seconds',
+                                    'Lamb command round trips, to the first response'
+                                    ' and until done', ('bot', 'verb', 'stage'),
+                                    commandbuckets)
+queuedepth = registry.gauge('shadowbot_queue_depth',
+                            'Things waiting to be sent or applied', ('bot', 'queue'))
+
+''' class BotMetrics
+    The children of every metric for one bot, looked up once
+
+    Methods
+    iteration     - Observes the seconds of an iteration of a loop
+    queue         - Returns the gauge of a queue's depth
+    command       - Returns the histogram of a command verb's latency
+'''
+class BotMetrics():
+  def __init__(self, nick):
+    self.nick = nick
+    self.bytesin = ircbytes.labels(nick, 'in')
+    self.bytesout = ircbytes.labels(nick, 'out')
+    self.linesin = irclines.labels(nick, 'in')
+    self.linesout = irclines.labels(nick, 'out')
+    self.ping = pingseconds.labels(nick)
+    self.awaiting = awaitseconds.labels(nick)
+    self.combat = combatseconds.labels(nick)
+    self.kills = kills.labels(nick)
+    self.lootnuyen = lootnuyen.labels(nick)
+    self.lootxp = lootxp.labels(nick)
+    self.reconnects = reconnects.labels(nick)
+    self.exceptions = exceptions.labels(nick)
+
+  def iteration(self, loop, seconds):
+    iterationseconds.labels(self.nick, loop).observe(seconds)
+
+  def queue(self, name):
+    return queuedepth.labels(self.nick, name)
+
+  def command(self, verb, stage):
+    return commandseconds.labels(self.nick, verb, stage)
+
+botmetricslock = threading.Lock()
+botmetricsbynick = {}
+
+''' botmetrics
+    Returns the BotMetrics for a nick, the same one every time,
+     so a bot connected again carries on counting
+'''
+def botmetrics(nick):
+  with botmetricslock:
+    if nick not in botmetricsbynick:
+      botmetricsbynick[nick] = BotMetrics(nick)
+    return botmetricsbynick[nick]
+
+''' timed
+    Decorates a method, observing the seconds each call takes
+     in the histogram named by the attribute of self.metrics
+'''
+def timed(attribute):
+  def decorate(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      start = time.time()
+      try:
+        return method(self, *args, **kwargs)
+      finally:
+        getattr(self.metrics, attribute).observe(time.time() - start)
+    return wrapper
+  return decorate
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = self.server.registry.exposition().encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  # Scrapes aren't worth a line on the console
+  def log_message(self, format, *args):
+    pass
+
+''' serve
+    Serves /metrics from a daemon thread, returns the server
+    Only on localhost unless another host is given
+'''
+def serve(port, host='127.0.0.1', registry=registry):
+  server = ThreadingHTTPServer((host, port), MetricsHandler)
+  server.daemon_threads = True
+  server.registry = registry
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  querycache.py
+#  Responses to the Lamb bot's info commands, kept until they expire
+#   or a message tells us they have changed
+##
+#  Author: Chase LP
+###
+
+import time
+
+# Seconds a response stays fresh, by command verb
+# "#inventory" isn't here, the inventory index follows loot and sales itself
+ttls = {'#kp':3600, '#kw':3600, '#level':600, '#party':30}
+
+# Messages that make a command's response out of date, by command verb
+# There is no message we know of for learning a word, #kw only expires
+invalidators = {
+  # Arriving somewhere, or a fight, changes what the party is doing
+  '#party':     ('You enter', 'You arrive', 'now outside of', 'You continue inside',
+                 'You are fighting', 'ENCOUNTER', 'joined the party',
+                 'left the party'),
+  # Someone in the party levels up
+  '#level':     ('joined the party', 'left the party',
+                 'advanced to level', 'reached level'),
+  # Exploring can find new places, the bare #kp also tells us where we are
+  '#kp':        ('explored', 'You enter', 'You arrive', 'now outside of',
+                 'You continue inside'),
+}
+
+''' class QueryCache
+    Entries are keyed on the full command, '#kp Redmond',
+     TTLs and invalidation are by its verb, '#kp'
+
+    Attributes
+    ttls          - dict, command verb -> seconds a response stays fresh
+    entries       - dict, command -> (time, response)
+    hits          - number of lookups answered from the cache
+    misses        - number of lookups that had to ask the server
+    invalidated   - number of entries dropped because a message changed them
+
+    Methods
+    fresh         - Returns True if a command has a response that hasn't expired
+    get           - Returns a fresh response for a command, or None
+    put           - Saves the response to a command
+    invalidate    - Drops the responses for a command verb
+    observe       - Drops the responses a stripped Lamb message has changed
+    report        - Returns a string with the hit / miss counters
+'''
+class QueryCache():
+  def __init__(self, ttls=ttls):
+    self.ttls = dict(ttls)
+    self.entries = {}
+    self.hits = 0
+    self.misses = 0
+    self.invalidated = 0
+
+  def verb(self, command):
+    return command.split(' ')[0]
+
+  ''' fresh
+      Returns True if we have a response for the command that hasn't expired
+      This doesn't count as a hit or a miss
+  '''
+  def fresh(self, command):
+    entry = self.entries.get(command)
+    ttl = self.ttls.get(self.verb(command), 0)
+    return entry is not None and time.time() - entry[0] <= ttl
+
+  def get(self, command):
+    if not self.fresh(command):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return self.entries[command][1]
+
+  def put(self, command, response):
+    self.entries[command] = (time.time(), response)
+
+  def invalidate(self, verb):
+    for command in [command for command in self.entries
+                            if self.verb(command) == verb]:
+      del self.entries[command]
+      self.invalidated += 1
+
+  ''' observe
+      Returns True if the line invalidated any response
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    changed = False
+    for verb, msgs in invalidators.items():
+      if any(msg in line for msg in msgs):
+        self.invalidate(verb)
+        changed = True
+    return changed
+
+  def report(self):
+    total = self.hits + self.misses
+    ratio = 100 * self.hits / total if total > 0 else 0
+    return f'{self.hits} hits, {self.misses} misses ({ratio:.0f}% hits),' + \
+           f' {self.invalidated} invalidated, {len(self.entries)} cached'
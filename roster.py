@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  roster.py
+#  Keeps track of the members of our party, their levels and HP/MP
+##
+#  Author: Chase LP
+###
+
+import re, time
+
+# Party members listed by #level, '1-chaseleif{57}(L59(101))'
+levelmember = re.compile(r'(\d+)-([^{ ,]+){(\d+)}\(L(\d+)')
+# Any party member, '1-chaseleif{57}' or 'chaseleif{57}'
+anymember = re.compile(r'(?:(\d+)-)?([^{ ,.]+){(\d+)}')
+# A member and their HP, from an attack or a spell
+# 4-Ninja[8027866] attacks 1-chaseleif{57} with NinjaSword and caused 0.4 damage, 72.2/72.6HP left
+memberhp = re.compile(r'(?:(\d+)-)?([^{ ,.]+){(\d+)}[^{\[]*?([\d.]+)/([\d.]+)HP')
+# chaseleif{57} joined the party / chaseleif{57} left the party
+joinpart = re.compile(r'(?:\d+-)?([^{ ,]+){(\d+)} (joined|left) the party$')
+# HP or MP in #status, 'HP :58.5/72.6, MP :135.38/135.38', or after a member
+#  in #party, '1-chaseleif{57}(L59(101)) 58.5/72.6HP 135.38/135.38MP'
+pools = {kind:re.compile(kind + r' ?:([\d.]+)/([\d.]+)|([\d.]+)/([\d.]+) ?' + kind)
+         for kind in ('HP', 'MP')}
+
+# Seconds before an HP/MP sample is too old to decide who to heal
+maxage = 120
+
+''' pool
+    Returns (current, max) of 'HP' or 'MP' in a string, or None
+'''
+def pool(kind, text):
+  match = pools[kind].search(text)
+  if match is None:
+    return None
+  groups = [group for group in match.groups() if group is not None]
+  return float(groups[0]), float(groups[1])
+
+''' class PartyMember
+    Attributes
+    name          - string, the player's nick
+    server        - string, the player's server number
+    pos           - None or a string, the last seen combat position number
+    level         - None or an integer
+    hp, maxhp     - None or floats, the latest HP sample
+    mp, maxmp     - None or floats, the latest MP sample
+    updated       - time of the latest HP/MP sample
+
+    Methods
+    health        - Returns the fraction of HP remaining
+    sample        - Takes the HP and MP in a string
+'''
+class PartyMember():
+  def __init__(self, name, server):
+    self.name = name
+    self.server = server
+    self.pos = None
+    self.level = None
+    self.hp = self.maxhp = None
+    self.mp = self.maxmp = None
+    self.updated = 0
+
+  @property
+  def key(self):
+    return self.name + '{' + self.server + '}'
+
+  ''' health
+      Returns the fraction of HP remaining, or None if we have no sample
+  '''
+  def health(self):
+    if self.hp is None or not self.maxhp:
+      return None
+    return self.hp / self.maxhp
+
+  ''' sample
+      Returns True if the string had our HP or MP
+  '''
+  def sample(self, text):
+    hp, mp = pool('HP', text), pool('MP', text)
+    if hp is not None:
+      self.hp, self.maxhp = hp
+    if mp is not None:
+      self.mp, self.maxmp = mp
+    if hp is None and mp is None:
+      return False
+    self.updated = time.time()
+    return True
+
+  def __str__(self):
+    s = f' ~ Party {self.key}'
+    if self.level is not None: s += f' L{self.level}'
+    if self.hp is not None: s += f' {self.hp}/{self.maxhp}HP'
+    if self.mp is not None: s += f' {self.mp}/{self.maxmp}MP'
+    return s
+
+''' class PartyRoster
+    Attributes
+    members       - dict, member key ('name{server}') -> PartyMember
+    version       - integer, increases when a member joins or leaves
+    me            - None, or our own key, the member a #status is about
+
+    Methods
+    observe       - Updates the roster from a stripped message from the Lamb bot
+    get           - Returns the PartyMember for a name{server} key, or None
+    join, leave   - Adds or removes a member
+    mosturgent    - Returns the member with the lowest fraction of HP remaining,
+                     of those with a recent sample
+'''
+class PartyRoster():
+  def __init__(self):
+    self.members = {}
+    self.version = 0
+    self.me = None
+
+  def __contains__(self, key):
+    return key in self.members
+
+  def __iter__(self):
+    return iter(self.members.values())
+
+  def __len__(self):
+    return len(self.members)
+
+  def get(self, key):
+    return self.members.get(key)
+
+  def join(self, name, server):
+    key = name + '{' + server + '}'
+    if key not in self.members:
+      self.members[key] = PartyMember(name, server)
+      self.version += 1
+    return self.members[key]
+
+  def leave(self, name, server):
+    if self.members.pop(name + '{' + server + '}', None) is not None:
+      self.version += 1
+
+  ''' observe
+      Returns True if the line changed the roster
+
+      Parameters
+      line        - string, a stripped message from the Lamb bot
+  '''
+  def observe(self, line):
+    # Someone joined or left
+    match = joinpart.search(line)
+    if match is not None:
+      name, server, action = match.groups()
+      if action == 'joined': self.join(name, server)
+      else: self.leave(name, server)
+      return True
+    # The response from #level lists everyone in the party with levels
+    if 'has level' in line:
+      listed = levelmember.findall(line)
+      if len(listed) == 0:
+        return False
+      keys = set()
+      for pos, name, server, level in listed:
+        member = self.join(name, server)
+        member.pos = pos
+        member.level = int(level)
+        keys.add(member.key)
+      self.prune(keys)
+      return True
+    # The response from #party lists everyone in the party, with their HP/MP
+    if line.startswith('Your party'):
+      listed = list(anymember.finditer(line))
+      if len(listed) == 0:
+        return False
+      keys = set()
+      for num, match in enumerate(listed):
+        pos, name, server = match.groups()
+        member = self.join(name, server)
+        if pos is not None: member.pos = pos
+        # A member's HP/MP are between their name and the next member's
+        end = listed[num+1].start() if num+1 < len(listed) else len(line)
+        member.sample(line[match.end():end])
+        keys.add(member.key)
+      self.prune(keys)
+      return True
+    # The response from #status has our own HP/MP
+    if self.me is not None and ' Weight :' in line and 'HP :' in line:
+      name, server = self.me[:-1].split('{')
+      return self.join(name, server).sample(line)
+    # A combat line or a spell telling us someone's HP
+    match = memberhp.search(line)
+    if match is not None:
+      pos, name, server, hp, maxhp = match.groups()
+      member = self.members.get(name + '{' + server + '}')
+      if member is None:
+        return False
+      if pos is not None: member.pos = pos
+      member.hp = float(hp)
+      member.maxhp = float(maxhp)
+      member.updated = time.time()
+      return True
+    return False
+
+  ''' prune
+      Removes members whose key isn't in keys
+  '''
+  def prune(self, keys):
+    for key in [key for key in self.members if key not in keys]:
+      del self.members[key]
+      self.version += 1
+
+  ''' mosturgent
+      Returns the member with the lowest fraction of HP remaining
+      Returns None if we have no HP samples newer than maxage
+
+      Parameters
+      below       - float, only consider members with less health than this
+      maxage      - seconds, older samples may be from a fight long over
+  '''
+  def mosturgent(self, below=1.0, maxage=maxage):
+    urgent = None
+    for member in self.members.values():
+      health = member.health()
+      if health is None or health >= below or time.time() - member.updated > maxage:
+        continue
+      if urgent is None or health < urgent.health():
+        urgent = member
+    return urgent
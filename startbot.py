@@ -25,360 +25,292 @@
 #  Author: Chase LP
 ###
 
-import sys, time
+'''
+    startbot.py [passfile]                      - Connects and shows the menus
+    startbot.py --headless --loop explore       - Connects and starts the loop,
+                                                  no menus are imported or shown
+
+    --config FILE     A JSON file with an account and settings, e.g.,
+                      {"passfile": "pass3", "doloop": "explore", "invstop": 12}
+                      The account is "passfile", or "username", "password",
+                      "server" and "port", "doloop" is the loop to start
+                      Anything else is a setting in botconfig.py
+    --loop NAME       The loop function to start
+    --precmd CMD      A command to run before the loop, may be given again
+    --escort NICK     Escort a player, the loop is 'escort'
+    --lambbot NICK    The Lamb bot's nick
+    --server HOST     The IRC server, --port PORT its port
+    --set NAME=VALUE  Any setting, VALUE is JSON or else a string
+    --control SOCKET  Serve the JSON control API of controlapi.py on a Unix socket
+    --metrics PORT    Serve Prometheus metrics on http://127.0.0.1:PORT/metrics
+
+    Later sources win: the pass file, then --config, then the other flags
+    In headless mode ctrl-c lets the loop finish its activity, a second
+     ctrl-c or SIGTERM quits more immediately
+'''
+
+import sys, json, signal, argparse
+import botconfig
 from irchandler import IRCHandler
 from bot import ShadowThread
 
 passfilename = 'pass3'
 
-if __name__ == '__main__' and len(sys.argv) == 2:
-  passfilename = sys.argv[1]
-
-# The ShadowThread object we will interact with
-thread = None
-
-# Read the user/pass, connect to irc, instantiate the thread object
-with open(passfilename) as infile:
-  lines = infile.readlines()
-  # The username is by itself on the first line
-  username = lines[0].strip()
-  # The password is by itself on the second line
-  userpass = lines[1].strip()
-  # Then the bot nick
-  lambnick = lines[2].strip()
-  # The server is next
-  server = lines[3].strip()
-  # Connect to irc with the IRCHandler
-  # The IRCHandler object is given to the ShadowThread constructor
-  print(f'| Connecting as user {username}')
-  thread = ShadowThread(IRCHandler( server=server,
-                                    port=6667,
-                                    botnick=username,
-                                    botpass=userpass
-                                  ),
-                        lambnick)
-  del username, userpass, lambnick, server
+# Keys of a config file that are the account rather than a setting
+accountkeys = ('passfile', 'username', 'password', 'server', 'port')
 
 # These are methods of the ShadowThread object that are for internal use only
 # These methods should not be called in the printloop method
 unavailfuncs = ['islambmsg',
                 'getlambmsg',
+                'observe',
                 'sleepreceive',
                 'awaitresponse',
-                'cityrank',
+                'whereami',
                 'walkpath',
                 'gotoloc',
                 'printloop',
                 'handlecombat',
                 'invflush',
+                'syncinventory',
+                'disposeitems',
+                'meet',
+                'load',
+                'status',
+                'needrest',
+                'query',
+                'cachereport',
+                'prefetch',
+                'send',
+                'wait',
+                'expirecommands',
+                'rest',
+                'exploremachine',
+                'getbaconmachine',
+                'forestmachine',
+                'statusstates',
+                'travelstates',
+                'reststates',
+                'shedstates',
+                'needstatus',
+                'precmdsteps',
+                'receive',
+                'runsteps',
+                'needshed',
+                'shedroom',
                 'setlambbot',
+                'setconfig',
+                'control',
+                'applycontrols',
                 'colorprint',
                 'print',
-                'togglecolors'
+                'togglecolors',
+                'enemyreport',
+                'itemreport',
+                'latencyreport',
+                'sent'
                ]
 
-# Get a list of available functions
-# This is used for printing available functions
-#  and confirming that a valid function is selected (when changed)
-availfuncs = []
-# Go through the dir() of the ShadowThread object
-for func in dir(thread):
-  # Don't take any attribute or method that begins with an underscore
-  if func.startswith('_'):
-    pass
-  # Only take methods that can be called
-  elif not callable(getattr(thread,func)):
-    pass
-  # These methods are for internal use only
-  elif func in unavailfuncs:
-    pass
-  # This is a user-defined method for the printloop method
-  else:
-    availfuncs.append(func)
+''' loopfunctions
+    Returns the names of the thread's methods a user may choose as its loop
+    This is used for printing available functions
+     and confirming that a valid function is selected (when changed)
+'''
+def loopfunctions(thread):
+  availfuncs = []
+  # Go through the dir() of the ShadowThread object
+  for func in dir(thread):
+    # Don't take any attribute or method that begins with an underscore
+    if func.startswith('_'):
+      pass
+    # Only take methods that can be called
+    elif not callable(getattr(thread,func)):
+      pass
+    # These methods are for internal use only
+    elif func in unavailfuncs:
+      pass
+    # This is a user-defined method for the printloop method
+    else:
+      availfuncs.append(func)
+  return availfuncs
 
-# The previous recipient of a private message from this bot
-# Used to ease sending repeated manual messages to some nick
-lastrecipient = ''
+''' readpassfile
+    Returns the account in a pass file as a dict
+    The username, password, Lamb bot nick and server are each on their own line
+'''
+def readpassfile(filename):
+  with open(filename) as infile:
+    lines = [line.strip() for line in infile.readlines()]
+  return {'username':lines[0], 'password':lines[1],
+          'lambbot':lines[2], 'server':lines[3]}
 
-def botcmdmenu():
-  while True:
-    print(' ___')
-    print('| These commands will be ran before the function loop starts')
-    print('| Each either:')
-    print('| Issue a command to the Lambbot, e.g., \"#cast berzerk\"')
-    print('| Send a player a message, e.g., \"msg nick a message\"')
-    print('| Sleep for about some time, e.g., \"sleep(30)\"')
-    print('|')
-    print(f'| Current commands: {thread.precmds}')
-    print('| 1) Add a command')
-    if len(thread.precmds) > 0:
-      print('| 2) Remove a command')
-      print('| 3) Clear commands')
-    print('| 0) Return to bot menu')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      newcmd = input('| Enter a new command: ')
-      if newcmd != '':
-        thread.precmds.append(newcmd)
-    elif response == '2' and len(thread.precmds) > 0:
-      delcmd = input('| Enter the command to remove: ')
-      try:
-        thread.precmds.remove(delcmd)
-      except Exception as e:
-        print(f'| Exception: {e}')
-    elif response == '3' and len(thread.precmds) > 0:
-      thread.precmds = []
-    elif response == '0':
-      break
-    else:
-      time.sleep(1)
+''' loadspec
+    Returns (account, doloop, config) for a dict read from a config file
+    A "passfile" is read first, the other keys override it
+    Raises a ValueError for a bad setting
 
-def botescortmenu():
-  while True:
-    print(' ___')
-    print('| Escort options')
-    print(f'| Escorting: {thread.escortnick}')
-    print('| 1) Set escort nick')
-    print('| 2) Set prohibited commands for the \"docmd\" command')
-    print('| 3) Accept configuration')
-    if thread.escortcasts:
-      print('| 4) Set that your escort can\'t cast spells')
-    else:
-      print('| 4) Set that your escort can cast spells')
-    print('| 0) Cancel escort')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      thread.escortnick = input('| Enter the nick to escort: ')
-    elif response == '2':
-      while True:
-        print('| Block when any word is matched in an escorted players docmd')
-        print(f'| Prohibited words: {thread.badcmds}')
-        print('|')
-        print('| Short+long forms of many commands are prohibited by default')
-        print('| Commands affecting our player are also prohibited')
-        print('|')
-        print('| 1) Add prohibited word (must match a word of the command)')
-        print('| 2) Remove word from prohibited list')
-        print('| 0) Return to escort options')
-        response = input('| Enter your selection: ')
-        if response == '1':
-          response = input('| Enter new prohibited word: ')
-          if response != '':
-            thread.badcmds.append(response)
-        elif response == '2':
-          response = input('| Enter word to remove: ')
-          try:
-            thread.badcmds.remove(response)
-          except Exception as e:
-            print(f'Exception: {e}')
-        elif response == '0':
-          break
-        else:
-          time.sleep(1)
-    elif response == '3':
-      if thread.escortnick != '':
-        return 'escort'
-      return None
-    elif response == '4':
-      if thread.escortcasts: thread.escortcasts = False
-      else: thread.escortcasts = True
-    elif response == '0':
-      return None
-    else:
-      time.sleep(1)
+    Parameters
+    spec          - dict, account keys, "doloop" and settings
+    base          - BotConfig, for the settings the spec doesn't have
+'''
+def loadspec(spec, base=botconfig.BotConfig()):
+  spec = dict(spec)
+  account = {'port':6667}
+  if 'passfile' in spec:
+    account.update(readpassfile(spec.pop('passfile')))
+  for key in accountkeys[1:]:
+    if key in spec:
+      account[key] = spec.pop(key)
+  # The pass file's Lamb bot nick is a setting
+  if 'lambbot' in account and 'lambbot' not in spec:
+    spec['lambbot'] = account.pop('lambbot')
+  account.pop('lambbot', None)
+  doloop = spec.pop('doloop', None)
+  return account, doloop, base.replace(**spec)
 
-def travelmenu():
-  while True:
-    print(' ___')
-    print('| Travel and combat options:')
-    print(f'| 1) Set word to say on \'Meet\' events ({thread.meetsay})')
-    print(f'| 2) Set number of bums needed to kill ({thread.bumsleft})')
-    if thread.attacklow:
-      print('| 3) Set attack priority to high levels first')
-    else:
-      print('| 3) Set attack priority to low levels first (the default)')
-    if thread.cancast:
-      print('| 4) Disable casting (teleport + calm + heal)')
-    else:
-      print('| 4) Enable casting (teleport + calm + heal)')
-    print(f'| 5) Set sell location for explore loop ({thread.store})')
-    print('| 0) Return to the bot menu')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      newword = input('| Enter what the bot says on meet: ')
-      thread.meetsay = newword
-    elif response == '2':
-      print(' ___')
-      print(f'| Currently need to kill {thread.bumsleft} more bum',end='')
-      if thread.bumsleft != 1: print('s',end='')
-      newval = input('\n| Enter the number of bums to kill: ')
-      try:
-        newval = int(newval)
-        if newval < 0:
-          newval = 0
-        thread.bumsleft = newval
-      except Exception as e:
-        print('| Exception: ' + str(e))
-    elif response == '3':
-      if thread.attacklow: thread.attacklow = False
-      else: thread.attacklow = True
-    elif response == '4':
-      if thread.cancast: thread.cancast = False
-      else: thread.cancast = True
-    elif response == '5':
-      newval = input('| Enter sell location: ')
-      if input(f'| Confirm location \"{newval}\" (y/N): ').startswith('y'):
-        thread.store = newval
-    elif response == '0':
-      break
-    else:
-      time.sleep(1)
+''' connect
+    Connects an account to irc, returns its ShadowThread
+'''
+def connect(account, config):
+  print(f'| Connecting as user {account["username"]}')
+  # The IRCHandler object is given to the ShadowThread constructor
+  return ShadowThread(IRCHandler( server=account['server'],
+                                  port=account['port'],
+                                  botnick=account['username'],
+                                  botpass=account['password']
+                                ),
+                      config=config)
 
-def botmenu():
-  while True:
-    print(' ___')
-    print(f'| Bot ({thread.irc.username}) Configuration:')
-    print(f'| 1) Set the Lamb bot nick ({thread.lambbot})')
-    print('| 2) Set the stop value for selling / pushing items to bank',
-          f'({thread.invstop})')
-    print('| 3) Set travel and combat options')
-    print('| 4) Set escort options')
-    print('| 5) Set command list to run before function loop')
-    print(f'| 6) Change the function loop ({thread.doloop})')
-    if thread.doloop is not None:
-      print('| 7) Clear current function loop')
-    print('| 0) Return to the main menu')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      newnick = input('| Enter the Lamb bot\'s nick: ')
-      thread.setlambbot(newnick)
-    elif response == '2':
-      print(f'| Currently the stop value is {thread.invstop}')
-      print('| Less than 1 indicates to not shed inventory')
-      print('| A positive value indicates',
-            'the highest number of inventory to sell')
-      newval = input('| Enter the inventory stop position: ')
-      try:
-        newval = int(newval)
-        if newval < 0:
-          newval = 0
-        thread.invstop = newval
-      except Exception as e:
-        print(f'| Exception: {e}')
-    elif response == '3':
-      travelmenu()
-    elif response == '4':
-      botescortmenu()
-    elif response == '5':
-      botcmdmenu()
-    elif response == '6':
-      print(' ___')
-      print(f'| Bot function is {thread.doloop}')
-      print('| Available functions are', ', '.join(availfuncs))
-      newfunc = input('| Enter a function name: ')
-      if newfunc in availfuncs:
-        if newfunc == 'escort':
-          newfunc = botescortmenu()
-        thread.doloop = newfunc
-      else:
-        print('| Invalid function name')
-    elif response == '7' and thread.doloop is not None:
-      thread.doloop = None
-    elif response == '0':
-      break
-    else:
-      time.sleep(1)
+''' startloop
+    Starts a loop function on a thread, raises a ValueError for an unknown loop
+'''
+def startloop(thread, doloop):
+  if doloop not in loopfunctions(thread):
+    raise ValueError(f'Unknown loop function {doloop}')
+  if doloop == 'escort' and thread.escortnick == '':
+    raise ValueError('The escort loop needs an escort nick')
+  thread.control('doloop', doloop)
 
-def ircmenu():
-  global lastrecipient
-  while True:
-    print(' ___')
-    print('| IRC Commands:')
-    print('| 1) Join a channel')
-    print('| 2) Send a message to a nick or channel')
-    print(f'| 3) Send a message to {thread.lambbot}')
-    if lastrecipient != '':
-      print(f'| 4) Send a message to {lastrecipient}')
-    print('| 0) Return to the main menu')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      chan = input('| Enter the channel name to join: ')
-      if chan != '1':
-        thread.irc.joinchan(chan)
-    elif response == '2':
-      recipient = input('| Enter the recipient: ')
-      if recipient == '2':
-        continue
-      if recipient != thread.lambbot and recipient != '':
-        lastrecipient = recipient
-      msg = input('| Enter the message: ')
-      if msg != '' and msg != '2':
-        thread.irc.privmsg(recipient, msg, delay=0)
-    elif response == '3':
-      msg = input('| Enter the message: ')
-      if msg != '' and msg != '3':
-        thread.irc.privmsg(thread.lambbot, msg, delay=0)
-    elif response == '4' and lastrecipient != '':
-      msg = input('| Enter the message: ')
-      if msg != '4':
-        thread.irc.privmsg(lastrecipient, msg, delay=0)
-    elif response == '0':
-      break
-    else:
-      time.sleep(1)
+''' headless
+    Waits on a thread until it quits, with signals in place of the quit menu
+'''
+def headless(thread):
+  def terminate(signum, frame):
+    thread.control('doloop', None)
+    thread.control('doquit', True)
+  signal.signal(signal.SIGTERM, terminate)
+  try:
+    while thread.th.is_alive():
+      thread.th.join(1)
+  except KeyboardInterrupt:
+    print('| Finishing current activity, ctrl-c again to abort . . .')
+    thread.control('doloop', None)
+    thread.control('softquit', True)
+    try:
+      while thread.th.is_alive():
+        thread.th.join(1)
+    except KeyboardInterrupt:
+      terminate(None, None)
+      thread.th.join()
+  print('| Goodbye')
 
-def mainmenu():
-  while True:
-    print(' ___')
-    print('| Main Menu:')
-    print('| 1) Bot configuration')
-    print('| 2) IRC commands')
-    print('| 3) Quit')
-    print(f'| 4) Toggle colors ({thread.colors})')
-    print('| 5) Hide menu')
-    response = input('| Enter your selection: ')
-    if response == '1':
-      botmenu()
-    elif response == '2':
-      ircmenu()
-    elif response == '3':
-      print(' ___')
-      print('| Quit')
-      print('| 1) Allow thread to finish its current activity before exit')
-      print('| 2) More immediately abort thread and quit')
-      print('| (anything else to cancel)')
-      response = input('| Enter your selection: ')
-      if response == '1':
-        thread.doloop = None
-        thread.softquit = True
-        print('| Finishing current activity, joining thread . . .')
-        thread.th.join()
-        print('| Goodbye')
-        break
-      if response == '2':
-        print('| Aborting current activity, joining thread . . .')
-        thread.doloop = None
-        thread.doquit = True
-        #time.sleep(2)
-        thread.th.join()
-        print('| Goodbye')
-        break
-    elif response == '4':
-      thread.togglecolors()
-    elif response == '5':
-      print(' ___')
-      input('| Hiding menu until the enter key is pressed . . .\n')
-    else:
-      time.sleep(1)
+''' parseargs
+    Returns the argparse namespace for the command line
+'''
+def parseargs(argv):
+  parser = argparse.ArgumentParser(description='Runs a bot for the Shadow Lamb bot')
+  parser.add_argument('passfile', nargs='?', default=None,
+                      help=f'the account\'s pass file, {passfilename} by default')
+  parser.add_argument('--config', help='a JSON file with an account and settings')
+  parser.add_argument('--headless', action='store_true',
+                      help='start without the menus')
+  parser.add_argument('--loop', help='the loop function to start')
+  parser.add_argument('--precmd', action='append', default=[],
+                      help='a command to run before the loop')
+  parser.add_argument('--escort', help='the nick to escort')
+  parser.add_argument('--lambbot', help='the Lamb bot\'s nick')
+  parser.add_argument('--server', help='the IRC server')
+  parser.add_argument('--port', type=int, help='the IRC server\'s port')
+  parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                      help='any setting, the value as JSON or a string')
+  parser.add_argument('--control', metavar='SOCKET',
+                      help='serve the JSON control API on this Unix socket')
+  parser.add_argument('--metrics', metavar='PORT', type=int,
+                      help='serve Prometheus metrics on this localhost port')
+  return parser.parse_args(argv)
 
-print('\n',
-      '_____\n|',
-      'shadowbot  Copyright (C) 2022  Chase Phelps\n|',
-      'This program comes with ABSOLUTELY NO WARRANTY.\n|',
-      'This is free software,',
-      'and you are welcome to redistribute it under certain conditions\n',
-      '_____')
+''' specfromargs
+    Returns the spec for loadspec from the command line
+'''
+def specfromargs(args):
+  spec = {}
+  if args.config is not None:
+    with open(args.config) as infile:
+      spec = json.load(infile)
+    if not isinstance(spec, dict):
+      raise ValueError(f'{args.config}: expected an object')
+  if args.passfile is not None:
+    spec['passfile'] = args.passfile
+  elif not any(key in spec for key in accountkeys):
+    spec['passfile'] = passfilename
+  for name, value in (('lambbot', args.lambbot), ('server', args.server),
+                      ('port', args.port), ('doloop', args.loop)):
+    if value is not None:
+      spec[name] = value
+  if len(args.precmd) > 0:
+    spec['precmds'] = list(spec.get('precmds', [])) + args.precmd
+  if args.escort is not None:
+    spec['escortnick'] = args.escort
+    spec['doloop'] = 'escort'
+  for setting in args.set:
+    name, sep, value = setting.partition('=')
+    if sep == '':
+      raise ValueError(f'--set {setting}: expected NAME=VALUE')
+    try:
+      spec[name] = json.loads(value)
+    except json.JSONDecodeError:
+      spec[name] = value
+  return spec
 
-# Begin the driver loop
-mainmenu()
+def main(argv):
+  args = parseargs(argv)
+  try:
+    account, doloop, config = loadspec(specfromargs(args))
+  except (OSError, ValueError, IndexError) as e:
+    sys.exit(f'| {e}')
+  thread = connect(account, config)
+  # The password is not kept in memory after use
+  del account
+  if args.control is not None:
+    # Only imported when asked for, like the menus
+    from controlapi import ControlServer
+    ControlServer(args.control, lambda: {thread.irc.username:thread})
+  if args.metrics is not None:
+    import metrics
+    metrics.serve(args.metrics)
+  if doloop is not None:
+    try:
+      startloop(thread, doloop)
+    except ValueError as e:
+      print(f'| {e}')
+      if args.headless:
+        thread.control('doquit', True)
+        thread.th.join()
+        sys.exit(1)
+  if args.headless:
+    headless(thread)
+    return
+  # Only the interactive mode needs the menus
+  import menus
+  print('\n',
+        '_____\n|',
+        'shadowbot  Copyright (C) 2022  Chase Phelps\n|',
+        'This program comes with ABSOLUTELY NO WARRANTY.\n|',
+        'This is free software,',
+        'and you are welcome to redistribute it under certain conditions\n',
+        '_____')
+  # Begin the driver loop
+  menus.run(thread, loopfunctions(thread))
 
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,326 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  statemachine.py
+#  Loop functions declared as states and transitions on typed events,
+#   and a scheduler driving the machines from the bot's thread
+##
+#  Author: Chase LP
+###
+
+import time, selectors
+from collections import namedtuple
+
+# An event for a machine
+# kind is one of the kinds below, 'line', 'timeout', or 'done' when an
+#  activity ends without a line
+# line is the stripped Lamb message, '' for a timeout
+Event = namedtuple('Event', ['kind', 'line'])
+
+# Kinds of events, a line is the first kind with a message found in it
+eventkinds = [('combat',   ('You ENCOUNTER', 'You are fighting')),
+              ('meet',     ('You meet ',)),
+              ('rested',   ('ready to go', 'You don\'t need to rest')),
+              ('arrived',  ('You enter', 'now outside of', 'You arrive',
+                            'You continue inside')),
+              ('explored', ('explored',)),
+              ('status',   (' Weight :',)),
+              ('error',    ('The command is not available', 'Unknown command')),
+             ]
+
+''' sendcmd
+    Returns an enter function sending a command to the Lamb bot
+'''
+def sendcmd(command):
+  def enter(bot):
+    bot.irc.privmsg(bot.lambbot, command, delay=0)
+  return enter
+
+''' awaiting
+    Returns the transitions once a line has a message in it, whatever kind
+     of event the line is, to a state or a function(bot, event) returning one
+'''
+def awaiting(msg, then):
+  def check(bot, event):
+    if msg not in event.line:
+      return None
+    return then(bot, event) if callable(then) else then
+  return {kind:check for kind in ['line'] + [kind for kind, _ in eventkinds]}
+
+''' classify
+    Returns the Event for a stripped Lamb message
+'''
+def classify(line):
+  for kind, msgs in eventkinds:
+    if any(msg in line for msg in msgs):
+      return Event(kind, line)
+  return Event('line', line)
+
+''' class State
+    Attributes
+    name          - string
+    enter         - None, or a function(bot) run when the state is entered,
+                     returning None to stay, the name of the next state,
+                     or an activity to run in the state
+    on            - dict, event kind -> the name of the next state,
+                     or a function(bot, event) returning a name or None to stay
+    timeout       - None, or the seconds until a 'timeout' event
+    delay         - seconds after entering before enter is run,
+                     the same courtesy as the delay in IRCHandler.privmsg
+'''
+class State():
+  def __init__(self, name, enter=None, on=None, timeout=None, delay=0):
+    self.name = name
+    self.enter = enter
+    self.on = on or {}
+    self.timeout = timeout
+    self.delay = delay
+
+''' class Machine
+    A machine runs until it reaches the 'done' state
+    Interrupts are handled in every state before its own transitions,
+     a handler may return a line, which is then fed as an event in its place
+    An activity, e.g., a Fight or a Disposal, has feed(line), poll(), deadline()
+     and done, returned by an enter or an interrupt handler it takes every line
+     until it is done, then its last line (or a 'done' event) goes to the state
+    Until a delayed enter has run only the interrupts see the lines
+    Each state and activity is a span in the bot's tracer
+
+    Attributes
+    bot           - ShadowThread, whose irc the machine talks on
+    states        - dict, name -> State
+    interrupts    - dict, event kind -> function(bot, event)
+    state         - the current State, None once done
+    entered       - time the current state was entered
+    wake          - None, or the time the current state's enter is due
+    activity      - None, or the activity running in the current state
+
+    Methods
+    goto          - Moves to a state
+    feed          - Handles an event
+    poll          - Runs a due enter or activity, or sends a 'timeout' event
+    deadline      - Returns the next time poll has something to do, or None
+    close         - Ends the open spans of a machine that won't run again
+'''
+class Machine():
+  def __init__(self, bot, states, start, interrupts=None):
+    self.bot = bot
+    self.states = {state.name:state for state in states}
+    self.interrupts = interrupts or {}
+    self.state = None
+    self.entered = 0
+    self.wake = None
+    self.activity = None
+    self.goto(start)
+
+  @property
+  def done(self):
+    return self.state is None
+
+  def goto(self, name):
+    while name is not None:
+      if self.state is not None:
+        self.bot.tracer.end()
+      if name == 'done':
+        self.state = None
+        return
+      self.state = self.states[name]
+      self.bot.tracer.begin(name, None)
+      self.entered = time.time()
+      if self.state.delay > 0:
+        self.wake = self.entered + self.state.delay
+        return
+      self.wake = None
+      name = self.enter()
+
+  ''' enter
+      Runs the current state's enter, returns the name of the next state or None
+  '''
+  def enter(self):
+    result = self.state.enter(self.bot) if self.state.enter else None
+    if result is None or isinstance(result, str):
+      return result
+    return self.start(result)
+
+  ''' start
+      Runs an activity, returns the name of the next state if it is done at once
+  '''
+  def start(self, activity):
+    self.activity = activity
+    self.bot.tracer.begin(activity.name, None)
+    activity.poll()
+    return self.settle()
+
+  ''' settle
+      Returns the name of the next state once the activity is done, or None
+  '''
+  def settle(self):
+    if self.activity is None or not self.activity.done:
+      return None
+    self.bot.tracer.end()
+    line, self.activity = self.activity.line, None
+    return self.target(classify(line) if line else Event('done', ''))
+
+  ''' target
+      Returns the name of the state the current state goes to on an event, or None
+  '''
+  def target(self, event):
+    # Until a delayed enter has run, the lines aren't answers to this state
+    if event.kind in self.interrupts or self.wake is not None:
+      return None
+    target = self.state.on.get(event.kind)
+    if callable(target):
+      target = target(self.bot, event)
+    return target
+
+  def feed(self, event):
+    if self.done:
+      return
+    if self.activity is not None:
+      self.activity.feed(event.line)
+      self.goto(self.settle())
+      return
+    handler = self.interrupts.get(event.kind)
+    if handler is None:
+      self.goto(self.target(event))
+      return
+    result = handler(self.bot, event)
+    if not result:
+      return
+    if isinstance(result, str):
+      self.goto(self.target(classify(result)))
+    else:
+      self.goto(self.start(result))
+
+  def deadline(self):
+    if self.done:
+      return None
+    if self.activity is not None:
+      return self.activity.deadline()
+    if self.wake is not None:
+      return self.wake
+    if self.state.timeout is None:
+      return None
+    return self.entered + self.state.timeout
+
+  def poll(self):
+    deadline = self.deadline()
+    if deadline is None or time.time() < deadline:
+      return
+    if self.activity is not None:
+      self.activity.poll()
+      self.goto(self.settle())
+    elif self.wake is not None:
+      self.wake = None
+      self.entered = time.time()
+      self.goto(self.enter())
+    else:
+      self.feed(Event('timeout', ''))
+
+  def close(self):
+    if self.activity is not None:
+      self.activity = None
+      self.bot.tracer.end()
+    if self.state is not None:
+      self.state = None
+      self.bot.tracer.end()
+
+''' class Scheduler
+    Drives machines until they are done, from the thread of the loop function
+    The irc sockets are in one selector and the select timeout is the
+     nearest machine deadline, so waiting costs nothing
+    A state's enter and the interrupt handlers run in this thread,
+     so they only send, anything longer (combat, disposal) is an activity
+    A machine whose bot quits is closed and dropped, the others carry on,
+     run raises 'Player quit' once they are done
+
+    Attributes
+    machines      - list of Machine
+    selector      - selectors.DefaultSelector, with the irc sockets and wake pipes
+    quit          - boolean, whether a machine was dropped because its bot quit
+'''
+class Scheduler():
+  def __init__(self, machines):
+    self.machines = list(machines)
+    self.selector = selectors.DefaultSelector()
+    self.quit = False
+    for machine in self.machines:
+      self.selector.register(machine.bot.irc.irc, selectors.EVENT_READ, machine)
+      # control() from the menu wakes us through the irc's pipe
+      self.selector.register(machine.bot.irc.wakeread, selectors.EVENT_READ, machine)
+
+  ''' drop
+      Closes a machine and stops selecting on its bot's irc
+  '''
+  def drop(self, machine):
+    machine.close()
+    # Leave the lines for a done machine's bot to whoever reads next
+    if machine.bot.irc.irc in self.selector.get_map():
+      self.selector.unregister(machine.bot.irc.irc)
+      self.selector.unregister(machine.bot.irc.wakeread)
+
+  ''' receive
+      Feeds a machine every line its bot's irc has ready
+  '''
+  def receive(self, machine):
+    bot = machine.bot
+    while True:
+      response = bot.receive(timeout=0)
+      line = bot.getlambmsg(response)
+      if line != '':
+        bot.print(line)
+        machine.feed(classify(line))
+      if len(bot.irc.readybuff) == 0:
+        return
+
+  def run(self):
+    try:
+      while any(not machine.done for machine in self.machines):
+        for machine in self.machines:
+          if machine.bot.doquit and not machine.done:
+            self.drop(machine)
+            self.quit = True
+          # Lines already buffered won't show up in the selector
+          if len(machine.bot.irc.readybuff) > 0 and not machine.done:
+            self.receive(machine)
+        running = [machine for machine in self.machines if not machine.done]
+        if len(running) == 0:
+          break
+        deadlines = [machine.deadline() for machine in running]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        # Each bot's own timers, arrivals and periodic jobs
+        timeout = min(machine.bot.timers.timeout() for machine in running)
+        if len(deadlines) > 0:
+          timeout = min(timeout, max(0, min(deadlines) - time.time()))
+        for key, _ in self.selector.select(timeout=timeout):
+          if not key.data.done:
+            self.receive(key.data)
+        for machine in running:
+          machine.bot.timers.run()
+          machine.poll()
+          if machine.done:
+            self.drop(machine)
+    finally:
+      for machine in self.machines:
+        machine.close()
+      self.selector.close()
+    if self.quit:
+      raise Exception('Player quit')
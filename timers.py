@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  timers.py
+#  A heap of named deadlines and periodic jobs,
+#   and the one place "remaining" / "ETA" messages are parsed
+##
+#  Author: Chase LP
+###
+
+import re, time, heapq
+
+# You continue to Seattle_Subway. 1m 12s remaining
+remainingline = re.compile(r' ?((?:\d+m ?)?(?:\d+s ?)?)remaining$')
+# You are travelling to Seattle. ETA: 3m 12s
+etaline = re.compile(r' ?ETA: ((?:\d+m ?)?(?:\d+s)?)$')
+
+''' seconds
+    Returns the seconds in a duration like '3m 12s', '3m' or '12s'
+'''
+def seconds(text):
+  total = 0
+  mins = re.search(r'(\d+)m', text)
+  secs = re.search(r'(\d+)s', text)
+  if mins: total += int(mins.group(1)) * 60
+  if secs: total += int(secs.group(1))
+  return total
+
+''' findeta
+    Returns (seconds, action) for a line ending in a time remaining or an ETA,
+     action is the line without the time, or None for any other line
+'''
+def findeta(line):
+  for pattern in (remainingline, etaline):
+    match = pattern.search(line)
+    if match is not None and match.group(1).strip() != '':
+      return seconds(match.group(1)), line[:match.start()]
+  return None
+
+''' class TimerHeap
+    Every timer has a name, setting a name again replaces its deadline
+    Replaced and cancelled entries stay in the heap and are skipped when popped
+
+    Attributes
+    heap          - list of (deadline, sequence, name), a heapq
+    timers        - dict, name -> (deadline, callback, interval)
+    sequence      - a counter so heapq never compares names
+
+    Methods
+    at            - Sets a timer for a time
+    after         - Sets a timer for some seconds from now
+    every         - Sets a periodic job
+    cancel        - Removes a timer
+    deadline      - Returns the time a timer is due, or None
+    remaining     - Returns the seconds until a timer is due, or None
+    timeout       - Returns the seconds to wait for input before the next timer
+    run           - Fires every due timer, returns their names
+'''
+class TimerHeap():
+  def __init__(self):
+    self.heap = []
+    self.timers = {}
+    self.sequence = 0
+
+  ''' at
+      Parameters
+      name        - string, the timer
+      when        - the time it is due
+      callback    - None, or a function run when it fires
+      interval    - None, or the seconds until it is due again
+  '''
+  def at(self, name, when, callback=None, interval=None):
+    self.timers[name] = (when, callback, interval)
+    heapq.heappush(self.heap, (when, self.sequence, name))
+    self.sequence += 1
+
+  def after(self, name, seconds, callback=None, interval=None):
+    self.at(name, time.time() + seconds, callback, interval)
+
+  def every(self, name, interval, callback):
+    self.after(name, interval, callback, interval)
+
+  def cancel(self, name):
+    self.timers.pop(name, None)
+
+  def deadline(self, name):
+    timer = self.timers.get(name)
+    return None if timer is None else timer[0]
+
+  def remaining(self, name):
+    deadline = self.deadline(name)
+    return None if deadline is None else deadline - time.time()
+
+  ''' top
+      Returns the (deadline, name) of the next live timer, or None
+  '''
+  def top(self):
+    while len(self.heap) > 0:
+      when, _, name = self.heap[0]
+      timer = self.timers.get(name)
+      if timer is not None and timer[0] == when:
+        return when, name
+      heapq.heappop(self.heap)
+    return None
+
+  ''' timeout
+      Returns the seconds to wait for input, the next deadline or at most limit
+  '''
+  def timeout(self, limit=30):
+    top = self.top()
+    if top is None:
+      return limit
+    return min(limit, max(0, top[0] - time.time()))
+
+  def run(self):
+    fired = []
+    now = time.time()
+    while True:
+      top = self.top()
+      if top is None or top[0] > now:
+        return fired
+      when, name = top
+      heapq.heappop(self.heap)
+      _, callback, interval = self.timers.pop(name)
+      if interval is not None:
+        self.at(name, max(now, when + interval), callback, interval)
+      fired.append(name)
+      if callback is not None:
+        callback()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  tracing.py
+#  Spans around the phases of a loop iteration (travel, combat, waiting,
+#   selling, resting), where each iteration's time went
+##
+#  Author: Chase LP
+###
+
+'''
+    A span's own time is its duration less the spans inside it, so
+     an awaitresponse inside gotoloc counts as awaitresponse, not twice
+    The trace file is in the Chrome trace event format, one event a line,
+     it opens in chrome://tracing or https://ui.perfetto.dev as it is
+'''
+
+import os, json, time, threading, functools
+
+''' class Tracer
+    One for each bot, its spans are only opened by one thread at a time
+
+    Attributes
+    nick          - string, the bot's nick in the trace
+    stack         - list of open spans, [name, start, time in children, args]
+    owntime       - dict, span name -> own seconds this iteration
+    started       - time the iteration started
+    outfile       - None, or the trace file
+    named         - set of the thread ids named in the trace file
+
+    Methods
+    setfile       - Starts or stops writing spans to a trace file
+    begin         - Opens a span inside the open spans
+    end           - Closes the innermost span
+    newiteration  - Starts the breakdown of an iteration
+    enditeration  - Writes the iteration, returns its breakdown
+'''
+class Tracer():
+  def __init__(self, nick, filename=None):
+    self.nick = nick
+    self.stack = []
+    self.owntime = {}
+    self.started = time.time()
+    self.outfile = None
+    self.filename = None
+    self.named = set()
+    self.setfile(filename)
+
+  def setfile(self, filename):
+    if filename == self.filename:
+      return
+    # Opened before the old file is closed, so a failure changes nothing
+    outfile = None if filename is None else open(filename, 'a', buffering=1)
+    if self.outfile is not None:
+      self.outfile.close()
+    self.outfile = outfile
+    self.filename = filename
+    if outfile is None:
+      return
+    # The closing ] is optional in the format, so the file can grow forever
+    if outfile.tell() == 0:
+      outfile.write('[\n')
+    self.named = set()
+
+  def write(self, event):
+    if self.outfile is None:
+      return
+    pid, tid = os.getpid(), threading.get_ident()
+    # Name the thread the spans are on with our nick
+    if tid not in self.named:
+      self.named.add(tid)
+      self.write({'name':'thread_name', 'ph':'M', 'args':{'name':self.nick}})
+    event['pid'] = pid
+    event['tid'] = tid
+    self.outfile.write(json.dumps(event) + ',\n')
+
+  def begin(self, name, args):
+    self.stack.append([name, time.time(), 0, args])
+
+  def end(self):
+    name, start, childtime, args = self.stack.pop()
+    duration = time.time() - start
+    self.owntime[name] = self.owntime.get(name, 0) + duration - childtime
+    if len(self.stack) > 0:
+      self.stack[-1][2] += duration
+    event = {'name':name, 'ph':'X', 'ts':int(start * 1e6), 'dur':int(duration * 1e6)}
+    if args:
+      event['args'] = args
+    self.write(event)
+
+  def newiteration(self):
+    self.owntime = {}
+    self.started = time.time()
+
+  ''' enditeration
+      Returns [(name, own seconds)] for the iteration, the most first,
+       with 'other' for the time in no span
+  '''
+  def enditeration(self, loop, fncounter):
+    now = time.time()
+    self.write({'name':loop, 'ph':'X', 'ts':int(self.started * 1e6),
+                'dur':int((now - self.started) * 1e6), 'cat':'iteration',
+                'args':{'iteration':fncounter}})
+    breakdown = sorted(self.owntime.items(), key=lambda item: -item[1])
+    other = now - self.started - sum(self.owntime.values())
+    if other > 0:
+      breakdown.append(('other', other))
+    return breakdown
+
+  def close(self):
+    self.setfile(None)
+
+''' traced
+    Decorates a method of an object with a tracer, a span for each call
+'''
+def traced(name):
+  def decorate(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      self.tracer.begin(name, None)
+      try:
+        return method(self, *args, **kwargs)
+      finally:
+        self.tracer.end()
+    return wrapper
+  return decorate
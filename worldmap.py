@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  worldmap.py
+#  A graph of cities, subway links and known locations for route planning
+##
+#  Author: Chase LP
+###
+
+import os, json, heapq, fcntl
+from contextlib import contextmanager
+
+# '#travel 1' moves to the right, 2 to left, (unless in redmond)
+# Chicago <-> Delaware <-> Seattle <-> Redmond
+subway = {'Chicago':  {'Delaware':'#travel 1'},
+          'Delaware': {'Chicago':'#travel 2', 'Seattle':'#travel 1'},
+          'Seattle':  {'Delaware':'#travel 2', 'Redmond':'#travel 1'},
+          'Redmond':  {'Seattle':'#travel 1'},
+         }
+
+# Locations we know exist before we have seen any others
+knownplaces = ['Redmond_Hotel', 'Redmond_OrkHQ'] + \
+              [city + '_Subway' for city in subway]
+
+''' class WorldMap
+    The nodes are locations, 'Redmond_Hotel', and cities, 'Redmond'
+    Being in a city means being on its streets, a #goto away from its locations
+    Each edge is a step:
+     (kind, argument, source, destination)
+     kind is one of 'goto', 'travel', 'teleport', 'teleportii' or None
+     None is a free step, from inside a location to its city's streets
+    Edge weights are seconds, learned from measured walks, ETAs and casts
+    Every bot saves to the same file, so a save merges under an exclusive
+     flock, what we measured since our last save is averaged into the saved
+     weights, and the file is replaced atomically
+
+    Attributes
+    filename      - string, the json file the places and weights are kept in
+    lockname      - string, the lock file
+    places        - dict, city -> set of known locations in that city
+    weights       - dict, edge key -> learned seconds
+    measured      - dict, edge key -> list of seconds measured since our last save
+    defaults      - dict, kind -> seconds to assume before we have measured it
+    alpha         - float, weight of a new measurement in the running average
+
+    Methods
+    addplace      - Adds a location to the map
+    cost          - Returns the seconds expected for a step
+    learn         - Updates the seconds for a step from a measurement
+    plan          - Returns the cheapest list of steps between two nodes
+    save          - Merges the places and weights into filename
+'''
+class WorldMap():
+  defaults = {'goto':60, 'travel':240, 'teleport':20, 'teleportii':30}
+  alpha    = 0.3
+
+  def __init__(self, filename='worldmap.json'):
+    self.filename = filename
+    self.lockname = None if filename is None else filename + '.lock'
+    self.places = {city:set() for city in subway}
+    self.weights = {}
+    self.measured = {}
+    for place in knownplaces:
+      self.addplace(place)
+    if filename is not None:
+      with self.locked():
+        self.read()
+
+  ''' locked
+      Context manager holding a flock on the lock file
+
+      Parameters
+      exclusive   - boolean, an exclusive (write) or shared (read) lock
+  '''
+  @contextmanager
+  def locked(self, exclusive=False):
+    with open(self.lockname, 'a') as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield
+      finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+  ''' read
+      Adds the saved places and takes the saved weights
+      The caller must hold a lock
+  '''
+  def read(self):
+    try:
+      with open(self.filename) as infile:
+        saved = json.load(infile)
+    except FileNotFoundError:
+      return
+    for place in saved.get('places', []):
+      self.addplace(place)
+    self.weights.update(saved.get('weights', {}))
+
+  ''' save
+      Merges our places and measurements with what other bots have saved
+      The saved weights are taken, then what we measured since our last
+       save is averaged into them as if it had been learned from there
+  '''
+  def save(self):
+    if self.filename is None:
+      return
+    with self.locked(exclusive=True):
+      self.read()
+      for key, samples in self.measured.items():
+        for seconds in samples:
+          self.average(key, seconds)
+      self.measured = {}
+      places = sorted(place for city in self.places
+                            for place in self.places[city])
+      tmpname = f'{self.filename}.{os.getpid()}'
+      with open(tmpname, 'w') as outfile:
+        json.dump({'places':places, 'weights':self.weights}, outfile, indent=1)
+      os.replace(tmpname, self.filename)
+
+  ''' addplace
+      Adds a location of the form 'City_Place' to the map
+      Returns the location with its city capitalized as in the map
+  '''
+  def addplace(self, location):
+    if '_' not in location:
+      return location
+    city, place = location.split('_', 1)
+    for known in self.places:
+      if known.lower() == city.lower():
+        location = known + '_' + place
+        self.places[known].add(location)
+        break
+    return location
+
+  ''' key
+      Returns the key for a step in the weights dict
+      Walks and subway rides are kept per destination,
+       casts are kept per city since a cast takes about as long anywhere
+  '''
+  def key(self, kind, src, dst):
+    if kind == 'goto': return 'goto:' + dst
+    if kind == 'travel': return f'travel:{src}>{dst}'
+    if kind == 'teleport': return 'teleport:' + dst.split('_')[0]
+    return kind
+
+  def cost(self, kind, src, dst):
+    if kind is None:
+      return 0
+    return self.weights.get(self.key(kind, src, dst), self.defaults[kind])
+
+  def learn(self, kind, src, dst, seconds):
+    if kind is None or seconds <= 0:
+      return
+    key = self.key(kind, src, dst)
+    self.average(key, seconds)
+    self.measured.setdefault(key, []).append(seconds)
+
+  ''' average
+      Moves the weight for a key toward a measurement
+  '''
+  def average(self, key, seconds):
+    if key in self.weights:
+      seconds = (1-self.alpha)*self.weights[key] + self.alpha*seconds
+    self.weights[key] = round(seconds, 1)
+
+  ''' steps
+      Yields the steps available from a node
+
+      Parameters
+      node        - string, a city or a location
+      cancast     - boolean, whether teleport and teleportii are available
+  '''
+  def steps(self, node, cancast):
+    if '_' in node:
+      city = node.split('_')[0]
+      # We can #goto elsewhere directly from inside a location
+      yield (None, None, node, city)
+      # The subway takes us to the next city's streets
+      if node == city + '_Subway':
+        for nextcity, cmd in subway.get(city, {}).items():
+          yield ('travel', cmd, city, nextcity)
+      return
+    for place in self.places.get(node, ()):
+      yield ('goto', place, node, place)
+      if cancast:
+        yield ('teleport', place, node, place)
+    if cancast:
+      for city in self.places:
+        if city == node: continue
+        for place in self.places[city]:
+          yield ('teleportii', place, node, place)
+
+  ''' plan
+      Returns a list of (kind, argument, source, destination) steps
+       for the cheapest route, Dijkstra over the learned weights
+      Returns None if there is no route
+
+      Parameters
+      src         - string, where we are, a city or a location
+      dst         - string, where we want to be, a location
+      cancast     - boolean, whether teleport and teleportii are available
+  '''
+  def plan(self, src, dst, cancast=True):
+    src = self.addplace(src)
+    dst = self.addplace(dst)
+    best = {src:0}
+    prev = {}
+    # (cost, tiebreaker, node), the counter keeps heapq from comparing nodes
+    queue = [(0, 0, src)]
+    counter = 1
+    while len(queue) > 0:
+      cost, _, node = heapq.heappop(queue)
+      if node == dst:
+        break
+      if cost > best[node]:
+        continue
+      for step in self.steps(node, cancast):
+        # For a travel step the nodes are the cities, the weight key as well
+        nextnode = step[3]
+        nextcost = cost + self.cost(step[0], step[2], step[3])
+        if nextnode not in best or nextcost < best[nextnode]:
+          best[nextnode] = nextcost
+          prev[nextnode] = (node, step)
+          heapq.heappush(queue, (nextcost, counter, nextnode))
+          counter += 1
+    if dst not in best:
+      return None
+    path = []
+    node = dst
+    while node != src:
+      node, step = prev[node]
+      # Free steps don't need a command
+      if step[0] is not None:
+        path.append(step)
+    path.reverse()
+    return path
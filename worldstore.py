@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+
+'''
+    shadowbot - an IRC bot to talk to another IRC bot
+    Copyright (C) 2022  Chase Phelps
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+###
+#  worldstore.py
+#  Persistent world knowledge shared by every bot on this host:
+#   entrance messages, items the stores refuse,
+#   and each player's known places, known words, position
+##
+#  Author: Chase LP
+###
+
+import os, json, time, fcntl
+from contextlib import contextmanager
+
+# entermsg is a dict keyed on locations with entrance messages as values
+# These are the messages we know before we have learned any others
+entermsg = {'Redmond':'You arrive at Redmond',
+            'Redmond_Hotel':'You enter the Redmond Hotel',
+            ################ The OrkHQ, for getting bacon
+            'Redmond_OrkHQ':'You enter the ork headquarters',
+            'OrkHQ_StorageRoom':'You continue inside OrkHQ_StorageRoom',
+            # Confirmed exit messages the same for:
+            # Redmond_OrkHQ, Redmond_Hideout, Seattle_Renraku,
+            # Seattle_Forest, Seattle_Harbor, Delaware_Nysoft,
+            # Delaware_Prison
+            'Exit':'You can return to this location',
+            # '#travel 1' moves to the right, 2 to left, (unless in redmond)
+            # Chicago <-> Delaware <-> Seattle <-> Redmond
+            'Subway':'You enter the Subway',
+           }
+
+''' class WorldStore
+    The store is a json file, every change is a read-modify-write
+     while holding an exclusive flock on a separate lock file
+    Reads use a shared lock and are only done when the file has changed
+
+    Attributes
+    filename      - string, the json file
+    lockname      - string, the lock file
+    data          - dict, the last contents of the file
+    mtime         - the modification time of the file when data was read
+
+    Methods
+    entermsg      - Returns the entrance message for a location
+    learnentermsg - Saves the entrance message for a location
+    locationfor   - Returns the location with this entrance message, or None
+    refused       - Returns the item names stores have refused to buy
+    addrefused    - Saves an item name a store refused to buy
+    knownplaces   - Returns a player's known places in a city, or None
+    setknownplaces, addknownplaces
+    knownwords    - Returns a player's known words, or None
+    setknownwords, addknownwords
+    position      - Returns a player's last known location and whether
+                     they were inside it, or None
+    setposition   - Saves a player's location, inside or outside of it
+'''
+class WorldStore():
+  def __init__(self, filename='world.json'):
+    self.filename = filename
+    self.lockname = filename + '.lock'
+    self.data = {'entermsg':{}, 'refused':[], 'players':{}}
+    self.mtime = None
+    self.load()
+
+  ''' locked
+      Context manager holding a flock on the lock file
+
+      Parameters
+      exclusive   - boolean, an exclusive (write) or shared (read) lock
+  '''
+  @contextmanager
+  def locked(self, exclusive=False):
+    with open(self.lockname, 'a') as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield
+      finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+  ''' read
+      Re-reads the file if it changed since we last read it
+      The caller must hold a lock
+  '''
+  def read(self):
+    try:
+      mtime = os.stat(self.filename).st_mtime_ns
+    except FileNotFoundError:
+      return
+    if mtime == self.mtime:
+      return
+    with open(self.filename) as infile:
+      data = json.load(infile)
+    self.data = {'entermsg':data.get('entermsg', {}),
+                 'refused':data.get('refused', []),
+                 'players':data.get('players', {})}
+    self.mtime = mtime
+
+  def load(self):
+    with self.locked():
+      self.read()
+
+  ''' update
+      Applies a change to the latest contents and writes them back
+      The file is replaced atomically so readers never see a partial file
+
+      Parameters
+      change      - function taking the data dict, returns False to skip the write
+  '''
+  def update(self, change):
+    with self.locked(exclusive=True):
+      self.read()
+      if change(self.data) is False:
+        return
+      tmpname = f'{self.filename}.{os.getpid()}'
+      with open(tmpname, 'w') as outfile:
+        json.dump(self.data, outfile, indent=1)
+      os.replace(tmpname, self.filename)
+      self.mtime = os.stat(self.filename).st_mtime_ns
+
+  ''' player
+      Returns the dict for a player inside data, creating it if needed
+  '''
+  def player(self, data, nick):
+    return data['players'].setdefault(nick, {'kp':{}, 'kw':None,
+                                             'position':None})
+
+  def entermsg(self, location, default='You enter'):
+    self.load()
+    learned = self.data['entermsg']
+    if location in learned: return learned[location]
+    if location in entermsg: return entermsg[location]
+    # 'Seattle_Subway' has the same entrance message as any 'Subway'
+    place = location.split('_')[-1]
+    return learned.get(place, entermsg.get(place, default))
+
+  def learnentermsg(self, location, msg):
+    if self.entermsg(location, None) == msg:
+      return
+    def change(data):
+      data['entermsg'][location] = msg
+    self.update(change)
+
+  def locationfor(self, line):
+    self.load()
+    for msgs in (self.data['entermsg'], entermsg):
+      for location, msg in msgs.items():
+        if '_' in location and line.startswith(msg):
+          return location
+    return None
+
+  def refused(self):
+    self.load()
+    return self.data['refused']
+
+  def addrefused(self, name):
+    def change(data):
+      if name in data['refused']:
+        return False
+      data['refused'].append(name)
+    self.update(change)
+
+  ''' knownplaces
+      Returns a list of the places a player knows in a city
+      Returns None if we don't know, or only knew more than maxage seconds ago
+
+      Parameters
+      nick        - string, the player
+      city        - string, the city
+      maxage      - None, or the seconds after which the list is too old
+  '''
+  def knownplaces(self, nick, city, maxage=None):
+    self.load()
+    known = self.data['players'].get(nick, {}).get('kp', {}).get(city)
+    if known is None:
+      return None
+    if maxage is not None and time.time() - known['time'] > maxage:
+      return None
+    return known['places']
+
+  def setknownplaces(self, nick, city, places):
+    def change(data):
+      self.player(data, nick)['kp'][city] = {'time':time.time(),
+                                             'places':sorted(set(places))}
+    self.update(change)
+
+  def addknownplaces(self, nick, city, places):
+    def change(data):
+      kp = self.player(data, nick)['kp']
+      known = kp.get(city, {'time':0, 'places':[]})
+      known['places'] = sorted(set(known['places']) | set(places))
+      kp[city] = known
+    self.update(change)
+
+  def knownwords(self, nick, maxage=None):
+    self.load()
+    known = self.data['players'].get(nick, {}).get('kw')
+    if known is None:
+      return None
+    if maxage is not None and time.time() - known['time'] > maxage:
+      return None
+    return known['words']
+
+  def setknownwords(self, nick, words):
+    def change(data):
+      self.player(data, nick)['kw'] = {'time':time.time(),
+                                        'words':sorted(set(words))}
+    self.update(change)
+
+  def addknownwords(self, nick, words):
+    def change(data):
+      player = self.player(data, nick)
+      known = player['kw'] or {'time':0, 'words':[]}
+      known['words'] = sorted(set(known['words']) | set(words))
+      player['kw'] = known
+    self.update(change)
+
+  ''' position
+      Returns a player's last known (location, inside), or None
+      inside is True within a location, False outside of it or in its city
+      Characters don't move while their bot is down,
+       maxage guards against someone having played them by hand since
+
+      Parameters
+      nick        - string, the player
+      maxage      - None, or the seconds after which the position is too old
+  '''
+  def position(self, nick, maxage=None):
+    self.load()
+    known = self.data['players'].get(nick, {}).get('position')
+    # Positions saved before inside was kept don't say which side we were on
+    if known is None or 'inside' not in known:
+      return None
+    if maxage is not None and time.time() - known['time'] > maxage:
+      return None
+    return known['location'], known['inside']
+
+  def setposition(self, nick, location, inside):
+    def change(data):
+      player = self.player(data, nick)
+      if player['position'] is not None \
+          and player['position']['location'] == location \
+          and player['position'].get('inside') == inside:
+        return False
+      player['position'] = {'time':time.time(), 'location':location,
+                            'inside':inside}
+    self.update(change)